@@ -18,17 +18,16 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import csv
 import logging
+import math
 import os
 import random
 import sys
-import codecs
 import numpy as np
 import torch
 import torch.nn as nn
 from collections import defaultdict
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
+from torch.utils.data import (DataLoader, RandomSampler,
                               TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
@@ -42,6 +41,15 @@ from transformers.tokenization_roberta import RobertaTokenizer
 from transformers.optimization import AdamW
 from transformers.modeling_roberta import RobertaModel#RobertaForSequenceClassification
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from tsv_reader import read_tsv
+from feature_conversion import convert_examples_to_features
+from kshot_sampler import StratifiedKShotSampler
+from mixed_precision import MixedPrecision
+from gradient_checkpointing import enable_gradient_checkpointing
+from feature_cache import TokenizedFeatures
+from batching import features_dataloader, restore_order
+
 # from transformers.modeling_bert import BertModel
 # from transformers.tokenization_bert import BertTokenizer
 # from bert_common_functions import store_transformers_models
@@ -116,16 +124,6 @@ class InputExample(object):
         self.label = label
 
 
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids, input_mask, segment_ids, label_id):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-
-
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
@@ -136,14 +134,7 @@ class DataProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """Reads a tab separated value file."""
-        with open(input_file, "r") as f:
-            reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-            lines = []
-            for line in reader:
-                if sys.version_info[0] == 2:
-                    line = list(unicode(cell, 'utf-8') for cell in line)
-                lines.append(line)
-            return lines
+        return [list(line) for line in read_tsv(input_file, strip_fields=False)]
 
 class RteProcessor(DataProcessor):
     """Processor for the RTE data set (GLUE version)."""
@@ -154,98 +145,56 @@ class RteProcessor(DataProcessor):
         can read the training file, dev and test file
         '''
         examples=[]
-        readfile = codecs.open(filename, 'r', 'utf-8')
-        line_co=0
-        for row in readfile:
-            if line_co>0:
-                line=row.strip().split('\t')
-                guid = "train-"+str(line_co-1)
-                text_a = line[1].strip()
-                text_b = line[2].strip()
-                label = 'entailment' if line[3].strip()=='entailment' else 'not_entailment' #["entailment", "not_entailment"]
-                examples.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            line_co+=1
-            # if line_co > 20000:
-            #     break
-        readfile.close()
-        print('loaded  size:', line_co)
+        for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, columns=(1, 2, 3), skip_header=True)):
+            guid = "train-"+str(line_co)
+            label = 'entailment' if label=='entailment' else 'not_entailment' #["entailment", "not_entailment"]
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+        print('loaded  size:', len(examples))
         return examples
 
-    def get_RTE_as_train_k_shot(self, filename, k_shot):
+    def get_RTE_as_train_k_shot(self, filename, k_shot, sampling_seed=None):
         '''
         can read the training file, dev and test file
+        sampling_seed: draw the k-shot examples with their own random.Random instead of the global state
         '''
-        examples_entail=[]
-        examples_non_entail=[]
-        readfile = codecs.open(filename, 'r', 'utf-8')
-        line_co=0
-        for row in readfile:
-            if line_co>0:
-                line=row.strip().split('\t')
-                guid = "train-"+str(line_co-1)
-                text_a = line[1].strip()
-                text_b = line[2].strip()
-                label = 'entailment' if line[3].strip()=='entailment' else 'not_entailment' #["entailment", "not_entailment"]
-                if label == 'entailment':
-                    examples_entail.append(
-                        InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-                else:
-                    examples_non_entail.append(
-                        InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            line_co+=1
-        readfile.close()
-        print('loaded  entail size:', len(examples_entail), 'non-entail size:', len(examples_non_entail))
+        examples=[]
+        for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, columns=(1, 2, 3), skip_header=True)):
+            guid = "train-"+str(line_co)
+            label = 'entailment' if label=='entailment' else 'not_entailment' #["entailment", "not_entailment"]
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+        sampler = StratifiedKShotSampler([ex.label for ex in examples], ["entailment", "not_entailment"])
+        print('loaded  entail size:', sampler.sizes()[0], 'non-entail size:', sampler.sizes()[1])
         '''sampling'''
         if k_shot > 99999:
-            return examples_entail+examples_non_entail
+            rows = sampler.all_rows()
         else:
-            sampled_examples = random.sample(examples_entail, k_shot)+random.sample(examples_non_entail, k_shot)
-            return sampled_examples
+            rows = np.concatenate(sampler.sample(k_shot, sampling_seed))
+        return [examples[i] for i in rows]
 
     def get_RTE_as_dev(self, filename):
         '''
         can read the training file, dev and test file
         '''
         examples=[]
-        readfile = codecs.open(filename, 'r', 'utf-8')
-        line_co=0
-        for row in readfile:
-            if line_co>0:
-                line=row.strip().split('\t')
-                guid = "dev-"+str(line_co-1)
-                text_a = line[1].strip()
-                text_b = line[2].strip()
-                # label = line[3].strip() #["entailment", "not_entailment"]
-                label = 'entailment' if line[3].strip()=='entailment' else 'not_entailment'
-                # label = 'entailment'  if line[3] == 'entailment' else 'neutral'
-                examples.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            line_co+=1
-            # if line_co > 20000:
-            #     break
-        readfile.close()
-        print('loaded  size:', line_co-1)
+        for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, columns=(1, 2, 3), skip_header=True)):
+            guid = "dev-"+str(line_co)
+            label = 'entailment' if label=='entailment' else 'not_entailment'
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+        print('loaded  size:', len(examples))
         return examples
 
     def get_RTE_as_test(self, filename):
-        readfile = codecs.open(filename, 'r', 'utf-8')
-        line_co=0
         examples=[]
-        for row in readfile:
-            line=row.strip().split('\t')
-            if len(line)==3:
-                guid = "test-"+str(line_co)
-                text_a = line[1]
-                text_b = line[2]
-                '''for RTE, we currently only choose randomly two labels in the set, in prediction we then decide the predicted labels'''
-                label = 'entailment'  if line[0] == '1' else 'not_entailment'
-                examples.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-                line_co+=1
-
-        readfile.close()
-        print('loaded test size:', line_co)
+        for line_co, (label, text_a, text_b) in enumerate(read_tsv(filename, num_columns=3, strip_fields=False)):
+            guid = "test-"+str(line_co)
+            '''for RTE, we currently only choose randomly two labels in the set, in prediction we then decide the predicted labels'''
+            label = 'entailment'  if label == '1' else 'not_entailment'
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+        print('loaded test size:', len(examples))
         return examples
 
     def get_labels(self):
@@ -269,154 +218,6 @@ class RteProcessor(DataProcessor):
 
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, output_mode,
-                                 cls_token_at_end=False,
-                                 cls_token='[CLS]',
-                                 cls_token_segment_id=1,
-                                 sep_token='[SEP]',
-                                 sep_token_extra=False,
-                                 pad_on_left=False,
-                                 pad_token=0,
-                                 pad_token_segment_id=0,
-                                 sequence_a_segment_id=0,
-                                 sequence_b_segment_id=1,
-                                 mask_padding_with_zero=True):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
-    """
-
-    label_map = {label : i for i, label in enumerate(label_list)}
-
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
-            special_tokens_count = 4 if sep_token_extra else 3
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - special_tokens_count)
-        else:
-            # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-            special_tokens_count = 3 if sep_token_extra else 2
-            if len(tokens_a) > max_seq_length - special_tokens_count:
-                tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids:   0   0   0   0  0     0   0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = tokens_a + [sep_token]
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + [sep_token]
-            segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
-
-        if cls_token_at_end:
-            tokens = tokens + [cls_token]
-            segment_ids = segment_ids + [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            segment_ids = [cls_token_segment_id] + segment_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-        else:
-            input_ids = input_ids + ([pad_token] * padding_length)
-            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        if output_mode == "classification":
-            label_id = label_map[example.label]
-        elif output_mode == "regression":
-            label_id = float(example.label)
-        else:
-            raise KeyError(output_mode)
-
-        # if ex_index < 5:
-        #     logger.info("*** Example ***")
-        #     logger.info("guid: %s" % (example.guid))
-        #     logger.info("tokens: %s" % " ".join(
-        #             [str(x) for x in tokens]))
-        #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-        #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-        #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-        #     logger.info("label: %s (id = %d)" % (example.label, label_id))
-
-        features.append(
-                InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
-                              label_id=label_id))
-    return features
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
-
-
-
-
-
-
-
-
 def main():
     parser = argparse.ArgumentParser()
 
@@ -431,6 +232,9 @@ def main():
                         default="",
                         type=str,
                         help="Where do you want to store the pre-trained models downloaded from s3")
+    parser.add_argument("--gradient_checkpointing",
+                        action='store_true',
+                        help="Recompute the encoder layer activations in the backward pass, for less memory per batch")
     parser.add_argument("--max_seq_length",
                         default=128,
                         type=int,
@@ -441,6 +245,10 @@ def main():
                         action='store_true',
                         help="Whether to run training.")
 
+    parser.add_argument("--sampling_seed",
+                        default=None,
+                        type=int,
+                        help="Seed of the k-shot sampling only; by default the k-shot examples follow --seed")
     parser.add_argument('--kshot',
                         type=int,
                         default=5,
@@ -459,6 +267,10 @@ def main():
                         default=64,
                         type=int,
                         help="Total batch size for eval.")
+    parser.add_argument("--eval_max_tokens",
+                        default=0,
+                        type=int,
+                        help="If set, evaluate in length-sorted batches of at most this many padded tokens instead of eval_batch_size rows, e.g. 8192")
     parser.add_argument("--learning_rate",
                         default=1e-5,
                         type=float,
@@ -489,7 +301,10 @@ def main():
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument('--fp16',
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
+                        help="Whether to run forward passes in float16 autocast with loss scaling (GPU only)")
+    parser.add_argument('--bf16',
+                        action='store_true',
+                        help="Whether to run forward passes in bfloat16 autocast (also what --fp16 falls back to without a GPU)")
     parser.add_argument('--loss_scale',
                         type=float, default=0,
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
@@ -519,14 +334,17 @@ def main():
         n_gpu = 1
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
-    logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
-        device, n_gpu, bool(args.local_rank != -1), args.fp16))
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+    logger.info("device: {} n_gpu: {}, distributed training: {}, precision: {}".format(
+        device, n_gpu, bool(args.local_rank != -1), precision))
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
                             args.gradient_accumulation_steps))
 
     args.train_batch_size = args.train_batch_size // args.gradient_accumulation_steps
+    logger.info("effective batch size: {} ({} accumulated batches of {})".format(
+        args.train_batch_size * args.gradient_accumulation_steps, args.gradient_accumulation_steps, args.train_batch_size))
 
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -549,7 +367,7 @@ def main():
     output_mode = output_modes[task_name]
 
 
-    train_examples = processor.get_RTE_as_train_k_shot('/export/home/Dataset/glue_data/RTE/train.tsv', args.kshot) #train_pu_half_v1.txt
+    train_examples = processor.get_RTE_as_train_k_shot('/export/home/Dataset/glue_data/RTE/train.tsv', args.kshot, sampling_seed=args.sampling_seed) #train_pu_half_v1.txt
     dev_examples = processor.get_RTE_as_dev('/export/home/Dataset/glue_data/RTE/dev.tsv')
     test_examples = processor.get_RTE_as_test('/export/home/Dataset/RTE/test_RTE_1235.txt')
     label_list = ["entailment", "not_entailment"]
@@ -559,13 +377,15 @@ def main():
     print('num_labels:', num_labels, 'training size:', len(train_examples), 'dev size:', len(dev_examples), 'test size:', len(test_examples))
 
     num_train_optimization_steps = None
-    num_train_optimization_steps = int(
-        len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
+    num_train_optimization_steps = int(math.ceil(
+        math.ceil(len(train_examples) / args.train_batch_size) / args.gradient_accumulation_steps)) * args.num_train_epochs
     if args.local_rank != -1:
         num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
 
     model = RobertaForSequenceClassification(num_labels)
     tokenizer = RobertaTokenizer.from_pretrained(pretrain_model_dir, do_lower_case=args.do_lower_case)
+    if args.gradient_checkpointing:
+        logger.info("gradient checkpointing on %d encoder layers", enable_gradient_checkpointing(model.roberta_single))
     model.to(device)
 
     param_optimizer = list(model.named_parameters())
@@ -606,14 +426,8 @@ def main():
             pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
             pad_token_segment_id=0)#4 if args.model_type in ['xlnet'] else 0,)
 
-        dev_all_input_ids = torch.tensor([f.input_ids for f in dev_features], dtype=torch.long)
-        dev_all_input_mask = torch.tensor([f.input_mask for f in dev_features], dtype=torch.long)
-        dev_all_segment_ids = torch.tensor([f.segment_ids for f in dev_features], dtype=torch.long)
-        dev_all_label_ids = torch.tensor([f.label_id for f in dev_features], dtype=torch.long)
-
-        dev_data = TensorDataset(dev_all_input_ids, dev_all_input_mask, dev_all_segment_ids, dev_all_label_ids)
-        dev_sampler = SequentialSampler(dev_data)
-        dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=args.eval_batch_size)
+        dev_features = TokenizedFeatures.from_features(dev_features, args.max_seq_length, tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0])
+        dev_dataloader = features_dataloader(dev_features, args.eval_batch_size, dataloader_mode='sequential', max_tokens=args.eval_max_tokens)
 
 
         '''load test set'''
@@ -628,14 +442,8 @@ def main():
             pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
             pad_token_segment_id=0)#4 if args.model_type in ['xlnet'] else 0,)
 
-        eval_all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-        eval_all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-        eval_all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-        eval_all_label_ids = torch.tensor([f.label_id for f in test_features], dtype=torch.long)
-
-        eval_data = TensorDataset(eval_all_input_ids, eval_all_input_mask, eval_all_segment_ids, eval_all_label_ids)
-        eval_sampler = SequentialSampler(eval_data)
-        test_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        test_features = TokenizedFeatures.from_features(test_features, args.max_seq_length, tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0])
+        test_dataloader = features_dataloader(test_features, args.eval_batch_size, dataloader_mode='sequential', max_tokens=args.eval_max_tokens)
 
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(train_examples))
@@ -662,7 +470,8 @@ def main():
                 input_ids, input_mask, segment_ids, label_ids = batch
 
 
-                logits = model(input_ids, input_mask)
+                with precision.autocast():
+                    logits = model(input_ids, input_mask).float()
                 loss_fct = CrossEntropyLoss()
 
                 loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
@@ -672,15 +481,16 @@ def main():
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
 
-                loss.backward()
+                precision.backward(loss)
 
                 tr_loss += loss.item()
                 nb_tr_examples += input_ids.size(0)
                 nb_tr_steps += 1
 
-                optimizer.step()
-                optimizer.zero_grad()
-                global_step += 1
+                if (step + 1) % args.gradient_accumulation_steps == 0 or step + 1 == len(train_dataloader):
+                    precision.step(optimizer)
+                    optimizer.zero_grad()
+                    global_step += 1
                 iter_co+=1
                 # if iter_co %20==0:
                 if iter_co % len(train_dataloader)==0:
@@ -712,14 +522,17 @@ def main():
                             label_ids = label_ids.to(device)
                             gold_label_ids+=list(label_ids.detach().cpu().numpy())
 
-                            with torch.no_grad():
-                                logits = model(input_ids, input_mask)
+                            with torch.no_grad(), precision.autocast():
+                                logits = model(input_ids, input_mask).float()
                             if len(preds) == 0:
                                 preds.append(logits.detach().cpu().numpy())
                             else:
                                 preds[0] = np.append(preds[0], logits.detach().cpu().numpy(), axis=0)
 
                         preds = preds[0]
+                        '''token-budget batches are sorted by length, put the rows back in example order'''
+                        preds = restore_order(dev_or_test_dataloader, preds)
+                        gold_label_ids = restore_order(dev_or_test_dataloader, gold_label_ids)
 
                         pred_probs = softmax(preds,axis=1)
                         pred_label_ids = list(np.argmax(pred_probs, axis=1))
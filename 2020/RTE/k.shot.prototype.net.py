@@ -4,18 +4,16 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import csv
 import logging
+import math
 import os
 import random
 import sys
-import codecs
 import numpy as np
 import torch
 import torch.nn as nn
 from collections import defaultdict
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import DataLoader, RandomSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 from scipy.stats import beta
@@ -28,6 +26,15 @@ from transformers.tokenization_roberta import RobertaTokenizer
 from transformers.optimization import AdamW
 from transformers.modeling_roberta import RobertaModel#RobertaForSequenceClassification
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from embedding_cache import EmbeddingCache, checkpoint_fingerprint
+from tsv_reader import read_tsv
+from example_table import ExampleTable
+from feature_cache import FeatureCache
+from batching import features_dataloader
+from feature_conversion import parallel_convert_examples_to_features
+from kshot_sampler import StratifiedKShotSampler
+
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -66,162 +73,6 @@ class InputExample(object):
         self.label = label
 
 
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids, input_mask, segment_ids, label_id):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-
-
-
-
-
-
-
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, output_mode,
-                                 cls_token_at_end=False,
-                                 cls_token='[CLS]',
-                                 cls_token_segment_id=1,
-                                 sep_token='[SEP]',
-                                 sep_token_extra=False,
-                                 pad_on_left=False,
-                                 pad_token=0,
-                                 pad_token_segment_id=0,
-                                 sequence_a_segment_id=0,
-                                 sequence_b_segment_id=1,
-                                 mask_padding_with_zero=True):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
-    """
-
-    label_map = {label : i for i, label in enumerate(label_list)}
-
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
-            special_tokens_count = 4 if sep_token_extra else 3
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - special_tokens_count)
-        else:
-            # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-            special_tokens_count = 3 if sep_token_extra else 2
-            if len(tokens_a) > max_seq_length - special_tokens_count:
-                tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids:   0   0   0   0  0     0   0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = tokens_a + [sep_token]
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + [sep_token]
-            segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
-
-        if cls_token_at_end:
-            tokens = tokens + [cls_token]
-            segment_ids = segment_ids + [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            segment_ids = [cls_token_segment_id] + segment_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-        else:
-            input_ids = input_ids + ([pad_token] * padding_length)
-            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        if output_mode == "classification":
-            label_id = label_map[example.label]
-        elif output_mode == "regression":
-            label_id = float(example.label)
-        else:
-            raise KeyError(output_mode)
-
-        # if ex_index < 5:
-        #     logger.info("*** Example ***")
-        #     logger.info("guid: %s" % (example.guid))
-        #     logger.info("tokens: %s" % " ".join(
-        #             [str(x) for x in tokens]))
-        #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-        #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-        #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-        #     logger.info("label: %s (id = %d)" % (example.label, label_id))
-
-        features.append(
-                InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
-                              label_id=label_id))
-    return features
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
-
 class RobertaForSequenceClassification(nn.Module):
     def __init__(self, tagset_size):
         super(RobertaForSequenceClassification, self).__init__()
@@ -282,35 +133,25 @@ class PrototypeNet(nn.Module):
         return score_matrix
 
 
-def get_RTE_as_train_k_shot(filename, k_shot):
+def get_RTE_as_train_k_shot(filename, k_shot, sampling_seed=None):
     '''
     can read the training file, dev and test file
+    sampling_seed: draw the k-shot examples with their own random.Random instead of the global state
     '''
-    examples_entail=[]
-    examples_non_entail=[]
-    readfile = codecs.open(filename, 'r', 'utf-8')
-    line_co=0
-    for row in readfile:
-        if line_co>0:
-            line=row.strip().split('\t')
-            guid = "train-"+str(line_co-1)
-            text_a = line[1].strip()
-            text_b = line[2].strip()
-            label = 'entailment' if line[3].strip()=='entailment' else 'not_entailment' #["entailment", "not_entailment"]
-            if label == 'entailment':
-                examples_entail.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            else:
-                examples_non_entail.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        line_co+=1
-    readfile.close()
-    print('loaded  entail size:', len(examples_entail), 'non-entail size:', len(examples_non_entail))
+    examples=[]
+    for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, columns=(1, 2, 3), skip_header=True)):
+        guid = "train-"+str(line_co)
+        label = 'entailment' if label=='entailment' else 'not_entailment' #["entailment", "not_entailment"]
+        examples.append(
+            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+    sampler = StratifiedKShotSampler([ex.label for ex in examples], ["entailment", "not_entailment"])
+    print('loaded  entail size:', sampler.sizes()[0], 'non-entail size:', sampler.sizes()[1])
     '''sampling'''
     if k_shot > 99999:
-        return examples_entail, examples_non_entail
+        rows_entail, rows_non_entail = sampler.rows_by_label
     else:
-        return random.sample(examples_entail, k_shot), random.sample(examples_non_entail, k_shot)
+        rows_entail, rows_non_entail = sampler.sample(k_shot, sampling_seed)
+    return [examples[i] for i in rows_entail], [examples[i] for i in rows_non_entail]
 
 
 def get_RTE_as_dev(filename):
@@ -318,113 +159,62 @@ def get_RTE_as_dev(filename):
     can read the training file, dev and test file
     '''
     examples=[]
-    readfile = codecs.open(filename, 'r', 'utf-8')
-    line_co=0
-    for row in readfile:
-        if line_co>0:
-            line=row.strip().split('\t')
-            guid = "dev-"+str(line_co-1)
-            text_a = line[1].strip()
-            text_b = line[2].strip()
-            # label = line[3].strip() #["entailment", "not_entailment"]
-            label = 'entailment' if line[3].strip()=='entailment' else 'not_entailment'
-            # label = 'entailment'  if line[3] == 'entailment' else 'neutral'
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        line_co+=1
-        # if line_co > 20000:
-        #     break
-    readfile.close()
-    print('loaded  size:', line_co-1)
+    for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, columns=(1, 2, 3), skip_header=True)):
+        guid = "dev-"+str(line_co)
+        label = 'entailment' if label=='entailment' else 'not_entailment'
+        examples.append(
+            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+    print('loaded  size:', len(examples))
     return examples
 
 def get_RTE_as_test(filename):
-    readfile = codecs.open(filename, 'r', 'utf-8')
-    line_co=0
     examples=[]
-    for row in readfile:
-        line=row.strip().split('\t')
-        if len(line)==3:
-            guid = "test-"+str(line_co)
-            text_a = line[1]
-            text_b = line[2]
-            '''for RTE, we currently only choose randomly two labels in the set, in prediction we then decide the predicted labels'''
-            label = 'entailment'  if line[0] == '1' else 'not_entailment'
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            line_co+=1
-
-    readfile.close()
-    print('loaded test size:', line_co)
+    for line_co, (label, text_a, text_b) in enumerate(read_tsv(filename, num_columns=3, strip_fields=False)):
+        guid = "test-"+str(line_co)
+        '''for RTE, we currently only choose randomly two labels in the set, in prediction we then decide the predicted labels'''
+        label = 'entailment'  if label == '1' else 'not_entailment'
+        examples.append(
+            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+    print('loaded test size:', len(examples))
     return examples
 
-def get_MNLI_train(filename, k_shot):
+def get_MNLI_train(filename, k_shot, sampling_seed=None):
     '''
     classes: ["entailment", "neutral", "contradiction"]
+    returns ExampleTable views, all sharing the text buffer of the whole file
     '''
-    examples_entail = []
-    examples_neural = []
-    examples_contra = []
-    readfile = codecs.open(filename, 'r', 'utf-8')
-    line_co=0
-    for row in readfile:
-        if line_co>0:
-            line=row.strip().split('\t')
-            guid = "train-"+str(line_co-1)
-            # text_a = 'MNLI. '+line[8].strip()
-            text_a = line[8].strip()
-            text_b = line[9].strip()
-            label = line[-1].strip() #["entailment", "neutral", "contradiction"]
-
-            if label == 'entailment':
-                examples_entail.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            elif label == 'neutral':
-                examples_neural.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            else:
-                examples_contra.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        line_co+=1
-    readfile.close()
-    print('loaded  MNLI size:', len(examples_entail)+len(examples_neural)+len(examples_contra))
-
-    kshot_entail = random.sample(examples_entail, k_shot)
-    kshot_neural = random.sample(examples_neural, k_shot)
-    kshot_contra = random.sample(examples_contra, k_shot)
-
-    remaining_examples = []
-    for ex in examples_entail+examples_neural+examples_contra:
-        if ex not in set(kshot_entail+kshot_neural+kshot_contra):
-            remaining_examples.append(ex)
-
-    assert len(kshot_entail)+len(kshot_neural)+len(kshot_contra)+len(remaining_examples)==len(examples_entail+examples_neural+examples_contra)
+    examples = ExampleTable.from_rows(read_tsv(filename, columns=(8, 9, -1), skip_header=True),
+                                      ["entailment", "neutral", "contradiction"], 'train')
+    '''rows by label code: 0 entailment, 1 neutral, 2 contradiction'''
+    sampler = StratifiedKShotSampler(examples.labels, [0, 1, 2])
+    print('loaded  MNLI size:', sum(sampler.sizes()))
+
+    kshot_entail, kshot_neural, kshot_contra = [examples.take(rows) for rows in sampler.sample(k_shot, sampling_seed)]
+    remaining_examples = examples.take(sampler.complement([kshot_entail.rows, kshot_neural.rows, kshot_contra.rows]))
+
+    assert len(kshot_entail)+len(kshot_neural)+len(kshot_contra)+len(remaining_examples)==sum(sampler.sizes())
     return kshot_entail, kshot_neural, kshot_contra, remaining_examples
 
 
-def examples_to_features(source_examples, label_list, args, tokenizer, batch_size, output_mode, dataloader_mode='sequential'):
-    source_features = convert_examples_to_features(
-        source_examples, label_list, args.max_seq_length, tokenizer, output_mode,
+def examples_to_features(source_examples, label_list, args, tokenizer, batch_size, output_mode, dataloader_mode='sequential', cache_name='examples'):
+    '''the token ids come from args.feature_cache_dir, only the first run on a dataset tokenizes it'''
+    pad_token = tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0]
+    feature_cache = FeatureCache(args.feature_cache_dir, pretrain_model_dir, args.do_lower_case, args.max_seq_length,
+                                 sep_token_extra=True, pad_token=pad_token)
+    convert = lambda examples: parallel_convert_examples_to_features(
+        examples, label_list, args.max_seq_length, tokenizer, output_mode,
+        num_workers=args.preprocessing_num_workers, chunk_size=args.preprocessing_chunk_size,
         cls_token_at_end=False,#bool(args.model_type in ['xlnet']),            # xlnet has a cls token at the end
         cls_token=tokenizer.cls_token,
         cls_token_segment_id=0,#2 if args.model_type in ['xlnet'] else 0,
         sep_token=tokenizer.sep_token,
         sep_token_extra=True,#bool(args.model_type in ['roberta']),           # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
         pad_on_left=False,#bool(args.model_type in ['xlnet']),                 # pad on the left for xlnet
-        pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+        pad_token=pad_token,
         pad_token_segment_id=0)#4 if args.model_type in ['xlnet'] else 0,)
 
-    dev_all_input_ids = torch.tensor([f.input_ids for f in source_features], dtype=torch.long)
-    dev_all_input_mask = torch.tensor([f.input_mask for f in source_features], dtype=torch.long)
-    dev_all_segment_ids = torch.tensor([f.segment_ids for f in source_features], dtype=torch.long)
-    dev_all_label_ids = torch.tensor([f.label_id for f in source_features], dtype=torch.long)
-
-    dev_data = TensorDataset(dev_all_input_ids, dev_all_input_mask, dev_all_segment_ids, dev_all_label_ids)
-    if dataloader_mode=='sequential':
-        dev_sampler = SequentialSampler(dev_data)
-    else:
-        dev_sampler = RandomSampler(dev_data)
-    dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=batch_size)
+    features = feature_cache.load_or_build(cache_name, source_examples, label_list, convert)
+    dev_dataloader = features_dataloader(features, batch_size, dataloader_mode=dataloader_mode, bucket_by_length=args.bucket_by_length)
 
 
     return dev_dataloader
@@ -440,6 +230,25 @@ def main():
                         default="",
                         type=str,
                         help="Where do you want to store the pre-trained models downloaded from s3")
+    parser.add_argument("--embedding_cache_dir",
+                        default="/export/home/Dataset/BERT_pretrained_mine/embedding_cache",
+                        type=str,
+                        help="Where the frozen roberta vectors of MNLI and the target datasets are cached")
+    parser.add_argument("--feature_cache_dir",
+                        default="/export/home/Dataset/BERT_pretrained_mine/feature_cache",
+                        type=str,
+                        help="Where the tokenized datasets are cached")
+    parser.add_argument("--preprocessing_num_workers",
+                        default=None,
+                        type=int,
+                        help="Processes that tokenize a dataset on a feature cache miss, default all cores")
+    parser.add_argument("--preprocessing_chunk_size",
+                        default=2000,
+                        type=int,
+                        help="Examples per task sent to a tokenization process")
+    parser.add_argument("--bucket_by_length",
+                        action='store_true',
+                        help="Draw training batches of similar length (batches are always trimmed to their longest pair)")
     parser.add_argument("--max_seq_length",
                         default=128,
                         type=int,
@@ -447,6 +256,10 @@ def main():
                              "Sequences longer than this will be truncated, and sequences shorter \n"
                              "than this will be padded.")
 
+    parser.add_argument("--sampling_seed",
+                        default=None,
+                        type=int,
+                        help="Seed of the k-shot sampling only; by default the k-shot examples follow --seed")
     parser.add_argument('--kshot',
                         type=int,
                         default=5,
@@ -526,6 +339,8 @@ def main():
                             args.gradient_accumulation_steps))
 
     args.train_batch_size = args.train_batch_size // args.gradient_accumulation_steps
+    logger.info("effective batch size: {} ({} accumulated batches of {})".format(
+        args.train_batch_size * args.gradient_accumulation_steps, args.gradient_accumulation_steps, args.train_batch_size))
 
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -535,10 +350,12 @@ def main():
 
 
 
-    target_kshot_entail_examples, target_kshot_nonentail_examples = get_RTE_as_train_k_shot('/export/home/Dataset/glue_data/RTE/train.tsv', args.kshot) #train_pu_half_v1.txt
+    target_kshot_entail_examples, target_kshot_nonentail_examples = get_RTE_as_train_k_shot('/export/home/Dataset/glue_data/RTE/train.tsv', args.kshot, sampling_seed=args.sampling_seed) #train_pu_half_v1.txt
     target_dev_examples = get_RTE_as_dev('/export/home/Dataset/glue_data/RTE/dev.tsv')
     target_test_examples = get_RTE_as_test('/export/home/Dataset/RTE/test_RTE_1235.txt')
-    source_kshot_entail, source_kshot_neural, source_kshot_contra, source_remaining_examples = get_MNLI_train('/export/home/Dataset/glue_data/MNLI/train.tsv', args.kshot)
+    '''a seed of its own, so the MNLI draw does not mirror the target k-shot draw'''
+    source_sampling_seed = None if args.sampling_seed is None else '{}-MNLI'.format(args.sampling_seed)
+    source_kshot_entail, source_kshot_neural, source_kshot_contra, source_remaining_examples = get_MNLI_train('/export/home/Dataset/glue_data/MNLI/train.tsv', args.kshot, sampling_seed=source_sampling_seed)
     source_examples = source_kshot_entail+ source_kshot_neural+ source_kshot_contra+ source_remaining_examples
     target_label_list = ["entailment", "not_entailment"]
     source_label_list = ["entailment", "neutral", "contradiction"]
@@ -547,17 +364,29 @@ def main():
     print('training size:', len(source_examples), 'dev size:', len(target_dev_examples), 'test size:', len(target_test_examples))
 
     num_train_optimization_steps = None
-    num_train_optimization_steps = int(
-        len(source_remaining_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
+    num_train_optimization_steps = int(math.ceil(
+        math.ceil(len(source_remaining_examples) / args.train_batch_size) / args.gradient_accumulation_steps)) * args.num_train_epochs
     if args.local_rank != -1:
         num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
 
     roberta_model = RobertaForSequenceClassification(3)
     tokenizer = RobertaTokenizer.from_pretrained(pretrain_model_dir, do_lower_case=args.do_lower_case)
-    roberta_model.load_state_dict(torch.load('/export/home/Dataset/BERT_pretrained_mine/MNLI_pretrained/_acc_0.9040886899918633.pt'))
+    checkpoint_path = '/export/home/Dataset/BERT_pretrained_mine/MNLI_pretrained/_acc_0.9040886899918633.pt'
+    roberta_model.load_state_dict(torch.load(checkpoint_path))
     roberta_model.to(device)
     roberta_model.eval()
 
+    '''roberta_model is frozen, so each dataset is encoded once and protonet only sees the cached vectors'''
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir, checkpoint_fingerprint(checkpoint_path), args.max_seq_length)
+    def encode(name, examples, label_list):
+        to_dataloader = lambda exs: examples_to_features(exs, label_list, args, tokenizer, args.eval_batch_size, "classification", dataloader_mode='sequential', cache_name=name)
+        return embedding_cache.encode(name, examples, to_dataloader, roberta_model, device)
+
+    source_embeddings = encode('MNLI.train', source_examples, source_label_list)
+    target_kshot_embeddings = encode('RTE.train', target_kshot_entail_examples+target_kshot_nonentail_examples, target_label_list)
+    target_dev_embeddings = encode('RTE.dev', target_dev_examples, target_label_list)
+    target_test_embeddings = encode('RTE.test', target_test_examples, target_label_list)
+
     protonet = PrototypeNet(bert_hidden_dim)
     protonet.to(device)
 
@@ -576,17 +405,31 @@ def main():
     max_test_acc = 0.0
     max_dev_acc = 0.0
 
-    retrieve_batch_size = 5
-
-    source_kshot_entail_dataloader = examples_to_features(source_kshot_entail, source_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    source_kshot_neural_dataloader = examples_to_features(source_kshot_neural, source_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    source_kshot_contra_dataloader = examples_to_features(source_kshot_contra, source_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    source_remain_ex_dataloader = examples_to_features(source_remaining_examples, source_label_list, args, tokenizer, args.train_batch_size, "classification", dataloader_mode='random')
-
-    target_kshot_entail_dataloader = examples_to_features(target_kshot_entail_examples, target_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    target_kshot_nonentail_dataloader = examples_to_features(target_kshot_nonentail_examples, target_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    target_dev_dataloader = examples_to_features(target_dev_examples, target_label_list, args, tokenizer, args.eval_batch_size, "classification", dataloader_mode='random')
-    target_test_dataloader = examples_to_features(target_test_examples, target_label_list, args, tokenizer, args.eval_batch_size, "classification", dataloader_mode='random')
+    '''
+    class prototypes do not change during training, since the encoder is frozen
+    '''
+    source_entail_end = len(source_kshot_entail)
+    source_neural_end = source_entail_end+len(source_kshot_neural)
+    source_contra_end = source_neural_end+len(source_kshot_contra)
+    kshot_entail_rep = torch.mean(source_embeddings.take(np.arange(0, source_entail_end), device), dim=0, keepdim=True)
+    kshot_neural_rep = torch.mean(source_embeddings.take(np.arange(source_entail_end, source_neural_end), device), dim=0, keepdim=True)
+    kshot_contra_rep = torch.mean(source_embeddings.take(np.arange(source_neural_end, source_contra_end), device), dim=0, keepdim=True)
+    class_prototype_reps = torch.cat([kshot_entail_rep, kshot_neural_rep, kshot_contra_rep], dim=0) #(3, hidden)
+
+    target_entail_end = len(target_kshot_entail_examples)
+    kshot_entail_rep = torch.mean(target_kshot_embeddings.take(np.arange(0, target_entail_end), device), dim=0, keepdim=True)
+    kshot_nonentail_rep = torch.mean(target_kshot_embeddings.take(np.arange(target_entail_end, len(target_kshot_embeddings)), device), dim=0, keepdim=True)
+    target_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_nonentail_rep], dim=0) #(2, hidden)
+
+    '''source batches are positions into source_examples, their vectors come from the cache'''
+    source_remain_positions = torch.arange(source_contra_end, len(source_examples), dtype=torch.long)
+    source_remain_label_ids = torch.from_numpy(source_remaining_examples.label_ids(source_label_list))
+    source_remain_data = TensorDataset(source_remain_positions, source_remain_label_ids)
+    source_remain_ex_dataloader = DataLoader(source_remain_data, sampler=RandomSampler(source_remain_data), batch_size=args.train_batch_size)
+
+    target_label_map = {label : i for i, label in enumerate(target_label_list)}
+    target_dev_label_ids = [target_label_map[ex.label] for ex in target_dev_examples]
+    target_test_label_ids = [target_label_map[ex.label] for ex in target_test_examples]
 
     '''starting to train'''
     iter_co = 0
@@ -596,44 +439,9 @@ def main():
         nb_tr_examples, nb_tr_steps = 0, 0
         for step, batch in enumerate(tqdm(source_remain_ex_dataloader, desc="Iteration")):
             protonet.train()
-            batch = tuple(t.to(device) for t in batch)
-            input_ids, input_mask, segment_ids, label_ids_batch = batch
-
-            roberta_model.eval()
-            with torch.no_grad():
-                last_hidden_batch, _ = roberta_model(input_ids, input_mask)
-            '''
-            retrieve rep for support examples
-            '''
-            kshot_entail_reps = []
-            for entail_batch in source_kshot_entail_dataloader:
-                entail_batch = tuple(t.to(device) for t in entail_batch)
-                input_ids, input_mask, segment_ids, label_ids = entail_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_entail, _ = roberta_model(input_ids, input_mask)
-                kshot_entail_reps.append(last_hidden_entail)
-            kshot_entail_rep = torch.mean(torch.cat(kshot_entail_reps, dim=0), dim=0, keepdim=True)
-            kshot_neural_reps = []
-            for neural_batch in source_kshot_neural_dataloader:
-                neural_batch = tuple(t.to(device) for t in neural_batch)
-                input_ids, input_mask, segment_ids, label_ids = neural_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_neural, _ = roberta_model(input_ids, input_mask)
-                kshot_neural_reps.append(last_hidden_neural)
-            kshot_neural_rep = torch.mean(torch.cat(kshot_neural_reps, dim=0), dim=0, keepdim=True)
-            kshot_contra_reps = []
-            for contra_batch in source_kshot_contra_dataloader:
-                contra_batch = tuple(t.to(device) for t in contra_batch)
-                input_ids, input_mask, segment_ids, label_ids = contra_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_contra, _ = roberta_model(input_ids, input_mask)
-                kshot_contra_reps.append(last_hidden_contra)
-            kshot_contra_rep = torch.mean(torch.cat(kshot_contra_reps, dim=0), dim=0, keepdim=True)
-
-            class_prototype_reps = torch.cat([kshot_entail_rep, kshot_neural_rep, kshot_contra_rep], dim=0) #(3, hidden)
+            positions_batch, label_ids_batch = batch
+            label_ids_batch = label_ids_batch.to(device)
+            last_hidden_batch = source_embeddings.take(positions_batch, device)
 
             '''forward to model'''
             batch_logits = protonet(class_prototype_reps, last_hidden_batch)
@@ -650,12 +458,13 @@ def main():
             loss.backward()
 
             tr_loss += loss.item()
-            nb_tr_examples += input_ids.size(0)
+            nb_tr_examples += positions_batch.size(0)
             nb_tr_steps += 1
 
-            optimizer.step()
-            optimizer.zero_grad()
-            global_step += 1
+            if (step + 1) % args.gradient_accumulation_steps == 0 or step + 1 == len(source_remain_ex_dataloader):
+                optimizer.step()
+                optimizer.zero_grad()
+                global_step += 1
             iter_co+=1
             # if iter_co %20==0:
             if iter_co % len(source_remain_ex_dataloader)==0:
@@ -663,44 +472,17 @@ def main():
                 start evaluate on dev set after this epoch
                 '''
                 protonet.eval()
-                '''first get representations for support examples'''
-                kshot_entail_reps = []
-                for entail_batch in target_kshot_entail_dataloader:
-                    entail_batch = tuple(t.to(device) for t in entail_batch)
-                    input_ids, input_mask, segment_ids, label_ids = entail_batch
-                    roberta_model.eval()
-                    with torch.no_grad():
-                        last_hidden_entail, _ = roberta_model(input_ids, input_mask)
-                    kshot_entail_reps.append(last_hidden_entail)
-                kshot_entail_rep = torch.mean(torch.cat(kshot_entail_reps, dim=0), dim=0, keepdim=True)
-                kshot_nonentail_reps = []
-                for nonentail_batch in target_kshot_nonentail_dataloader:
-                    nonentail_batch = tuple(t.to(device) for t in nonentail_batch)
-                    input_ids, input_mask, segment_ids, label_ids = nonentail_batch
-                    roberta_model.eval()
-                    with torch.no_grad():
-                        last_hidden_nonentail, _ = roberta_model(input_ids, input_mask)
-                    kshot_nonentail_reps.append(last_hidden_nonentail)
-                kshot_nonentail_rep = torch.mean(torch.cat(kshot_nonentail_reps, dim=0), dim=0, keepdim=True)
-                target_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_nonentail_rep], dim=0) #(2, hidden)
-
-                for idd, dev_or_test_dataloader in enumerate([target_dev_dataloader, target_test_dataloader]):
+
+                for idd, (dev_or_test_embeddings, gold_label_ids) in enumerate([(target_dev_embeddings, target_dev_label_ids), (target_test_embeddings, target_test_label_ids)]):
 
 
                     eval_loss = 0
                     nb_eval_steps = 0
                     preds = []
-                    gold_label_ids = []
                     # print('Evaluating...')
-                    for input_ids, input_mask, segment_ids, label_ids in dev_or_test_dataloader:
-                        input_ids = input_ids.to(device)
-                        input_mask = input_mask.to(device)
-                        segment_ids = segment_ids.to(device)
-                        label_ids = label_ids.to(device)
-                        gold_label_ids+=list(label_ids.detach().cpu().numpy())
-                        roberta_model.eval()
-                        with torch.no_grad():
-                            last_hidden_target_batch, _ = roberta_model(input_ids, input_mask)
+                    for start in range(0, len(dev_or_test_embeddings), args.eval_batch_size):
+                        positions = np.arange(start, min(start+args.eval_batch_size, len(dev_or_test_embeddings)))
+                        last_hidden_target_batch = dev_or_test_embeddings.take(positions, device)
 
                         with torch.no_grad():
                             logits = protonet(target_class_prototype_reps, last_hidden_target_batch)
@@ -716,7 +498,6 @@ def main():
                     pred_probs = softmax(preds,axis=1)
                     pred_label_ids = list(np.argmax(pred_probs, axis=1))
 
-                    gold_label_ids = gold_label_ids
                     assert len(pred_label_ids) == len(gold_label_ids)
                     hit_co = 0
                     for k in range(len(pred_label_ids)):
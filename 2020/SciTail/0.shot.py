@@ -18,18 +18,15 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import csv
 import logging
 import os
 import random
 import sys
-import codecs
 import numpy as np
 import torch
 import torch.nn as nn
 from collections import defaultdict
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 from scipy.stats import beta
@@ -42,6 +39,14 @@ from transformers.tokenization_roberta import RobertaTokenizer
 from transformers.optimization import AdamW
 from transformers.modeling_roberta import RobertaModel#RobertaForSequenceClassification
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from tsv_reader import read_tsv
+from feature_conversion import convert_examples_to_features
+from quantization import quantize_model
+from export_model import load_exported
+from feature_cache import TokenizedFeatures
+from batching import features_dataloader, restore_order
+
 # from transformers.modeling_bert import BertModel
 # from transformers.tokenization_bert import BertTokenizer
 # from bert_common_functions import store_transformers_models
@@ -116,16 +121,6 @@ class InputExample(object):
         self.label = label
 
 
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids, input_mask, segment_ids, label_id):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-
-
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
@@ -136,14 +131,7 @@ class DataProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """Reads a tab separated value file."""
-        with open(input_file, "r") as f:
-            reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-            lines = []
-            for line in reader:
-                if sys.version_info[0] == 2:
-                    line = list(unicode(cell, 'utf-8') for cell in line)
-                lines.append(line)
-            return lines
+        return [list(line) for line in read_tsv(input_file, strip_fields=False)]
 
 class RteProcessor(DataProcessor):
     """Processor for the RTE data set (GLUE version)."""
@@ -155,21 +143,10 @@ class RteProcessor(DataProcessor):
         examples_per_file = []
         for filename in [train_filename, dev_filename]:
             examples=[]
-            readfile = codecs.open(filename, 'r', 'utf-8')
-            line_co=0
-            for row in readfile:
-
-                line=row.strip().split('\t')
-                if len(line) == 3:
-                    guid = "train-"+str(line_co-1)
-                    # text_a = 'SciTail. '+line[0].strip()
-                    text_a = line[0].strip()
-                    text_b = line[1].strip()
-                    label = line[2].strip()
-                    examples.append(
-                        InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-
-            readfile.close()
+            for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, num_columns=3)):
+                guid = "train-"+str(line_co)
+                examples.append(
+                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
             print('loaded  SciTail size:', len(examples))
             examples_per_file.append(examples)
         return examples_per_file[0], examples_per_file[1] #train, dev
@@ -195,154 +172,6 @@ class RteProcessor(DataProcessor):
 
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, output_mode,
-                                 cls_token_at_end=False,
-                                 cls_token='[CLS]',
-                                 cls_token_segment_id=1,
-                                 sep_token='[SEP]',
-                                 sep_token_extra=False,
-                                 pad_on_left=False,
-                                 pad_token=0,
-                                 pad_token_segment_id=0,
-                                 sequence_a_segment_id=0,
-                                 sequence_b_segment_id=1,
-                                 mask_padding_with_zero=True):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
-    """
-
-    label_map = {label : i for i, label in enumerate(label_list)}
-
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
-            special_tokens_count = 4 if sep_token_extra else 3
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - special_tokens_count)
-        else:
-            # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-            special_tokens_count = 3 if sep_token_extra else 2
-            if len(tokens_a) > max_seq_length - special_tokens_count:
-                tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids:   0   0   0   0  0     0   0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = tokens_a + [sep_token]
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + [sep_token]
-            segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
-
-        if cls_token_at_end:
-            tokens = tokens + [cls_token]
-            segment_ids = segment_ids + [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            segment_ids = [cls_token_segment_id] + segment_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-        else:
-            input_ids = input_ids + ([pad_token] * padding_length)
-            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        if output_mode == "classification":
-            label_id = label_map[example.label]
-        elif output_mode == "regression":
-            label_id = float(example.label)
-        else:
-            raise KeyError(output_mode)
-
-        # if ex_index < 5:
-        #     logger.info("*** Example ***")
-        #     logger.info("guid: %s" % (example.guid))
-        #     logger.info("tokens: %s" % " ".join(
-        #             [str(x) for x in tokens]))
-        #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-        #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-        #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-        #     logger.info("label: %s (id = %d)" % (example.label, label_id))
-
-        features.append(
-                InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
-                              label_id=label_id))
-    return features
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
-
-
-
-
-
-
-
-
 def main():
     parser = argparse.ArgumentParser()
 
@@ -357,6 +186,13 @@ def main():
                         default="",
                         type=str,
                         help="Where do you want to store the pre-trained models downloaded from s3")
+    parser.add_argument("--quantize",
+                        action='store_true',
+                        help="Evaluate on CPU with int8 dynamically quantized Linear layers (see quantization.py)")
+    parser.add_argument("--exported_model",
+                        default="",
+                        type=str,
+                        help="Evaluate a model written by export_model.py (on CPU) instead of the MNLI checkpoint")
     parser.add_argument("--max_seq_length",
                         default=128,
                         type=int,
@@ -378,6 +214,10 @@ def main():
                         default=64,
                         type=int,
                         help="Total batch size for eval.")
+    parser.add_argument("--eval_max_tokens",
+                        default=0,
+                        type=int,
+                        help="If set, evaluate in length-sorted batches of at most this many padded tokens instead of eval_batch_size rows, e.g. 8192")
     parser.add_argument("--learning_rate",
                         default=1e-5,
                         type=float,
@@ -476,9 +316,16 @@ def main():
     num_labels = len(label_list)
     print('num_labels:', num_labels,'test size:', len(test_examples))
 
-    model = RobertaForSequenceClassification(3)
     tokenizer = RobertaTokenizer.from_pretrained(pretrain_model_dir, do_lower_case=args.do_lower_case)
-    model.load_state_dict(torch.load('/export/home/Dataset/BERT_pretrained_mine/MNLI_pretrained/_acc_0.9040886899918633.pt'))
+    if args.exported_model:
+        device = torch.device('cpu')
+        model = load_exported(args.exported_model)
+    else:
+        model = RobertaForSequenceClassification(3)
+        model.load_state_dict(torch.load('/export/home/Dataset/BERT_pretrained_mine/MNLI_pretrained/_acc_0.9040886899918633.pt', map_location='cpu'))
+        if args.quantize:
+            device = torch.device('cpu')
+            model = quantize_model(model)
     model.to(device)
 
     '''load test set'''
@@ -493,14 +340,8 @@ def main():
         pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
         pad_token_segment_id=0)#4 if args.model_type in ['xlnet'] else 0,)
 
-    eval_all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-    eval_all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-    eval_all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-    eval_all_label_ids = torch.tensor([f.label_id for f in test_features], dtype=torch.long)
-
-    eval_data = TensorDataset(eval_all_input_ids, eval_all_input_mask, eval_all_segment_ids, eval_all_label_ids)
-    eval_sampler = SequentialSampler(eval_data)
-    test_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    test_features = TokenizedFeatures.from_features(test_features, args.max_seq_length, tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0])
+    test_dataloader = features_dataloader(test_features, args.eval_batch_size, dataloader_mode='sequential', max_tokens=args.eval_max_tokens)
 
 
 
@@ -531,6 +372,9 @@ def main():
             preds[0] = np.append(preds[0], logits.detach().cpu().numpy(), axis=0)
 
     preds = preds[0]
+    '''token-budget batches are sorted by length, put the rows back in example order'''
+    preds = restore_order(test_dataloader, preds)
+    gold_label_ids = restore_order(test_dataloader, gold_label_ids)
 
     pred_probs = softmax(preds,axis=1)
     pred_label_ids_3way = list(np.argmax(pred_probs, axis=1))
@@ -4,18 +4,15 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import csv
 import logging
 import os
 import random
 import sys
-import codecs
 import numpy as np
 import torch
 import torch.nn as nn
 from collections import defaultdict
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import DataLoader, RandomSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 from scipy.stats import beta
@@ -29,6 +26,17 @@ from transformers.tokenization_roberta import RobertaTokenizer
 from transformers.optimization import AdamW
 from transformers.modeling_roberta import RobertaModel#RobertaForSequenceClassification
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from embedding_cache import EmbeddingCache, checkpoint_fingerprint
+from tsv_reader import read_tsv
+from example_table import ExampleTable
+from feature_cache import FeatureCache
+from batching import features_dataloader
+from feature_conversion import parallel_convert_examples_to_features
+from kshot_sampler import StratifiedKShotSampler
+from mixed_precision import MixedPrecision
+from prototype_scoring import PrototypeNet
+
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -67,162 +75,6 @@ class InputExample(object):
         self.label = label
 
 
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids, input_mask, segment_ids, label_id):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-
-
-
-
-
-
-
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, output_mode,
-                                 cls_token_at_end=False,
-                                 cls_token='[CLS]',
-                                 cls_token_segment_id=1,
-                                 sep_token='[SEP]',
-                                 sep_token_extra=False,
-                                 pad_on_left=False,
-                                 pad_token=0,
-                                 pad_token_segment_id=0,
-                                 sequence_a_segment_id=0,
-                                 sequence_b_segment_id=1,
-                                 mask_padding_with_zero=True):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
-    """
-
-    label_map = {label : i for i, label in enumerate(label_list)}
-
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
-            special_tokens_count = 4 if sep_token_extra else 3
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - special_tokens_count)
-        else:
-            # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-            special_tokens_count = 3 if sep_token_extra else 2
-            if len(tokens_a) > max_seq_length - special_tokens_count:
-                tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids:   0   0   0   0  0     0   0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = tokens_a + [sep_token]
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + [sep_token]
-            segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
-
-        if cls_token_at_end:
-            tokens = tokens + [cls_token]
-            segment_ids = segment_ids + [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            segment_ids = [cls_token_segment_id] + segment_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-        else:
-            input_ids = input_ids + ([pad_token] * padding_length)
-            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        if output_mode == "classification":
-            label_id = label_map[example.label]
-        elif output_mode == "regression":
-            label_id = float(example.label)
-        else:
-            raise KeyError(output_mode)
-
-        # if ex_index < 5:
-        #     logger.info("*** Example ***")
-        #     logger.info("guid: %s" % (example.guid))
-        #     logger.info("tokens: %s" % " ".join(
-        #             [str(x) for x in tokens]))
-        #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-        #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-        #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-        #     logger.info("label: %s (id = %d)" % (example.label, label_id))
-
-        features.append(
-                InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
-                              label_id=label_id))
-    return features
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
-
 class RobertaForSequenceClassification(nn.Module):
     def __init__(self, tagset_size):
         super(RobertaForSequenceClassification, self).__init__()
@@ -259,83 +111,24 @@ class RobertaClassificationHead(nn.Module):
         return last_hidden, x
 
 
-class PrototypeNet(nn.Module):
-    def __init__(self, hidden_size):
-        super(PrototypeNet, self).__init__()
-        self.HiddenLayer_1 = nn.Linear(4*hidden_size, 4*hidden_size)
-        self.HiddenLayer_2 = nn.Linear(4*hidden_size, 4*hidden_size)
-        self.HiddenLayer_3 = nn.Linear(4*hidden_size, 2*hidden_size)
-        self.HiddenLayer_4 = nn.Linear(2*hidden_size, hidden_size)
-        self.HiddenLayer_5 = nn.Linear(hidden_size, 1)
-        self.dropout = nn.Dropout(0.1)
-
-    def forward(self, rep_classes,rep_query_batch):
-        '''
-        rep_classes: (#class*2, hidden_size), 3 comes from MNLI, 3 comes from target
-        rep_query_batch: (batch_size, hidden_size)
-        '''
-        class_size = rep_classes.shape[0]
-        batch_size = rep_query_batch.shape[0]
-        repeat_rep_classes = rep_classes.repeat(batch_size, 1)
-        repeat_rep_query = torch.repeat_interleave(rep_query_batch, repeats=class_size, dim=0)
-        combined_rep = torch.cat([repeat_rep_classes, repeat_rep_query, repeat_rep_classes*repeat_rep_query, repeat_rep_classes-repeat_rep_query], dim=1) #(#class*batch, 3*hidden)
-
-        output_1 = self.dropout(torch.tanh(self.HiddenLayer_1(combined_rep))) +combined_rep
-        output_2 = self.dropout(torch.tanh(self.HiddenLayer_2(output_1))) +output_1
-        output_3 = self.dropout(torch.tanh(self.HiddenLayer_3(output_2)))
-        output_4 = self.dropout(torch.tanh(self.HiddenLayer_4(output_3)))
-        all_scores = torch.sigmoid(self.HiddenLayer_5(output_4))
-
-
-
-
-
-        # all_scores = torch.sigmoid(self.HiddenLayer_3(self.dropout(torch.tanh(self.HiddenLayer_2(self.dropout(torch.tanh(self.HiddenLayer_1(combined_rep)))))))) #(#class*batch, 1)
-
-        score_matrix_to_fold = all_scores.view(-1, class_size) #(batch_size, class_size*2)
-        score_matrix = score_matrix_to_fold[:,:3]+score_matrix_to_fold[:, -3:]#(batch_size, class_size)
-        return score_matrix
-
-
-def get_SciTail_as_train_k_shot(filename, k_shot):
+def get_SciTail_as_train_k_shot(filename, k_shot, sampling_seed=None):
     '''
     classes: entails, neutral
+    sampling_seed: draw the k-shot examples with their own random.Random instead of the global state
     '''
-    examples_entail=[]
-    examples_non_entail=[]
-    readfile = codecs.open(filename, 'r', 'utf-8')
-    line_co=0
-    for row in readfile:
-
-        line=row.strip().split('\t')
-        if len(line)==3:
-            guid = "train-"+str(line_co-1)
-            # text_a = 'SciTail. '+line[0].strip()
-            text_a = line[0].strip()
-            text_b = line[1].strip()
-            label = line[2].strip()
-            if label == 'entails':
-                examples_entail.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            else:
-                examples_non_entail.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        line_co+=1
-    readfile.close()
-    print('loaded  entail size:', len(examples_entail), 'non-entail size:', len(examples_non_entail))
+    examples=[]
+    for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, num_columns=3)):
+        guid = "train-"+str(line_co)
+        examples.append(
+            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+    sampler = StratifiedKShotSampler([ex.label == 'entails' for ex in examples], [True, False])
+    print('loaded  entail size:', sampler.sizes()[0], 'non-entail size:', sampler.sizes()[1])
     '''sampling'''
     if k_shot > 99999:
-        return examples_entail+examples_non_entail
+        return [examples[i] for i in sampler.all_rows()]
     else:
-        k_shot_entail = k_shot
-        k_shot_non_entail = k_shot
-        if k_shot > len(examples_entail):
-            k_shot_entail = len(examples_entail)
-        if k_shot > len(examples_non_entail):
-            k_shot_non_entail = len(examples_non_entail)
-        return random.sample(examples_entail, k_shot_entail), random.sample(examples_non_entail, k_shot_non_entail)
-        # sampled_examples = random.sample(examples_entail, k_shot)+random.sample(examples_non_entail, k_shot)
-        # return sampled_examples
+        rows_entail, rows_non_entail = sampler.sample(k_shot, sampling_seed, clamp=True)
+        return [examples[i] for i in rows_entail], [examples[i] for i in rows_non_entail]
 
 
 def get_SciTail_dev_and_test(train_filename, dev_filename):
@@ -345,92 +138,51 @@ def get_SciTail_dev_and_test(train_filename, dev_filename):
     examples_per_file = []
     for filename in [train_filename, dev_filename]:
         examples=[]
-        readfile = codecs.open(filename, 'r', 'utf-8')
-        line_co=0
-        for row in readfile:
-
-            line=row.strip().split('\t')
-            if len(line) == 3:
-                guid = "train-"+str(line_co-1)
-                # text_a = 'SciTail. '+line[0].strip()
-                text_a = line[0].strip()
-                text_b = line[1].strip()
-                label = line[2].strip()
-                examples.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-
-        readfile.close()
+        for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, num_columns=3)):
+            guid = "train-"+str(line_co)
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
         print('loaded  SciTail size:', len(examples))
         examples_per_file.append(examples)
     return examples_per_file[0], examples_per_file[1] #train, dev
 
-def get_MNLI_train(filename, k_shot):
+def get_MNLI_train(filename, k_shot, sampling_seed=None):
     '''
     classes: ["entailment", "neutral", "contradiction"]
+    returns ExampleTable views, all sharing the text buffer of the whole file
     '''
-    examples_entail = []
-    examples_neural = []
-    examples_contra = []
-    readfile = codecs.open(filename, 'r', 'utf-8')
-    line_co=0
-    for row in readfile:
-        if line_co>0:
-            line=row.strip().split('\t')
-            guid = "train-"+str(line_co-1)
-            # text_a = 'MNLI. '+line[8].strip()
-            text_a = line[8].strip()
-            text_b = line[9].strip()
-            label = line[-1].strip() #["entailment", "neutral", "contradiction"]
-
-            if label == 'entailment':
-                examples_entail.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            elif label == 'neutral':
-                examples_neural.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            else:
-                examples_contra.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        line_co+=1
-    readfile.close()
-    print('loaded  MNLI size:', len(examples_entail)+len(examples_neural)+len(examples_contra))
-
-    kshot_entail = random.sample(examples_entail, k_shot)
-    kshot_neural = random.sample(examples_neural, k_shot)
-    kshot_contra = random.sample(examples_contra, k_shot)
-
-    remaining_examples = []
-    for ex in examples_entail+examples_neural+examples_contra:
-        if ex not in set(kshot_entail+kshot_neural+kshot_contra):
-            remaining_examples.append(ex)
-
-    assert len(kshot_entail)+len(kshot_neural)+len(kshot_contra)+len(remaining_examples)==len(examples_entail+examples_neural+examples_contra)
+    examples = ExampleTable.from_rows(read_tsv(filename, columns=(8, 9, -1), skip_header=True),
+                                      ["entailment", "neutral", "contradiction"], 'train')
+    '''rows by label code: 0 entailment, 1 neutral, 2 contradiction'''
+    sampler = StratifiedKShotSampler(examples.labels, [0, 1, 2])
+    print('loaded  MNLI size:', sum(sampler.sizes()))
+
+    kshot_entail, kshot_neural, kshot_contra = [examples.take(rows) for rows in sampler.sample(k_shot, sampling_seed)]
+    remaining_examples = examples.take(sampler.complement([kshot_entail.rows, kshot_neural.rows, kshot_contra.rows]))
+
+    assert len(kshot_entail)+len(kshot_neural)+len(kshot_contra)+len(remaining_examples)==sum(sampler.sizes())
     return kshot_entail, kshot_neural, kshot_contra, remaining_examples
 
 
-def examples_to_features(source_examples, label_list, args, tokenizer, batch_size, output_mode, dataloader_mode='sequential'):
-    source_features = convert_examples_to_features(
-        source_examples, label_list, args.max_seq_length, tokenizer, output_mode,
+def examples_to_features(source_examples, label_list, args, tokenizer, batch_size, output_mode, dataloader_mode='sequential', cache_name='examples'):
+    '''the token ids come from args.feature_cache_dir, only the first run on a dataset tokenizes it'''
+    pad_token = tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0]
+    feature_cache = FeatureCache(args.feature_cache_dir, pretrain_model_dir, args.do_lower_case, args.max_seq_length,
+                                 sep_token_extra=True, pad_token=pad_token)
+    convert = lambda examples: parallel_convert_examples_to_features(
+        examples, label_list, args.max_seq_length, tokenizer, output_mode,
+        num_workers=args.preprocessing_num_workers, chunk_size=args.preprocessing_chunk_size,
         cls_token_at_end=False,#bool(args.model_type in ['xlnet']),            # xlnet has a cls token at the end
         cls_token=tokenizer.cls_token,
         cls_token_segment_id=0,#2 if args.model_type in ['xlnet'] else 0,
         sep_token=tokenizer.sep_token,
         sep_token_extra=True,#bool(args.model_type in ['roberta']),           # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
         pad_on_left=False,#bool(args.model_type in ['xlnet']),                 # pad on the left for xlnet
-        pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+        pad_token=pad_token,
         pad_token_segment_id=0)#4 if args.model_type in ['xlnet'] else 0,)
 
-    dev_all_input_ids = torch.tensor([f.input_ids for f in source_features], dtype=torch.long)
-    dev_all_input_mask = torch.tensor([f.input_mask for f in source_features], dtype=torch.long)
-    dev_all_segment_ids = torch.tensor([f.segment_ids for f in source_features], dtype=torch.long)
-    dev_all_label_ids = torch.tensor([f.label_id for f in source_features], dtype=torch.long)
-
-    dev_data = TensorDataset(dev_all_input_ids, dev_all_input_mask, dev_all_segment_ids, dev_all_label_ids)
-    if dataloader_mode=='sequential':
-        dev_sampler = SequentialSampler(dev_data)
-    else:
-        dev_sampler = RandomSampler(dev_data)
-    dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=batch_size)
+    features = feature_cache.load_or_build(cache_name, source_examples, label_list, convert)
+    dev_dataloader = features_dataloader(features, batch_size, dataloader_mode=dataloader_mode, bucket_by_length=args.bucket_by_length)
 
 
     return dev_dataloader
@@ -460,6 +212,29 @@ def main():
                         default="",
                         type=str,
                         help="Where do you want to store the pre-trained models downloaded from s3")
+    parser.add_argument("--embedding_cache_dir",
+                        default="/export/home/Dataset/BERT_pretrained_mine/embedding_cache",
+                        type=str,
+                        help="Where the frozen roberta vectors of MNLI and the target datasets are cached")
+    parser.add_argument("--feature_cache_dir",
+                        default="/export/home/Dataset/BERT_pretrained_mine/feature_cache",
+                        type=str,
+                        help="Where the tokenized datasets are cached")
+    parser.add_argument("--preprocessing_num_workers",
+                        default=None,
+                        type=int,
+                        help="Processes that tokenize a dataset on a feature cache miss, default all cores")
+    parser.add_argument("--preprocessing_chunk_size",
+                        default=2000,
+                        type=int,
+                        help="Examples per task sent to a tokenization process")
+    parser.add_argument("--bucket_by_length",
+                        action='store_true',
+                        help="Draw training batches of similar length (batches are always trimmed to their longest pair)")
+    parser.add_argument("--scoring_chunk_size",
+                        default=0,
+                        type=int,
+                        help="Score this many queries at a time with the factorized PrototypeNet layer 1 (prototype_scoring.py); 0 keeps the pairwise forward")
     parser.add_argument("--max_seq_length",
                         default=128,
                         type=int,
@@ -467,6 +242,10 @@ def main():
                              "Sequences longer than this will be truncated, and sequences shorter \n"
                              "than this will be padded.")
 
+    parser.add_argument("--sampling_seed",
+                        default=None,
+                        type=int,
+                        help="Seed of the k-shot sampling only; by default the k-shot examples follow --seed")
     parser.add_argument('--kshot',
                         type=int,
                         default=5,
@@ -519,7 +298,10 @@ def main():
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument('--fp16',
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
+                        help="Whether to run forward passes in float16 autocast with loss scaling (GPU only)")
+    parser.add_argument('--bf16',
+                        action='store_true',
+                        help="Whether to run forward passes in bfloat16 autocast (also what --fp16 falls back to without a GPU)")
     parser.add_argument('--loss_scale',
                         type=float, default=0,
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
@@ -542,14 +324,17 @@ def main():
         n_gpu = 1
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
-    logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
-        device, n_gpu, bool(args.local_rank != -1), args.fp16))
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+    logger.info("device: {} n_gpu: {}, distributed training: {}, precision: {}".format(
+        device, n_gpu, bool(args.local_rank != -1), precision))
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
                             args.gradient_accumulation_steps))
 
     args.train_batch_size = args.train_batch_size // args.gradient_accumulation_steps
+    logger.info("effective batch size: {} ({} accumulated batches of {})".format(
+        args.train_batch_size * args.gradient_accumulation_steps, args.gradient_accumulation_steps, args.train_batch_size))
 
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -560,12 +345,14 @@ def main():
 
 
     scitail_path = '/export/home/Dataset/SciTailV1/tsv_format/'
-    target_kshot_entail_examples, target_kshot_nonentail_examples = get_SciTail_as_train_k_shot(scitail_path+'scitail_1.0_train.tsv', args.kshot) #train_pu_half_v1.txt
+    target_kshot_entail_examples, target_kshot_nonentail_examples = get_SciTail_as_train_k_shot(scitail_path+'scitail_1.0_train.tsv', args.kshot, sampling_seed=args.sampling_seed) #train_pu_half_v1.txt
     target_dev_examples, target_test_examples = get_SciTail_dev_and_test(scitail_path+'scitail_1.0_dev.tsv', scitail_path+'scitail_1.0_test.tsv')
 
 
     source_kshot_size = 10# if args.kshot>10 else 10 if max(10, args.kshot)
-    source_kshot_entail, source_kshot_neural, source_kshot_contra, source_remaining_examples = get_MNLI_train('/export/home/Dataset/glue_data/MNLI/train.tsv', source_kshot_size)
+    '''a seed of its own, so the MNLI draw does not mirror the target k-shot draw'''
+    source_sampling_seed = None if args.sampling_seed is None else '{}-MNLI'.format(args.sampling_seed)
+    source_kshot_entail, source_kshot_neural, source_kshot_contra, source_remaining_examples = get_MNLI_train('/export/home/Dataset/glue_data/MNLI/train.tsv', source_kshot_size, sampling_seed=source_sampling_seed)
     source_examples = source_kshot_entail+ source_kshot_neural+ source_kshot_contra+ source_remaining_examples
     target_label_list = ["entails", "neutral"]
     source_label_list = ["entailment", "neutral", "contradiction"]
@@ -576,11 +363,23 @@ def main():
 
     roberta_model = RobertaForSequenceClassification(3)
     tokenizer = RobertaTokenizer.from_pretrained(pretrain_model_dir, do_lower_case=args.do_lower_case)
-    roberta_model.load_state_dict(torch.load('/export/home/Dataset/BERT_pretrained_mine/MNLI_pretrained/_acc_0.9040886899918633.pt'), strict=False)
+    checkpoint_path = '/export/home/Dataset/BERT_pretrained_mine/MNLI_pretrained/_acc_0.9040886899918633.pt'
+    roberta_model.load_state_dict(torch.load(checkpoint_path), strict=False)
     roberta_model.to(device)
     roberta_model.eval()
 
-    protonet = PrototypeNet(bert_hidden_dim)
+    '''roberta_model is frozen, so each dataset is encoded once and protonet only sees the cached vectors'''
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir, checkpoint_fingerprint(checkpoint_path), args.max_seq_length)
+    def encode(name, examples, label_list):
+        to_dataloader = lambda exs: examples_to_features(exs, label_list, args, tokenizer, args.eval_batch_size, "classification", dataloader_mode='sequential', cache_name=name)
+        return embedding_cache.encode(name, examples, to_dataloader, roberta_model, device)
+
+    source_embeddings = encode('MNLI.train', source_examples, source_label_list)
+    target_kshot_embeddings = encode('SciTail.train', target_kshot_entail_examples+target_kshot_nonentail_examples, target_label_list)
+    target_dev_embeddings = encode('SciTail.dev', target_dev_examples, target_label_list)
+    target_test_embeddings = encode('SciTail.test', target_test_examples, target_label_list)
+
+    protonet = PrototypeNet(bert_hidden_dim, scoring_chunk_size=args.scoring_chunk_size)
     protonet.to(device)
 
     param_optimizer = list(protonet.named_parameters())
@@ -598,17 +397,35 @@ def main():
     max_test_acc = 0.0
     max_dev_acc = 0.0
 
-    retrieve_batch_size = 5
-
-    source_kshot_entail_dataloader = examples_to_features(source_kshot_entail, source_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    source_kshot_neural_dataloader = examples_to_features(source_kshot_neural, source_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    source_kshot_contra_dataloader = examples_to_features(source_kshot_contra, source_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    source_remain_ex_dataloader = examples_to_features(source_remaining_examples, source_label_list, args, tokenizer, args.train_batch_size, "classification", dataloader_mode='random')
-
-    target_kshot_entail_dataloader = examples_to_features(target_kshot_entail_examples, target_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    target_kshot_nonentail_dataloader = examples_to_features(target_kshot_nonentail_examples, target_label_list, args, tokenizer, retrieve_batch_size, "classification", dataloader_mode='sequential')
-    target_dev_dataloader = examples_to_features(target_dev_examples, target_label_list, args, tokenizer, args.eval_batch_size, "classification", dataloader_mode='random')
-    target_test_dataloader = examples_to_features(target_test_examples, target_label_list, args, tokenizer, args.eval_batch_size, "classification", dataloader_mode='random')
+    '''
+    class prototypes do not change during training, since the encoder is frozen
+    '''
+    source_entail_end = len(source_kshot_entail)
+    source_neural_end = source_entail_end+len(source_kshot_neural)
+    source_contra_end = source_neural_end+len(source_kshot_contra)
+    kshot_entail_rep = torch.mean(source_embeddings.take(np.arange(0, source_entail_end), device), dim=0, keepdim=True)
+    kshot_neural_rep = torch.mean(source_embeddings.take(np.arange(source_entail_end, source_neural_end), device), dim=0, keepdim=True)
+    kshot_contra_rep = torch.mean(source_embeddings.take(np.arange(source_neural_end, source_contra_end), device), dim=0, keepdim=True)
+    source_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_neural_rep, kshot_contra_rep], dim=0) #(3, hidden)
+
+    target_entail_end = len(target_kshot_entail_examples)
+    all_kshot_entail_reps = target_kshot_embeddings.take(np.arange(0, target_entail_end), device)
+    all_kshot_neural_reps = target_kshot_embeddings.take(np.arange(target_entail_end, len(target_kshot_embeddings)), device)
+    kshot_entail_rep = torch.mean(all_kshot_entail_reps, dim=0, keepdim=True)
+    kshot_neural_rep = torch.mean(all_kshot_neural_reps, dim=0, keepdim=True)
+    target_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_neural_rep, kshot_neural_rep], dim=0) #(3, hidden)
+
+    class_prototype_reps = torch.cat([source_class_prototype_reps, target_class_prototype_reps], dim=0) #(6, hidden)
+
+    '''source batches are positions into source_examples, their vectors come from the cache'''
+    source_remain_positions = torch.arange(source_contra_end, len(source_examples), dtype=torch.long)
+    source_remain_label_ids = torch.from_numpy(source_remaining_examples.label_ids(source_label_list))
+    source_remain_data = TensorDataset(source_remain_positions, source_remain_label_ids)
+    source_remain_ex_dataloader = DataLoader(source_remain_data, sampler=RandomSampler(source_remain_data), batch_size=args.train_batch_size)
+
+    target_label_map = {label : i for i, label in enumerate(target_label_list)}
+    target_dev_label_ids = [target_label_map[ex.label] for ex in target_dev_examples]
+    target_test_label_ids = [target_label_map[ex.label] for ex in target_test_examples]
 
     '''starting to train'''
     iter_co = 0
@@ -618,73 +435,9 @@ def main():
         nb_tr_examples, nb_tr_steps = 0, 0
         for step, batch in enumerate(tqdm(source_remain_ex_dataloader, desc="Iteration")):
             protonet.train()
-            batch = tuple(t.to(device) for t in batch)
-            input_ids, input_mask, segment_ids, source_label_ids_batch = batch
-
-            roberta_model.eval()
-            with torch.no_grad():
-                source_last_hidden_batch, _ = roberta_model(input_ids, input_mask)
-            '''
-            retrieve rep for support examples in MNLI
-            '''
-            kshot_entail_reps = []
-            for entail_batch in source_kshot_entail_dataloader:
-                entail_batch = tuple(t.to(device) for t in entail_batch)
-                input_ids, input_mask, segment_ids, label_ids = entail_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_entail, _ = roberta_model(input_ids, input_mask)
-                kshot_entail_reps.append(last_hidden_entail)
-            kshot_entail_rep = torch.mean(torch.cat(kshot_entail_reps, dim=0), dim=0, keepdim=True)
-            kshot_neural_reps = []
-            for neural_batch in source_kshot_neural_dataloader:
-                neural_batch = tuple(t.to(device) for t in neural_batch)
-                input_ids, input_mask, segment_ids, label_ids = neural_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_neural, _ = roberta_model(input_ids, input_mask)
-                kshot_neural_reps.append(last_hidden_neural)
-            kshot_neural_rep = torch.mean(torch.cat(kshot_neural_reps, dim=0), dim=0, keepdim=True)
-            kshot_contra_reps = []
-            for contra_batch in source_kshot_contra_dataloader:
-                contra_batch = tuple(t.to(device) for t in contra_batch)
-                input_ids, input_mask, segment_ids, label_ids = contra_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_contra, _ = roberta_model(input_ids, input_mask)
-                kshot_contra_reps.append(last_hidden_contra)
-            kshot_contra_rep = torch.mean(torch.cat(kshot_contra_reps, dim=0), dim=0, keepdim=True)
-
-            source_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_neural_rep, kshot_contra_rep], dim=0) #(3, hidden)
-
-            '''
-            retrieve rep for support examples in target
-            '''
-            kshot_entail_reps = []
-            for entail_batch in target_kshot_entail_dataloader:
-                entail_batch = tuple(t.to(device) for t in entail_batch)
-                input_ids, input_mask, segment_ids, label_ids = entail_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_entail, _ = roberta_model(input_ids, input_mask)
-                kshot_entail_reps.append(last_hidden_entail)
-            all_kshot_entail_reps = torch.cat(kshot_entail_reps, dim=0)
-            kshot_entail_rep = torch.mean(all_kshot_entail_reps, dim=0, keepdim=True)
-            kshot_neural_reps = []
-            for neural_batch in target_kshot_nonentail_dataloader:
-                neural_batch = tuple(t.to(device) for t in neural_batch)
-                input_ids, input_mask, segment_ids, label_ids = neural_batch
-                roberta_model.eval()
-                with torch.no_grad():
-                    last_hidden_neural, _ = roberta_model(input_ids, input_mask)
-                kshot_neural_reps.append(last_hidden_neural)
-            all_kshot_neural_reps = torch.cat(kshot_neural_reps, dim=0)
-            kshot_neural_rep = torch.mean(all_kshot_neural_reps, dim=0, keepdim=True)
-            kshot_contra_rep = kshot_neural_rep#torch.mean(torch.cat(kshot_contra_reps, dim=0), dim=0, keepdim=True)
-
-            target_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_neural_rep, kshot_contra_rep], dim=0) #(3, hidden)
-
-            class_prototype_reps = torch.cat([source_class_prototype_reps, target_class_prototype_reps], dim=0) #(6, hidden)
+            source_positions_batch, source_label_ids_batch = batch
+            source_label_ids_batch = source_label_ids_batch.to(device)
+            source_last_hidden_batch = source_embeddings.take(source_positions_batch, device)
 
             '''forward to model'''
             target_batch_size = args.target_train_batch_size #10*3
@@ -697,7 +450,8 @@ def main():
             target_last_hidden_batch = torch.cat([selected_target_entail_rep, selected_target_neural_rep])
 
             last_hidden_batch = torch.cat([source_last_hidden_batch, target_last_hidden_batch], dim=0) #(train_batch_size+10*2)
-            batch_logits = protonet(class_prototype_reps, last_hidden_batch)
+            with precision.autocast():
+                batch_logits = protonet(class_prototype_reps, last_hidden_batch).float()
 
             '''source side loss'''
             # loss_fct = CrossEntropyLoss(reduction='none')
@@ -714,104 +468,40 @@ def main():
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            loss.backward()
+            precision.backward(loss)
 
             tr_loss += loss.item()
-            nb_tr_examples += input_ids.size(0)
+            nb_tr_examples += source_positions_batch.size(0)
             nb_tr_steps += 1
 
-            optimizer.step()
-            optimizer.zero_grad()
-            global_step += 1
-            iter_co+=1
+            if (step + 1) % args.gradient_accumulation_steps == 0 or step + 1 == len(source_remain_ex_dataloader):
+                precision.step(optimizer)
+                optimizer.zero_grad()
+                global_step += 1
+                iter_co+=1
+            else:
+                continue
             if iter_co %5==0:
                 # if iter_co % len(source_remain_ex_dataloader)==0:
                 '''
                 start evaluate on dev set after this epoch
                 '''
                 protonet.eval()
-                '''
-                retrieve rep for support examples in MNLI
-                '''
-                kshot_entail_reps = []
-                for entail_batch in source_kshot_entail_dataloader:
-                    entail_batch = tuple(t.to(device) for t in entail_batch)
-                    input_ids, input_mask, segment_ids, label_ids = entail_batch
-                    roberta_model.eval()
-                    with torch.no_grad():
-                        last_hidden_entail, _ = roberta_model(input_ids, input_mask)
-                    kshot_entail_reps.append(last_hidden_entail)
-                kshot_entail_rep = torch.mean(torch.cat(kshot_entail_reps, dim=0), dim=0, keepdim=True)
-                kshot_neural_reps = []
-                for neural_batch in source_kshot_neural_dataloader:
-                    neural_batch = tuple(t.to(device) for t in neural_batch)
-                    input_ids, input_mask, segment_ids, label_ids = neural_batch
-                    roberta_model.eval()
-                    with torch.no_grad():
-                        last_hidden_neural, _ = roberta_model(input_ids, input_mask)
-                    kshot_neural_reps.append(last_hidden_neural)
-                kshot_neural_rep = torch.mean(torch.cat(kshot_neural_reps, dim=0), dim=0, keepdim=True)
-                kshot_contra_reps = []
-                for contra_batch in source_kshot_contra_dataloader:
-                    contra_batch = tuple(t.to(device) for t in contra_batch)
-                    input_ids, input_mask, segment_ids, label_ids = contra_batch
-                    roberta_model.eval()
-                    with torch.no_grad():
-                        last_hidden_contra, _ = roberta_model(input_ids, input_mask)
-                    kshot_contra_reps.append(last_hidden_contra)
-                kshot_contra_rep = torch.mean(torch.cat(kshot_contra_reps, dim=0), dim=0, keepdim=True)
-
-                source_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_neural_rep, kshot_contra_rep], dim=0) #(3, hidden)
-
-                '''first get representations for support examples in target'''
-                kshot_entail_reps = []
-                for entail_batch in target_kshot_entail_dataloader:
-                    entail_batch = tuple(t.to(device) for t in entail_batch)
-                    input_ids, input_mask, segment_ids, label_ids = entail_batch
-                    roberta_model.eval()
-                    with torch.no_grad():
-                        last_hidden_entail, _ = roberta_model(input_ids, input_mask)
-                    kshot_entail_reps.append(last_hidden_entail)
-                kshot_entail_rep = torch.mean(torch.cat(kshot_entail_reps, dim=0), dim=0, keepdim=True)
-                kshot_nonentail_reps = []
-                for nonentail_batch in target_kshot_nonentail_dataloader:
-                    nonentail_batch = tuple(t.to(device) for t in nonentail_batch)
-                    input_ids, input_mask, segment_ids, label_ids = nonentail_batch
-                    roberta_model.eval()
-                    with torch.no_grad():
-                        last_hidden_nonentail, _ = roberta_model(input_ids, input_mask)
-                    kshot_nonentail_reps.append(last_hidden_nonentail)
-                kshot_nonentail_rep = torch.mean(torch.cat(kshot_nonentail_reps, dim=0), dim=0, keepdim=True)
-                target_class_prototype_reps = torch.cat([kshot_entail_rep, kshot_nonentail_rep, kshot_nonentail_rep], dim=0) #(3, hidden)
-
-                class_prototype_reps = torch.cat([source_class_prototype_reps, target_class_prototype_reps], dim=0) #(6, hidden)
-
-                for idd, dev_or_test_dataloader in enumerate([target_dev_dataloader, target_test_dataloader]):
+
+                for idd, (dev_or_test_embeddings, gold_label_ids) in enumerate([(target_dev_embeddings, target_dev_label_ids), (target_test_embeddings, target_test_label_ids)]):
 
 
                     eval_loss = 0
                     nb_eval_steps = 0
                     preds = []
-                    gold_label_ids = []
                     # print('Evaluating...')
-                    for input_ids, input_mask, segment_ids, label_ids in dev_or_test_dataloader:
-                        input_ids = input_ids.to(device)
-                        input_mask = input_mask.to(device)
-                        segment_ids = segment_ids.to(device)
-                        label_ids = label_ids.to(device)
-                        gold_label_ids+=list(label_ids.detach().cpu().numpy())
-                        roberta_model.eval()
-                        with torch.no_grad():
-                            last_hidden_target_batch, logits_from_source = roberta_model(input_ids, input_mask)
-
-                        with torch.no_grad():
-                            logits = protonet(class_prototype_reps, last_hidden_target_batch)
-
-                        '''combine with logits from source domain'''
-                        # print('logits:', logits)
-                        # print('logits_from_source:', logits_from_source)
-                        # weight = 0.9
-                        # logits = weight*logits+(1.0-weight)*torch.sigmoid(logits_from_source)
+                    for start in range(0, len(dev_or_test_embeddings), args.eval_batch_size):
+                        positions = np.arange(start, min(start+args.eval_batch_size, len(dev_or_test_embeddings)))
+                        last_hidden_target_batch = dev_or_test_embeddings.take(positions, device)
+
+                        with torch.no_grad(), precision.autocast():
+                            logits = protonet(class_prototype_reps, last_hidden_target_batch).float()
+
                         if len(preds) == 0:
                             preds.append(logits.detach().cpu().numpy())
                         else:
@@ -829,7 +519,6 @@ def main():
                         else:
                             pred_label_ids.append(0)
 
-                    gold_label_ids = gold_label_ids
                     assert len(pred_label_ids) == len(gold_label_ids)
                     hit_co = 0
                     for k in range(len(pred_label_ids)):
@@ -18,18 +18,16 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import csv
 import logging
+import math
 import os
 import random
 import sys
-import codecs
 import numpy as np
 import torch
 import torch.nn as nn
 from collections import defaultdict
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 from scipy.stats import beta
@@ -42,6 +40,17 @@ from transformers.tokenization_roberta import RobertaTokenizer
 from transformers.optimization import AdamW
 from transformers.modeling_roberta import RobertaModel#RobertaForSequenceClassification
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tsv_reader import read_tsv
+from example_table import ExampleTable
+from feature_cache import FeatureCache
+from batching import features_dataloader, restore_order, set_epoch
+from streaming_dataset import StreamingFeatureDataset
+from feature_conversion import parallel_convert_examples_to_features
+from mixed_precision import MixedPrecision
+from gradient_checkpointing import enable_gradient_checkpointing
+from distributed_training import get_world_size, init_distributed, is_main_process, wrap_model
+
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -125,16 +134,6 @@ class InputExample(object):
         self.label = label
 
 
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids, input_mask, segment_ids, label_id):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-
-
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
@@ -145,14 +144,7 @@ class DataProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """Reads a tab separated value file."""
-        with open(input_file, "r") as f:
-            reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-            lines = []
-            for line in reader:
-                if sys.version_info[0] == 2:
-                    line = list(unicode(cell, 'utf-8') for cell in line)
-                lines.append(line)
-            return lines
+        return [list(line) for line in read_tsv(input_file, strip_fields=False)]
 
 class RteProcessor(DataProcessor):
     """Processor for the RTE data set (GLUE version)."""
@@ -160,24 +152,12 @@ class RteProcessor(DataProcessor):
     def get_MNLI_train_and_dev(self, train_filename, dev_filename):
         '''
         classes: ["entailment", "neutral", "contradiction"]
+        returns one ExampleTable per file instead of lists of InputExample
         '''
         examples_per_file = []
         for filename in [train_filename, dev_filename]:
-            examples=[]
-            readfile = codecs.open(filename, 'r', 'utf-8')
-            line_co=0
-            for row in readfile:
-                if line_co>0:
-                    line=row.strip().split('\t')
-                    guid = "train-"+str(line_co-1)
-                    # text_a = 'MNLI. '+line[8].strip()
-                    text_a = line[8].strip()
-                    text_b = line[9].strip()
-                    label = line[-1].strip() #["entailment", "neutral", "contradiction"]
-                    examples.append(
-                        InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-                line_co+=1
-            readfile.close()
+            examples = ExampleTable.from_rows(read_tsv(filename, columns=(8, 9, -1), skip_header=True),
+                                              ["entailment", "neutral", "contradiction"], 'train')
             print('loaded  MNLI size:', len(examples))
             examples_per_file.append(examples)
         return examples_per_file[0], examples_per_file[1] #train, dev
@@ -203,154 +183,6 @@ class RteProcessor(DataProcessor):
 
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, output_mode,
-                                 cls_token_at_end=False,
-                                 cls_token='[CLS]',
-                                 cls_token_segment_id=1,
-                                 sep_token='[SEP]',
-                                 sep_token_extra=False,
-                                 pad_on_left=False,
-                                 pad_token=0,
-                                 pad_token_segment_id=0,
-                                 sequence_a_segment_id=0,
-                                 sequence_b_segment_id=1,
-                                 mask_padding_with_zero=True):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
-    """
-
-    label_map = {label : i for i, label in enumerate(label_list)}
-
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
-            special_tokens_count = 4 if sep_token_extra else 3
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - special_tokens_count)
-        else:
-            # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-            special_tokens_count = 3 if sep_token_extra else 2
-            if len(tokens_a) > max_seq_length - special_tokens_count:
-                tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids:   0   0   0   0  0     0   0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = tokens_a + [sep_token]
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + [sep_token]
-            segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
-
-        if cls_token_at_end:
-            tokens = tokens + [cls_token]
-            segment_ids = segment_ids + [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            segment_ids = [cls_token_segment_id] + segment_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-        else:
-            input_ids = input_ids + ([pad_token] * padding_length)
-            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        if output_mode == "classification":
-            label_id = label_map[example.label]
-        elif output_mode == "regression":
-            label_id = float(example.label)
-        else:
-            raise KeyError(output_mode)
-
-        # if ex_index < 5:
-        #     logger.info("*** Example ***")
-        #     logger.info("guid: %s" % (example.guid))
-        #     logger.info("tokens: %s" % " ".join(
-        #             [str(x) for x in tokens]))
-        #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-        #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-        #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-        #     logger.info("label: %s (id = %d)" % (example.label, label_id))
-
-        features.append(
-                InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
-                              label_id=label_id))
-    return features
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
-
-
-
-
-
-
-
-
 def main():
     parser = argparse.ArgumentParser()
 
@@ -365,6 +197,39 @@ def main():
                         default="",
                         type=str,
                         help="Where do you want to store the pre-trained models downloaded from s3")
+    parser.add_argument("--feature_cache_dir",
+                        default="/export/home/Dataset/BERT_pretrained_mine/feature_cache",
+                        type=str,
+                        help="Where the tokenized MNLI train/dev sets are cached")
+    parser.add_argument("--preprocessing_num_workers",
+                        default=None,
+                        type=int,
+                        help="Processes that tokenize a dataset on a feature cache miss, default all cores")
+    parser.add_argument("--preprocessing_chunk_size",
+                        default=2000,
+                        type=int,
+                        help="Examples per task sent to a tokenization process")
+    parser.add_argument("--bucket_by_length",
+                        action='store_true',
+                        help="Draw training batches of similar length (batches are always trimmed to their longest pair)")
+    parser.add_argument("--eval_max_tokens",
+                        default=0,
+                        type=int,
+                        help="If set, evaluate in length-sorted batches of at most this many padded tokens instead of eval_batch_size rows, e.g. 8192")
+    parser.add_argument("--streaming",
+                        action='store_true',
+                        help="Stream the training rows from the feature cache through a shuffle buffer instead of a random sampler over all rows")
+    parser.add_argument("--shuffle_buffer_size",
+                        default=10000,
+                        type=int,
+                        help="Rows held in the shuffle buffer of --streaming")
+    parser.add_argument("--dataloader_num_workers",
+                        default=0,
+                        type=int,
+                        help="DataLoader workers of --streaming, each reads its own part of the rows")
+    parser.add_argument("--gradient_checkpointing",
+                        action='store_true',
+                        help="Recompute the encoder layer activations in the backward pass, for less memory per batch")
     parser.add_argument("--max_seq_length",
                         default=128,
                         type=int,
@@ -407,7 +272,7 @@ def main():
     parser.add_argument("--local_rank",
                         type=int,
                         default=-1,
-                        help="local_rank for distributed training on gpus")
+                        help="local_rank for distributed training on gpus, or on CPU processes (gloo) with --no_cuda; see launch_distributed.py")
     parser.add_argument('--seed',
                         type=int,
                         default=42,
@@ -418,7 +283,10 @@ def main():
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument('--fp16',
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
+                        help="Whether to run forward passes in float16 autocast with loss scaling (GPU only)")
+    parser.add_argument('--bf16',
+                        action='store_true',
+                        help="Whether to run forward passes in bfloat16 autocast (also what --fp16 falls back to without a GPU)")
     parser.add_argument('--loss_scale',
                         type=float, default=0,
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
@@ -439,23 +307,20 @@ def main():
         "rte": "classification"
     }
 
-    if args.local_rank == -1 or args.no_cuda:
-        device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-        n_gpu = torch.cuda.device_count()
-    else:
-        torch.cuda.set_device(args.local_rank)
-        device = torch.device("cuda", args.local_rank)
-        n_gpu = 1
-        # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-        torch.distributed.init_process_group(backend='nccl')
-    logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
-        device, n_gpu, bool(args.local_rank != -1), args.fp16))
+    # Initializes the distributed backend (gloo on CPU, nccl on gpus) which will take care of sychronizing processes
+    device, n_gpu, args.local_rank = init_distributed(args.local_rank, args.no_cuda)
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+    logger.info("device: {} n_gpu: {}, distributed training: {}, precision: {}".format(
+        device, n_gpu, bool(args.local_rank != -1), precision))
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
                             args.gradient_accumulation_steps))
 
     args.train_batch_size = args.train_batch_size // args.gradient_accumulation_steps
+    logger.info("effective batch size: {} ({} processes x {} accumulated batches of {})".format(
+        args.train_batch_size * args.gradient_accumulation_steps * get_world_size(), get_world_size(),
+        args.gradient_accumulation_steps, args.train_batch_size))
 
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -483,14 +348,18 @@ def main():
     print('num_labels:', num_labels, 'training size:', len(train_examples), 'dev size:', len(dev_examples))
 
     num_train_optimization_steps = None
-    num_train_optimization_steps = int(
-        len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
+    num_train_optimization_steps = int(math.ceil(
+        math.ceil(len(train_examples) / args.train_batch_size) / args.gradient_accumulation_steps)) * args.num_train_epochs
     if args.local_rank != -1:
         num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
 
     model = RobertaForSequenceClassification(num_labels)
     tokenizer = RobertaTokenizer.from_pretrained(pretrain_model_dir, do_lower_case=args.do_lower_case)
+    if args.gradient_checkpointing:
+        logger.info("gradient checkpointing on %d encoder layers", enable_gradient_checkpointing(model.roberta_single))
     model.to(device)
+    '''DistributedDataParallel when launched with several processes; eval and saving use the plain model'''
+    train_model = wrap_model(model, device)
 
     param_optimizer = list(model.named_parameters())
     no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
@@ -507,64 +376,57 @@ def main():
     max_test_acc = 0.0
     max_dev_acc = 0.0
     if args.do_train:
-        train_features = convert_examples_to_features(
-            train_examples, label_list, args.max_seq_length, tokenizer, output_mode,
+        '''tokenized once into args.feature_cache_dir, the parallel seeds share the cache'''
+        pad_token = tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0]
+        feature_cache = FeatureCache(args.feature_cache_dir, pretrain_model_dir, args.do_lower_case, args.max_seq_length,
+                                     sep_token_extra=True, pad_token=pad_token)
+        convert = lambda examples: parallel_convert_examples_to_features(
+            examples, label_list, args.max_seq_length, tokenizer, output_mode,
+            num_workers=args.preprocessing_num_workers, chunk_size=args.preprocessing_chunk_size,
             cls_token_at_end=False,#bool(args.model_type in ['xlnet']),            # xlnet has a cls token at the end
             cls_token=tokenizer.cls_token,
             cls_token_segment_id=0,#2 if args.model_type in ['xlnet'] else 0,
             sep_token=tokenizer.sep_token,
             sep_token_extra=True,#bool(args.model_type in ['roberta']),           # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
             pad_on_left=False,#bool(args.model_type in ['xlnet']),                 # pad on the left for xlnet
-            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            pad_token=pad_token,
             pad_token_segment_id=0)#4 if args.model_type in ['xlnet'] else 0,)
+        train_features = feature_cache.load_or_build('MNLI.train', train_examples, label_list, convert)
 
         '''load dev set'''
-        dev_features = convert_examples_to_features(
-            dev_examples, label_list, args.max_seq_length, tokenizer, output_mode,
-            cls_token_at_end=False,#bool(args.model_type in ['xlnet']),            # xlnet has a cls token at the end
-            cls_token=tokenizer.cls_token,
-            cls_token_segment_id=0,#2 if args.model_type in ['xlnet'] else 0,
-            sep_token=tokenizer.sep_token,
-            sep_token_extra=True,#bool(args.model_type in ['roberta']),           # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-            pad_on_left=False,#bool(args.model_type in ['xlnet']),                 # pad on the left for xlnet
-            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-            pad_token_segment_id=0)#4 if args.model_type in ['xlnet'] else 0,)
-
-        dev_all_input_ids = torch.tensor([f.input_ids for f in dev_features], dtype=torch.long)
-        dev_all_input_mask = torch.tensor([f.input_mask for f in dev_features], dtype=torch.long)
-        dev_all_segment_ids = torch.tensor([f.segment_ids for f in dev_features], dtype=torch.long)
-        dev_all_label_ids = torch.tensor([f.label_id for f in dev_features], dtype=torch.long)
+        dev_features = feature_cache.load_or_build('MNLI.dev_mismatched', dev_examples, label_list, convert)
 
-        dev_data = TensorDataset(dev_all_input_ids, dev_all_input_mask, dev_all_segment_ids, dev_all_label_ids)
-        dev_sampler = SequentialSampler(dev_data)
-        dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=args.eval_batch_size)
+        dev_dataloader = features_dataloader(dev_features, args.eval_batch_size, dataloader_mode='sequential', max_tokens=args.eval_max_tokens)
 
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(train_examples))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_optimization_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-        train_sampler = RandomSampler(train_data)
-
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        '''ids and lengths only, masks are built per batch and trimmed to its longest pair'''
+        if args.streaming:
+            train_data = StreamingFeatureDataset(train_features, args.seed, batch_size=args.train_batch_size,
+                                                 shuffle_buffer_size=args.shuffle_buffer_size)
+            train_dataloader = DataLoader(train_data, batch_size=train_data.batch_size, collate_fn=train_data.collate,
+                                          num_workers=args.dataloader_num_workers)
+        else:
+            train_dataloader = features_dataloader(train_features, args.train_batch_size, dataloader_mode='random',
+                                                   bucket_by_length=args.bucket_by_length, seed=args.seed)
 
         iter_co = 0
         final_test_performance = 0.0
-        for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+            set_epoch(train_dataloader, epoch)
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
+            pending = False
             for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
                 model.train()
                 batch = tuple(t.to(device) for t in batch)
                 input_ids, input_mask, segment_ids, label_ids = batch
 
 
-                logits = model(input_ids, input_mask)
+                with precision.autocast():
+                    logits = train_model(input_ids, input_mask).float()
                 loss_fct = CrossEntropyLoss()
 
                 loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
@@ -574,19 +436,29 @@ def main():
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
 
-                loss.backward()
+                precision.backward(loss)
+                pending = True
 
                 tr_loss += loss.item()
                 nb_tr_examples += input_ids.size(0)
                 nb_tr_steps += 1
 
-                optimizer.step()
+                if (step + 1) % args.gradient_accumulation_steps == 0:
+                    precision.step(optimizer)
+                    optimizer.zero_grad()
+                    pending = False
+                    global_step += 1
+                iter_co+=1
+            '''apply the gradients of an incomplete last accumulation, without relying on len(train_dataloader)'''
+            if pending:
+                precision.step(optimizer)
                 optimizer.zero_grad()
                 global_step += 1
-                iter_co+=1
 
+            if not is_main_process():
+                continue
             '''
-            start evaluate on dev set after this epoch
+            start evaluate on dev set after this epoch, on rank 0 only
             '''
             model.eval()
             logger.info("***** Running dev *****")
@@ -604,14 +476,17 @@ def main():
                 label_ids = label_ids.to(device)
                 gold_label_ids+=list(label_ids.detach().cpu().numpy())
 
-                with torch.no_grad():
-                    logits = model(input_ids, input_mask)
+                with torch.no_grad(), precision.autocast():
+                    logits = model(input_ids, input_mask).float()
                 if len(preds) == 0:
                     preds.append(logits.detach().cpu().numpy())
                 else:
                     preds[0] = np.append(preds[0], logits.detach().cpu().numpy(), axis=0)
 
             preds = preds[0]
+            '''token-budget batches are sorted by length, put the rows back in example order'''
+            preds = restore_order(dev_dataloader, preds)
+            gold_label_ids = restore_order(dev_dataloader, gold_label_ids)
 
             pred_probs = softmax(preds,axis=1)
             pred_label_ids = list(np.argmax(pred_probs, axis=1))
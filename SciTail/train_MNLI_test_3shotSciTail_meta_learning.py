@@ -30,7 +30,7 @@ from transformers.optimization import AdamW
 from transformers.modeling_roberta import RobertaModel, RobertaConfig#, RobertaClassificationHead
 from transformers.modeling_bert import BertPreTrainedModel
 
-from bert_common_functions import store_transformers_models, get_a_random_batch_from_dataloader, cosine_rowwise_two_matrices
+from bert_common_functions import store_transformers_models, RandomBatchProvider, cosine_rowwise_two_matrices
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -627,6 +627,9 @@ def main():
                         type=int,
                         default=4,
                         help="random seed for initialization")
+    parser.add_argument('--sample_without_replacement',
+                        action='store_true',
+                        help="draw the per-class MNLI samples without replacement until every row of the class was drawn once")
     parser.add_argument('--gradient_accumulation_steps',
                         type=int,
                         default=1,
@@ -819,7 +822,7 @@ def main():
         iter_co = 0
         tr_loss = 0
         loss_fct = CrossEntropyLoss()
-        for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
             dataloader_list = []
             for idd, train_features in enumerate([train_features_entail, train_features_neutral, train_features_contra,
             train_features_entail + train_features_neutral + train_features_contra]):
@@ -830,16 +833,17 @@ def main():
 
                 train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
                 train_sampler = RandomSampler(train_data)
-                '''create 3 samples per class'''
+                '''create 3 samples per class, as random full-size batches indexed from the class tensors'''
                 if idd < 3:
-                    train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.sample_size)
+                    train_dataloader = RandomBatchProvider(train_data, args.sample_size, replacement=not args.sample_without_replacement,
+                                                           seed='{}-{}-{}'.format(args.seed, epoch, idd))
                 else:
                     train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
                 dataloader_list.append(train_dataloader)
 
-            MNLI_entail_dataloader = dataloader_list[0]
-            MNLI_neutra_dataloader = dataloader_list[1]
-            MNLI_contra_dataloader = dataloader_list[2]
+            MNLI_entail_batches = dataloader_list[0]
+            MNLI_neutra_batches = dataloader_list[1]
+            MNLI_contra_batches = dataloader_list[2]
             MNLI_dataloader = dataloader_list[3]
 
             '''start training'''
@@ -854,16 +858,16 @@ def main():
                 input_ids, input_mask, segment_ids, label_ids = batch
                 assert input_ids.shape[0] == args.train_batch_size
 
-                mnli_entail_batch = get_a_random_batch_from_dataloader(MNLI_entail_dataloader, args.sample_size)
+                mnli_entail_batch = MNLI_entail_batches.next_batch()
                 # print('random batch len:', len(mnli_entail_batch[0]))
                 mnli_entail_batch_input_ids, mnli_entail_batch_input_mask, mnli_entail_batch_segment_ids, mnli_entail_batch_label_ids = tuple(t.to(device) for t in mnli_entail_batch) #mnli_entail_batch
                 # print('sample entail:', mnli_entail_batch_input_ids.shape[0], mnli_entail_batch_label_ids.shape, mnli_entail_batch_label_ids)
 
-                mnli_neutra_batch = get_a_random_batch_from_dataloader(MNLI_neutra_dataloader, args.sample_size)
+                mnli_neutra_batch = MNLI_neutra_batches.next_batch()
                 mnli_neutra_batch_input_ids, mnli_neutra_batch_input_mask, mnli_neutra_batch_segment_ids, mnli_neutra_batch_label_ids = tuple(t.to(device) for t in mnli_neutra_batch) #mnli_neutra_batch
                 # print('sample neutra:', mnli_neutra_batch_input_ids.shape[0], mnli_neutra_batch_label_ids.shape, mnli_neutra_batch_label_ids)
 
-                mnli_contra_batch = get_a_random_batch_from_dataloader(MNLI_contra_dataloader, args.sample_size)
+                mnli_contra_batch = MNLI_contra_batches.next_batch()
                 mnli_contra_batch_input_ids, mnli_contra_batch_input_mask, mnli_contra_batch_segment_ids, mnli_contra_batch_label_ids = tuple(t.to(device) for t in mnli_contra_batch) #mnli_contra_batch
                 # print('sample contra:', mnli_contra_batch_input_ids.shape[0], mnli_contra_batch_label_ids.shape, mnli_contra_batch_label_ids)
 
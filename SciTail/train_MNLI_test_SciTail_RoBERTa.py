@@ -18,7 +18,6 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import csv
 import logging
 import os
 import random
@@ -43,6 +42,9 @@ from pytorch_transformers.tokenization_roberta import RobertaTokenizer
 from pytorch_transformers.optimization import AdamW
 from pytorch_transformers.modeling_roberta import RobertaForSequenceClassification
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tsv_reader import read_tsv
+
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
                     level = logging.INFO)
@@ -102,14 +104,7 @@ class DataProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """Reads a tab separated value file."""
-        with open(input_file, "r") as f:
-            reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-            lines = []
-            for line in reader:
-                if sys.version_info[0] == 2:
-                    line = list(unicode(cell, 'utf-8') for cell in line)
-                lines.append(line)
-            return lines
+        return [list(line) for line in read_tsv(input_file, strip_fields=False)]
 
 class RteProcessor(DataProcessor):
     """Processor for the RTE data set (GLUE version)."""
@@ -141,22 +136,12 @@ class RteProcessor(DataProcessor):
         can read the training file, dev and test file
         '''
         examples=[]
-        readfile = codecs.open(filename, 'r', 'utf-8')
-        line_co=0
-        for row in readfile:
-
-            line=row.strip().split('\t')
-            if len(line) == 3:
-                guid = prefix+'-'+str(line_co-1)
-                text_a = line[0].strip()
-                text_b = line[1].strip()
-                # label = line[3].strip() #["entailment", "not_entailment"]
-                label = 'entailment'  if line[2] == 'entails' else 'neutral'
-                examples.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-            line_co+=1
-        readfile.close()
-        print('loaded  size:', line_co-1)
+        for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, num_columns=3)):
+            guid = prefix+'-'+str(line_co)
+            label = 'entailment'  if label == 'entails' else 'neutral'
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+        print('loaded  size:', len(examples))
         return examples
 
     def get_labels(self):
@@ -0,0 +1,160 @@
+"""
+batch construction over tokenized features: length bucketing, token-budget
+evaluation batches and per-batch padding
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, Sampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
+
+from feature_cache import PackedFeatureDataset
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Random batches of similar length: the shuffled indices are cut into pools
+    of batch_size * bucket_size_multiplier, each pool is sorted by length and
+    split into batches, and the batches of all pools are shuffled. Combined
+    with a trimming collate, short pairs no longer run 128-token attention.
+
+    With world_size > 1 every rank draws the same permutation (from seed and
+    the epoch of `set_epoch`) and buckets only its strided part of it, an
+    equal number of rows per rank, like DistributedSampler.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=100, drop_last=False, generator=None,
+                 rank=0, world_size=1, seed=0):
+        self.lengths = [int(length) for length in lengths]
+        self.batch_size = batch_size
+        self.pool_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.generator = generator
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_rows = len(self.lengths) // world_size if world_size > 1 else len(self.lengths)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = self.generator
+        if self.world_size > 1:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.lengths), generator=generator).tolist()
+        if self.world_size > 1:
+            order = order[self.rank:self.num_rows * self.world_size:self.world_size]
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = sorted(order[start:start + self.pool_size], key=lambda i: self.lengths[i])
+            for batch_start in range(0, len(pool), self.batch_size):
+                batch = pool[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        for i in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(min(self.pool_size, self.num_rows - start) // self.batch_size
+                       for start in range(0, self.num_rows, self.pool_size))
+        return sum((min(self.pool_size, self.num_rows - start) + self.batch_size - 1) // self.batch_size
+                   for start in range(0, self.num_rows, self.pool_size))
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Evaluation batches packed by padded size: rows are sorted by length
+    (longest first) and a batch grows while len(batch) * its longest row stays
+    within max_tokens, so short pairs go in big batches and long ones in small.
+    The batches are fixed; `order` lists the rows in the order they are yielded
+    and `restore_order` maps per-row outputs back to the example order.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None):
+        lengths = [int(length) for length in lengths]
+        rows = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+        self.batches = []
+        batch = []
+        for row in rows:
+            # rows come longest first, so the first row of a batch sets its padded length
+            longest = lengths[batch[0]] if batch else lengths[row]
+            full = (len(batch) + 1) * longest > max_tokens or (max_batch_size is not None and len(batch) == max_batch_size)
+            if batch and full:
+                self.batches.append(batch)
+                batch = []
+            batch.append(row)
+        if batch:
+            self.batches.append(batch)
+        self.order = np.asarray([row for batch in self.batches for row in batch], dtype=np.int64)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def restore_order(self, values):
+        '''values: one entry (or array row) per example, in iteration order'''
+        if isinstance(values, list):
+            restored = [None] * len(values)
+            for position, row in enumerate(self.order.tolist()):
+                restored[row] = values[position]
+            return restored
+        if torch.is_tensor(values):
+            restored = torch.empty_like(values)
+            restored[torch.from_numpy(self.order).to(values.device)] = values
+            return restored
+        restored = np.empty_like(values)
+        restored[self.order] = values
+        return restored
+
+
+def restore_order(dataloader, values):
+    '''per-example outputs of a pass over `dataloader`, in the order of its examples'''
+    batch_sampler = dataloader.batch_sampler
+    if hasattr(batch_sampler, 'restore_order'):
+        return batch_sampler.restore_order(values)
+    return values
+
+
+def set_epoch(dataloader, epoch):
+    '''reshuffles the distributed sampler (or streaming dataset) of a training dataloader for `epoch`'''
+    batch_sampler = dataloader.batch_sampler
+    for shuffler in (batch_sampler, getattr(batch_sampler, 'sampler', None), dataloader.dataset):
+        if hasattr(shuffler, 'set_epoch'):
+            shuffler.set_epoch(epoch)
+
+
+def features_dataloader(features, batch_size, dataloader_mode='sequential', bucket_by_length=False, trim=True,
+                        max_tokens=None, seed=0):
+    '''
+    DataLoader of (input_ids, input_mask, segment_ids, label_ids) batches over TokenizedFeatures
+
+    dataloader_mode: 'sequential' keeps the example order (eval, embedding caches),
+                     anything else shuffles like RandomSampler
+    bucket_by_length: in random mode, draw batches with BucketBatchSampler
+    trim: pad each batch to its longest row instead of max_seq_length
+    max_tokens: in sequential mode, pack batches with TokenBudgetBatchSampler instead of
+                batch_size rows each; pass the outputs through restore_order
+    seed: in random mode under torch.distributed, every rank shuffles with seed + epoch and
+          takes its own part of the rows; call set_epoch before each epoch
+    '''
+    dataset = PackedFeatureDataset(features, trim=trim)
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if dataloader_mode == 'sequential' and max_tokens:
+        batch_sampler = TokenBudgetBatchSampler(features.lengths, max_tokens)
+    elif dataloader_mode == 'sequential':
+        batch_sampler = BatchSampler(SequentialSampler(dataset), batch_size, drop_last=False)
+    elif bucket_by_length and distributed:
+        batch_sampler = BucketBatchSampler(features.lengths, batch_size, rank=torch.distributed.get_rank(),
+                                           world_size=torch.distributed.get_world_size(), seed=seed)
+    elif bucket_by_length:
+        batch_sampler = BucketBatchSampler(features.lengths, batch_size)
+    elif distributed:
+        batch_sampler = BatchSampler(DistributedSampler(dataset, shuffle=True, seed=seed), batch_size, drop_last=False)
+    else:
+        batch_sampler = BatchSampler(RandomSampler(dataset), batch_size, drop_last=False)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate)
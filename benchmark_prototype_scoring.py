@@ -0,0 +1,42 @@
+"""
+time of the PrototypeNet pairwise forward against prototype_scoring.factorized_prototype_scores,
+in evaluation (no_grad)
+
+    python benchmark_prototype_scoring.py --hidden_size 1024 --batch_size 2048 --chunk_size 256
+"""
+
+import argparse
+import time
+
+import torch
+
+from prototype_scoring import PrototypeNet, factorized_prototype_scores
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden_size', type=int, default=1024)
+    parser.add_argument('--batch_size', type=int, default=2048, help='queries scored per call')
+    parser.add_argument('--chunk_size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    net = PrototypeNet(args.hidden_size).eval()
+    rep_classes = torch.randn(6, args.hidden_size)
+    rep_query_batch = torch.randn(args.batch_size, args.hidden_size)
+    for name, score in [('pairwise', lambda: net(rep_classes, rep_query_batch)),
+                        ('factorized', lambda: factorized_prototype_scores(net, rep_classes, rep_query_batch)),
+                        ('chunked', lambda: factorized_prototype_scores(net, rep_classes, rep_query_batch, args.chunk_size))]:
+        with torch.no_grad():
+            score()
+            start = time.time()
+            for _ in range(args.repeats):
+                score()
+        print('{:10} {:8.1f} ms'.format(name, 1000 * (time.time() - start) / args.repeats))
+    pairs = min(args.batch_size, args.chunk_size)
+    print('largest (pairs, 4*hidden) activation: {:.0f} MB pairwise, {:.0f} MB chunked'.format(
+        args.batch_size * 6 * 4 * args.hidden_size * 4 / 2**20, pairs * 6 * 4 * args.hidden_size * 4 / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+speed and memory of the training step and the eval forward of the entailment classifier,
+fp32 against autocast mixed precision (mixed_precision.py) and with or without gradient
+checkpointing (gradient_checkpointing.py)
+
+    python benchmark_training.py --pretrain_model_dir roberta-large --batch_size 8 --max_seq_length 128
+    python benchmark_training.py --precision fp32 fp16 --device cuda
+    python benchmark_training.py --precision fp32 --gradient_checkpointing --batch_size 16 32 64
+
+One training step is what the trainers run: forward, cross entropy, backward, AdamW step.
+"activations MB" is the size of the tensors autograd keeps for the backward pass (counted
+with saved_tensors_hooks, so also on CPU); on a GPU the peak allocated memory is reported too.
+"""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+from torch.nn import CrossEntropyLoss
+from transformers.optimization import AdamW
+
+from entailment_model import RobertaForSequenceClassification
+from export_model import example_inputs
+from gradient_checkpointing import enable_gradient_checkpointing
+from mixed_precision import MixedPrecision
+
+
+logger = logging.getLogger(__name__)
+
+
+def saved_activation_megabytes(model, precision, input_ids, input_mask, label_ids):
+    '''MB of the distinct tensors saved for backward by one forward + loss'''
+    saved = {}
+
+    def pack(tensor):
+        saved[(tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        with precision.autocast():
+            logits = model(input_ids, input_mask).float()
+        CrossEntropyLoss()(logits, label_ids)
+    return sum(saved.values()) / 2**20
+
+
+def train_step(model, optimizer, precision, input_ids, input_mask, label_ids):
+    with precision.autocast():
+        logits = model(input_ids, input_mask).float()
+    loss = CrossEntropyLoss()(logits, label_ids)
+    precision.backward(loss)
+    precision.step(optimizer)
+    optimizer.zero_grad()
+    return loss.item()
+
+
+def eval_logits(model, precision, input_ids, input_mask):
+    with torch.no_grad(), precision.autocast():
+        return model(input_ids, input_mask).float()
+
+
+def median_seconds(run, repeats, device):
+    '''median seconds of `run()`, after one warm-up call'''
+    run()
+    times = []
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        run()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def build_model(args, device):
+    model = RobertaForSequenceClassification(args.tagset_size, args.pretrain_model_dir, load_pretrained=False)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    return model.to(device)
+
+
+def benchmark(args, name, checkpointing, batch_size, device, reference_logits=None):
+    '''one row of the report; every row gets a freshly built model and optimizer'''
+    torch.manual_seed(args.seed)
+    model = build_model(args, device)
+    if checkpointing:
+        enable_gradient_checkpointing(model.roberta_single)
+    precision = MixedPrecision(device, fp16=name == 'fp16', bf16=name == 'bf16', loss_scale=args.loss_scale)
+    optimizer = AdamW(model.parameters(), lr=1e-6)
+    input_ids, input_mask = [t.to(device) for t in example_inputs(model.roberta_single.config.vocab_size,
+                                                                   batch_size, args.max_seq_length)]
+    label_ids = torch.arange(batch_size, device=device) % args.tagset_size
+
+    model.eval()
+    logits = eval_logits(model, precision, input_ids, input_mask)
+    eval_time = median_seconds(lambda: eval_logits(model, precision, input_ids, input_mask), args.repeats, device)
+    drift = (logits - reference_logits).abs().max().item() if reference_logits is not None else 0.0
+
+    model.train()
+    activations = saved_activation_megabytes(model, precision, input_ids, input_mask, label_ids)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    train_time = median_seconds(lambda: train_step(model, optimizer, precision, input_ids, input_mask, label_ids),
+                                args.repeats, device)
+    peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else float('nan')
+
+    print('{:5} {:10} {:5d} {:13.1f} {:13.1f} {:14.1f} {:15.1f} {:12.1f} {:12.2e}'.format(
+        precision.name, 'yes' if checkpointing else 'no', batch_size, 1000 * train_time,
+        batch_size / train_time, 1000 * eval_time, activations, peak, drift))
+    return logits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrain_model_dir', type=str, default='roberta-large',
+                        help='the model is built from its config, with random weights unless --checkpoint is given')
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--tagset_size', type=int, default=3)
+    parser.add_argument('--precision', type=str, nargs='+', default=['fp32', 'bf16', 'fp16'],
+                        choices=['fp32', 'bf16', 'fp16'], help='fp16 is skipped without a GPU')
+    parser.add_argument('--gradient_checkpointing', action='store_true',
+                        help='also run every precision and batch size with gradient checkpointing')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[8])
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--loss_scale', type=float, default=0)
+    parser.add_argument('--repeats', type=int, default=5, help='timed steps per precision')
+    parser.add_argument('--device', type=str, default=None, help='default: cuda if available')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--num_threads', type=int, default=None, help='torch.set_num_threads')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    names = list(args.precision)
+    if 'fp16' in names and device.type != 'cuda':
+        logger.warning('fp16 needs a GPU, skipping it on %s', device)
+        names.remove('fp16')
+    if 'fp32' in names:
+        names.remove('fp32')
+        names.insert(0, 'fp32')
+    print('{} tokens per example on {}'.format(args.max_seq_length, device))
+    print('      checkpoint batch  train ms/step  train ex/sec  eval ms/batch  activations MB  GPU peak MB  logit drift')
+    for batch_size in args.batch_size:
+        reference_logits = None
+        for name in names:
+            for checkpointing in ([False, True] if args.gradient_checkpointing else [False]):
+                logits = benchmark(args, name, checkpointing, batch_size, device, reference_logits)
+                if name == 'fp32' and not checkpointing:
+                    reference_logits = logits
+
+
+if __name__ == '__main__':
+    main()
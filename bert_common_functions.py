@@ -3,7 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import os
 from transformers.modeling_bert import BertPreTrainedModel, BertModel
-from random import randrange
+import random
+from torch.utils.data import TensorDataset
 
 def convert_examples_to_features(examples, label_list, max_seq_length,
                                  tokenizer, output_mode,
@@ -162,116 +163,116 @@ class BertForSequenceClassification(BertPreTrainedModel):
 
         return outputs  # (loss), logits, (hidden_states), (attentions)
 
-def sent_pair_to_embedding(sent1, sent2, tokenizer, model, tokenized_yes):
-    if tokenized_yes:
-        sent1_tokenized = sent1.split()
-        sent2_tokenized = sent2.split()
-    else:
-        sent1_tokenized = tokenizer.tokenize(sent1)
-        sent2_tokenized = tokenizer.tokenize(sent2)
-    pair_tokenlist = ['[CLS]']+sent1_tokenized+['[SEP]']+sent2_tokenized+['[SEP]']
-    # print(pair_tokenlist)
-    segments_ids = [0]*(len(sent1_tokenized)+2)+[1]*(len(sent2_tokenized)+1)
-    # print(segments_ids)
-    indexed_tokens = tokenizer.convert_tokens_to_ids(pair_tokenlist)
-    tokens_tensor = torch.tensor([indexed_tokens])
-    segments_tensors = torch.tensor([segments_ids])
+def _model_device(model, device):
+    return device if device is not None else next(model.parameters()).device
 
-    tokens_tensor = tokens_tensor.to('cuda')
-    segments_tensors = segments_tensors.to('cuda')
-
-
-    # Predict hidden states features for each layer
-    with torch.no_grad():
-        last_hidden_states = model(tokens_tensor, segments_tensors)[0]
-
-    return last_hidden_states[0,0,:]
-
-def sent_to_embedding(sent1, tokenizer, model, tokenized_yes):
-    sent1_tokenized = tokenizer.tokenize(sent1)
-
-
-    pair_tokenlist = ["[CLS]"] + sent1_tokenized + ["[SEP]"]
-    segments_ids = [0] * len(pair_tokenlist)
-
-    indexed_tokens = tokenizer.convert_tokens_to_ids(pair_tokenlist)
-
-    tokens_tensor = torch.tensor([indexed_tokens])
-    segments_tensors = torch.tensor([segments_ids])
-
-    tokens_tensor = tokens_tensor.to('cuda')
-    segments_tensors = segments_tensors.to('cuda')
-
-    # Predict hidden states features for each layer
-    with torch.no_grad():
-        encoded_layers, _ = model(tokens_tensor[:,:512], segments_tensors[:,:512])
-
-    # We have a hidden states for each of the 12 layers in model bert-base-uncased
-    last_layer_output = encoded_layers[-1]
-    return last_layer_output[0][0]
-
-def sent_to_embedding_last4(sent1, tokenizer, model, tokenized_yes):
-    sent1_tokenized = tokenizer.tokenize(sent1)
-
-
-    pair_tokenlist = ["[CLS]"] + sent1_tokenized + ["[SEP]"]
-    segments_ids = [0] * len(pair_tokenlist)
-
-    indexed_tokens = tokenizer.convert_tokens_to_ids(pair_tokenlist)
-
-    tokens_tensor = torch.tensor([indexed_tokens])
-    segments_tensors = torch.tensor([segments_ids])
-
-    tokens_tensor = tokens_tensor.to('cuda')
-    segments_tensors = segments_tensors.to('cuda')
+def _padded_batch(token_lists, segment_lists, tokenizer, device, max_tokens=None):
+    '''
+    right-padded (input_ids, segment_ids, attention_mask) LongTensors on `device`, as long as the
+    longest sequence; sequences are cut to max_tokens like the [:,:512] of the single-sentence functions
+    '''
+    ids_lists = [tokenizer.convert_tokens_to_ids(tokens)[:max_tokens] for tokens in token_lists]
+    seq_len = max(len(ids) for ids in ids_lists)
+    input_ids = torch.zeros(len(ids_lists), seq_len, dtype=torch.long)
+    segment_ids = torch.zeros(len(ids_lists), seq_len, dtype=torch.long)
+    attention_mask = torch.zeros(len(ids_lists), seq_len, dtype=torch.long)
+    for i, (ids, segments) in enumerate(zip(ids_lists, segment_lists)):
+        input_ids[i, :len(ids)] = torch.tensor(ids)
+        segment_ids[i, :len(ids)] = torch.tensor(segments[:len(ids)])
+        attention_mask[i, :len(ids)] = 1
+    return input_ids.to(device), segment_ids.to(device), attention_mask.to(device)
+
+def _in_length_batches(token_lists, batch_size, encode):
+    '''
+    runs encode(indices) on batches of similar length (less padding) and
+    stacks the results back in input order
+    '''
+    order = sorted(range(len(token_lists)), key=lambda i: len(token_lists[i]))
+    outputs = [encode(order[start:start + batch_size]) for start in range(0, len(order), batch_size)]
+    stacked = torch.cat(outputs, 0)
+    restore = torch.empty(len(order), dtype=torch.long)
+    restore[torch.tensor(order)] = torch.arange(len(order))
+    return stacked[restore.to(stacked.device)]
+
+def sent_pairs_to_embeddings(sent_pairs, tokenizer, model, tokenized_yes, batch_size=32, device=None):
+    '''
+    batched sent_pair_to_embedding
+    sent_pairs: list of (premise, hypothesis)
+    return: (len(sent_pairs), hidden_size), the last-layer [CLS] states, on the model's device
+    '''
+    device = _model_device(model, device)
+    token_lists, segment_lists = [], []
+    for sent1, sent2 in sent_pairs:
+        if tokenized_yes:
+            sent1_tokenized = sent1.split()
+            sent2_tokenized = sent2.split()
+        else:
+            sent1_tokenized = tokenizer.tokenize(sent1)
+            sent2_tokenized = tokenizer.tokenize(sent2)
+        token_lists.append(['[CLS]']+sent1_tokenized+['[SEP]']+sent2_tokenized+['[SEP]'])
+        segment_lists.append([0]*(len(sent1_tokenized)+2)+[1]*(len(sent2_tokenized)+1))
+
+    def encode(indices):
+        input_ids, segment_ids, attention_mask = _padded_batch(
+            [token_lists[i] for i in indices], [segment_lists[i] for i in indices], tokenizer, device)
+        with torch.no_grad():
+            last_hidden_states = model(input_ids, token_type_ids=segment_ids, attention_mask=attention_mask)[0]
+        return last_hidden_states[:,0,:]
+    return _in_length_batches(token_lists, batch_size, encode)
+
+def _sents_to_encoded_layers(sents, tokenizer, model, batch_size, device, select):
+    '''
+    runs single sentences "[CLS] sent [SEP]" through a model that returns (encoded_layers, pooled)
+    select(encoded_layers, lengths): the per-sentence output of a batch
+    '''
+    device = _model_device(model, device)
+    token_lists = [["[CLS]"] + tokenizer.tokenize(sent1) + ["[SEP]"] for sent1 in sents]
+
+    def encode(indices):
+        batch_tokens = [token_lists[i] for i in indices]
+        input_ids, segment_ids, attention_mask = _padded_batch(
+            batch_tokens, [[0] * len(tokens) for tokens in batch_tokens], tokenizer, device, max_tokens=512)
+        with torch.no_grad():
+            encoded_layers, _ = model(input_ids, token_type_ids=segment_ids, attention_mask=attention_mask)
+        return select(encoded_layers, attention_mask.sum(1))
+    return _in_length_batches(token_lists, batch_size, encode)
+
+def sents_to_embeddings(sents, tokenizer, model, tokenized_yes, batch_size=32, device=None):
+    '''batched sent_to_embedding: (len(sents), hidden_size) last-layer [CLS] states'''
+    return _sents_to_encoded_layers(sents, tokenizer, model, batch_size, device,
+                                    lambda encoded_layers, lengths: encoded_layers[-1][:,0])
+
+def sents_to_embeddings_last4(sents, tokenizer, model, tokenized_yes, batch_size=32, device=None):
+    '''batched sent_to_embedding_last4: (len(sents), 4*hidden_size), [CLS] of the last 4 layers, lowest first'''
+    return _sents_to_encoded_layers(sents, tokenizer, model, batch_size, device,
+                                    lambda encoded_layers, lengths: torch.cat([layer[:,0] for layer in encoded_layers[-4:]], 1))
+
+def sents_to_embedding_matrices(sents, tokenizer, model, tokenized_yes, max_len, batch_size=32, device=None):
+    '''
+    batched sent_to_embedding_matrix: (len(sents), max_len, hidden_size); the last-layer states
+    of each sentence without the final [SEP], cut or padded to max_len by repeating the last row
+    '''
+    def select(encoded_layers, lengths):
+        '''row j of sentence i is state min(j, length_i - 2)'''
+        rows = torch.min(torch.arange(max_len, device=lengths.device)[None, :], (lengths - 2)[:, None])
+        last_layer_output = encoded_layers[-1] #(batch, len, hidden_size)
+        return last_layer_output.gather(1, rows[:, :, None].expand(-1, -1, last_layer_output.size(2)))
+    return _sents_to_encoded_layers(sents, tokenizer, model, batch_size, device, select)
 
-    # Predict hidden states features for each layer
-    with torch.no_grad():
-        encoded_layers, _ = model(tokens_tensor[:,:512], segments_tensors[:,:512])
+def sent_pair_to_embedding(sent1, sent2, tokenizer, model, tokenized_yes, device=None):
+    return sent_pairs_to_embeddings([(sent1, sent2)], tokenizer, model, tokenized_yes, device=device)[0]
 
-    # We have a hidden states for each of the 12 layers in model bert-base-uncased
-    last_layer_output = encoded_layers[-1] #()
-    first_layer_output = encoded_layers[-4] #()
-    second_layer_output = encoded_layers[-3] #()
-    third_layer_output = encoded_layers[-2] #()
+def sent_to_embedding(sent1, tokenizer, model, tokenized_yes, device=None):
+    return sents_to_embeddings([sent1], tokenizer, model, tokenized_yes, device=device)[0]
 
-    return torch.cat([first_layer_output[0][0],second_layer_output[0][0],third_layer_output[0][0],last_layer_output[0][0]], 0)
+def sent_to_embedding_last4(sent1, tokenizer, model, tokenized_yes, device=None):
+    return sents_to_embeddings_last4([sent1], tokenizer, model, tokenized_yes, device=device)[0]
 
-def sent_to_embedding_matrix(sent1, tokenizer, model, tokenized_yes, max_len):
+def sent_to_embedding_matrix(sent1, tokenizer, model, tokenized_yes, max_len, device=None):
     '''
     we get contextualized token-level representations
     '''
-    sent1_tokenized = tokenizer.tokenize(sent1)
-
-
-    pair_tokenlist = ["[CLS]"] + sent1_tokenized + ["[SEP]"]
-    segments_ids = [0] * len(pair_tokenlist)
-
-    indexed_tokens = tokenizer.convert_tokens_to_ids(pair_tokenlist)
-
-    tokens_tensor = torch.tensor([indexed_tokens])
-    segments_tensors = torch.tensor([segments_ids])
-
-    tokens_tensor = tokens_tensor.to('cuda')
-    segments_tensors = segments_tensors.to('cuda')
-
-    # Predict hidden states features for each layer
-    with torch.no_grad():
-        encoded_layers, _ = model(tokens_tensor[:,:512], segments_tensors[:,:512])
-
-    # We have a hidden states for each of the 12 layers in model bert-base-uncased
-    last_layer_output = encoded_layers[-1] #(1, len, hidden_size)
-    # first_layer_output = encoded_layers[-4] #()
-    # second_layer_output = encoded_layers[-3] #()
-    # third_layer_output = encoded_layers[-2] #()
-    '''we do not need the hidden states of the [CLS] and [SEP]'''
-    origin_matrix = last_layer_output[0][:-1]
-    append_size = max_len - origin_matrix.size(0)
-    if append_size>0:
-        append_matrix =  torch.repeat_interleave(origin_matrix[-1:], append_size, dim=0) #(append_size, hidden_size)
-        return torch.cat([origin_matrix, append_matrix],0)
-    else:
-        return origin_matrix[:max_len]
+    return sents_to_embedding_matrices([sent1], tokenizer, model, tokenized_yes, max_len, device=device)[0]
 
 class LogisticRegression(nn.Module):  # inheriting from nn.Module!
 
@@ -297,15 +298,55 @@ def store_transformers_models(model, tokenizer, output_dir, flag_str):
     tokenizer.save_pretrained(output_dir)
     print('store succeed')
 
+class RandomBatchProvider(object):
+    """
+    Random full-size batches of a TensorDataset by indexing its tensors directly,
+    instead of iterating a DataLoader up to a random step.
+
+    replacement=True: every batch is `batch_size` distinct rows drawn uniformly,
+    independently of the previous batches (what a random batch of a
+    RandomSampler DataLoader is). replacement=False: rows are dealt from a
+    permutation of the dataset, so no row repeats until every row has been
+    drawn once; the short tail of each permutation is dropped.
+    seed: draws come from random.Random(seed), or the global `random` state if None
+    """
+
+    def __init__(self, dataset, batch_size, replacement=True, seed=None):
+        self.tensors = dataset.tensors if isinstance(dataset, TensorDataset) else tuple(dataset)
+        self.num_rows = len(self.tensors[0])
+        if batch_size > self.num_rows:
+            raise ValueError('batch size {} > {} rows'.format(batch_size, self.num_rows))
+        self.batch_size = batch_size
+        self.replacement = replacement
+        self.rng = random if seed is None else random.Random(seed)
+        self.epoch_order = []
+
+    def next_rows(self):
+        if self.replacement:
+            return self.rng.sample(range(self.num_rows), self.batch_size)
+        if len(self.epoch_order) < self.batch_size:
+            self.epoch_order = list(range(self.num_rows))
+            self.rng.shuffle(self.epoch_order)
+        rows = self.epoch_order[-self.batch_size:]
+        del self.epoch_order[-self.batch_size:]
+        return rows
+
+    def next_batch(self):
+        rows = torch.as_tensor(self.next_rows(), dtype=torch.long)
+        return [t[rows] for t in self.tensors]
+
 def get_a_random_batch_from_dataloader(dataloader, size):
-    while True:
-        ith = randrange(len(dataloader))
-        for step, batch in enumerate(dataloader):
-            if step == ith:
-                if len(batch[0]) ==  size:
-                    return batch
-                else:
-                    break
+    '''
+    a random batch of `size` rows of the dataloader's dataset; same distribution
+    as the old "random step of a RandomSampler dataloader, retried until full",
+    but indexes the dataset instead of iterating the dataloader
+    '''
+    dataset = dataloader.dataset
+    rows = random.sample(range(len(dataset)), size)
+    if isinstance(dataset, TensorDataset):
+        rows = torch.as_tensor(rows, dtype=torch.long)
+        return [t[rows] for t in dataset.tensors]
+    return dataloader.collate_fn([dataset[i] for i in rows])
 
 # def get_a_random_list_batches_from_dataloader(dataloader, size):
 #     while True:
@@ -0,0 +1,71 @@
+"""
+multi-process data-parallel training for the 2020 trainers: gloo on CPU, nccl on GPUs
+
+    python launch_distributed.py --nproc 4 2020/pretrain.on.MNLI.py --no_cuda --do_train ...
+    torchrun --nproc_per_node 4 2020/pretrain.on.MNLI.py --do_train ...
+
+Every process runs the whole script on its own shard of the training batches;
+DistributedDataParallel all-reduces (averages) the gradients in backward, so the
+replicas stay identical. Evaluation and checkpointing run on rank 0 only.
+"""
+
+import datetime
+import logging
+import os
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(local_rank=-1, no_cuda=False, timeout_minutes=120):
+    '''
+    local_rank: the --local_rank of the scripts; -1 also reads LOCAL_RANK of torchrun / launch_distributed.py
+    return: (device, n_gpu, local_rank), local_rank stays -1 outside a distributed launch
+
+    Rank 0 evaluates while the other ranks wait in their next all-reduce, hence the long timeout.
+    Other ranks only log warnings.
+    '''
+    if local_rank == -1:
+        local_rank = int(os.environ.get('LOCAL_RANK', -1))
+    use_cuda = torch.cuda.is_available() and not no_cuda
+    if local_rank == -1:
+        return torch.device("cuda" if use_cuda else "cpu"), torch.cuda.device_count() if use_cuda else 0, -1
+
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+    else:
+        device = torch.device("cpu")
+    torch.distributed.init_process_group(backend='nccl' if use_cuda else 'gloo',
+                                         timeout=datetime.timedelta(minutes=timeout_minutes))
+    if not is_main_process():
+        logging.getLogger().setLevel(logging.WARN)
+    logger.info('process group: backend %s, world size %d', torch.distributed.get_backend(), get_world_size())
+    return device, 1 if use_cuda else 0, local_rank
+
+
+def is_distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def get_world_size():
+    return torch.distributed.get_world_size() if is_distributed() else 1
+
+
+def get_rank():
+    return torch.distributed.get_rank() if is_distributed() else 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def wrap_model(model, device):
+    '''DistributedDataParallel around `model` (already on `device`) when distributed, else `model` itself'''
+    if not is_distributed():
+        return model
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids, output_device=device_ids[0] if device_ids else None)
@@ -0,0 +1,148 @@
+"""
+cache of frozen-encoder representations, stored as float16 memmaps
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+
+import file_lock
+
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_fingerprint(checkpoint_path, block_size=1 << 22):
+    '''
+    sha1 of the checkpoint file, so a retrained model never reuses stale vectors
+    '''
+    sha = hashlib.sha1()
+    with open(checkpoint_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def examples_fingerprint(examples):
+    '''
+    sha1 over (text_a, text_b, label) of every example, in the given order
+    '''
+    sha = hashlib.sha1()
+    for example in examples:
+        for field in (example.text_a, example.text_b, example.label):
+            sha.update(('' if field is None else field).encode('utf-8'))
+            sha.update(b'\x00')
+    return sha.hexdigest()
+
+
+def canonical_order(examples):
+    '''
+    a permutation of the examples that does not depend on how they were
+    shuffled or split by the caller (e.g. per-seed k-shot sampling)
+    '''
+    return sorted(range(len(examples)),
+                  key=lambda i: (examples[i].guid, examples[i].text_a, examples[i].text_b or '', examples[i].label))
+
+
+class CachedEmbeddings(object):
+    """Vectors of a set of examples, addressed by the caller's example positions."""
+
+    def __init__(self, vectors, rows):
+        self.vectors = vectors  # (#example, hidden) float16 memmap, canonical order
+        self.rows = rows  # caller position -> row of `vectors`
+
+    def __len__(self):
+        return len(self.rows)
+
+    def take(self, positions, device):
+        '''
+        positions: list/array/LongTensor of caller positions
+        return: (len(positions), hidden) float32 tensor on device
+        '''
+        if torch.is_tensor(positions):
+            positions = positions.cpu().numpy()
+        rows = self.rows[np.asarray(positions, dtype=np.int64)]
+        return torch.from_numpy(self.vectors[rows].astype(np.float32)).to(device)
+
+
+class EmbeddingCache(object):
+    """
+    Encodes each dataset once with a frozen encoder and keeps the vectors on
+    disk, keyed by checkpoint hash + dataset fingerprint + max_seq_length.
+    Parallel seeds share the cache: the first process that misses encodes the
+    dataset under a lock file, the others wait and load its result.
+
+    `model(input_ids, input_mask)` must return the vector as its first output,
+    as `RobertaForSequenceClassification` in the GFS/prototype scripts does.
+    """
+
+    def __init__(self, cache_dir, checkpoint_hash, max_seq_length, poll_seconds=10):
+        self.cache_dir = cache_dir
+        self.checkpoint_hash = checkpoint_hash
+        self.max_seq_length = max_seq_length
+        self.poll_seconds = poll_seconds
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path_for(self, name, data_hash):
+        key = hashlib.sha1('{}|{}|{}'.format(
+            self.checkpoint_hash, data_hash, self.max_seq_length).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '{}.{}.npy'.format(name, key))
+
+    def encode(self, name, examples, to_dataloader, model, device):
+        '''
+        name: readable prefix of the cache file, e.g. "MNLI.train"
+        to_dataloader: maps a list of examples to a *sequential* dataloader
+        return: CachedEmbeddings over `examples`
+        '''
+        order = canonical_order(examples)
+        if hasattr(examples, 'take'):
+            canonical_examples = examples.take(order)  # ExampleTable view, no per-row objects
+        else:
+            canonical_examples = [examples[i] for i in order]
+        path = self.path_for(name, examples_fingerprint(canonical_examples))
+
+        def build():
+            logger.info('encode %d examples into %s', len(examples), path)
+            self._write(path, canonical_examples, to_dataloader, model, device)
+
+        file_lock.build_once(path, lambda: os.path.exists(path), build, self.poll_seconds)
+        logger.info('load cached embeddings %s', path)
+        vectors = np.load(path, mmap_mode='r')
+        assert vectors.shape[0] == len(examples)
+
+        rows = np.empty(len(order), dtype=np.int64)
+        rows[np.asarray(order, dtype=np.int64)] = np.arange(len(order), dtype=np.int64)
+        return CachedEmbeddings(vectors, rows)
+
+    def _write(self, path, canonical_examples, to_dataloader, model, device):
+        '''write to a temporary file first, so `path` only ever holds a complete matrix'''
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        out = None
+        start = 0
+        model.eval()
+        for batch in to_dataloader(canonical_examples):
+            input_ids, input_mask = batch[0].to(device), batch[1].to(device)
+            with torch.no_grad():
+                reps = model(input_ids, input_mask)[0]
+            reps = reps.float().cpu().numpy()
+            if out is None:
+                out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                                shape=(len(canonical_examples), reps.shape[1]))
+            out[start:start + reps.shape[0]] = reps
+            start += reps.shape[0]
+        assert start == len(canonical_examples)
+        if out is None:
+            # no examples, no batch to take the hidden size from
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.zeros((0, 0), dtype=np.float16))
+        else:
+            out.flush()
+            del out
+        os.replace(tmp_path, path)
@@ -0,0 +1,155 @@
+"""
+the RoBERTa entailment classifier of the 2020 scripts (roberta_single + single_hidden2tag),
+rebuilt from a saved state_dict for inference outside a training script, e.g. the MNLI
+checkpoint `_acc_0.9040886899918633.pt` written by 2020/pretrain.on.MNLI.py
+"""
+
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+from transformers import RobertaConfig
+from transformers.modeling_roberta import RobertaModel
+from transformers.tokenization_roberta import RobertaTokenizer
+
+from batching import features_dataloader
+from example_table import Example
+from feature_cache import TokenizedFeatures
+from feature_conversion import convert_examples_to_features
+from tsv_reader import read_tsv
+
+
+logger = logging.getLogger(__name__)
+
+bert_hidden_dim = 1024
+pretrain_model_dir = 'roberta-large'
+
+'''the 3-way MNLI labels the checkpoint predicts; pred_id != 0 is not_entailment in the 2-way eval'''
+MNLI_LABELS = ["entailment", "neutral", "contradiction"]
+
+'''the 2-way label lists of the eval sets, entailment first'''
+EVAL_LABELS = {'rte': ["entailment", "not_entailment"],
+               'rte_test': ["entailment", "not_entailment"],
+               'scitail': ["entails", "neutral"]}
+
+
+class RobertaForSequenceClassification(nn.Module):
+    """
+    same modules and forward as the class of the 2020 scripts, so their state_dicts load as is;
+    load_pretrained=False builds the encoder from the config only, for when a checkpoint
+    overwrites every weight anyway
+    """
+    def __init__(self, tagset_size, pretrain_model_dir=pretrain_model_dir, load_pretrained=True):
+        super(RobertaForSequenceClassification, self).__init__()
+        self.tagset_size = tagset_size
+
+        if load_pretrained:
+            self.roberta_single= RobertaModel.from_pretrained(pretrain_model_dir)
+        else:
+            self.roberta_single= RobertaModel(RobertaConfig.from_pretrained(pretrain_model_dir))
+        self.single_hidden2tag = RobertaClassificationHead(self.roberta_single.config.hidden_size, tagset_size)
+
+    def forward(self, input_ids, input_mask):
+        outputs_single = self.roberta_single(input_ids, input_mask, None)
+        hidden_states_single = outputs_single[1] #(batch, hidden)
+
+        score_single = self.single_hidden2tag(hidden_states_single) #(batch, tag_set)
+        return score_single
+
+
+class RobertaClassificationHead(nn.Module):
+    """wenpeng overwrite it so to accept matrix as input"""
+
+    def __init__(self, bert_hidden_dim, num_labels):
+        super(RobertaClassificationHead, self).__init__()
+        self.dense = nn.Linear(bert_hidden_dim, bert_hidden_dim)
+        self.dropout = nn.Dropout(0.1)
+        self.out_proj = nn.Linear(bert_hidden_dim, num_labels)
+
+    def forward(self, features):
+        x = features#[:, 0, :]  # take <s> token (equiv. to [CLS])
+        x = self.dropout(x)
+        x = self.dense(x)
+        x = torch.tanh(x)
+        x = self.dropout(x)
+        x = self.out_proj(x)
+        return x
+
+
+def load_model(checkpoint, tagset_size=3, pretrain_model_dir=pretrain_model_dir):
+    '''
+    checkpoint: a `torch.save(model.state_dict(), ...)` file of the scripts' RobertaForSequenceClassification
+    return: the model on CPU, in eval mode
+    '''
+    model = RobertaForSequenceClassification(tagset_size, pretrain_model_dir, load_pretrained=False)
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    model.eval()
+    return model
+
+
+def load_tokenizer(pretrain_model_dir=pretrain_model_dir, do_lower_case=False):
+    return RobertaTokenizer.from_pretrained(pretrain_model_dir, do_lower_case=do_lower_case)
+
+
+def roberta_layout(tokenizer):
+    '''the layout arguments every 2020 script passes to convert_examples_to_features (and encode_pairs)'''
+    return dict(cls_token=tokenizer.cls_token,
+                cls_token_segment_id=0,
+                sep_token=tokenizer.sep_token,
+                sep_token_extra=True,
+                pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                pad_token_segment_id=0)
+
+
+def load_eval_examples(task, filename):
+    '''
+    task: 'rte' (GLUE RTE train/dev tsv), 'rte_test' (label, premise, hypothesis) or 'scitail' (tsv_format)
+    return: Examples with the labels of EVAL_LABELS[task]
+    '''
+    if task == 'rte':
+        rows = ((text_a, text_b, 'entailment' if label == 'entailment' else 'not_entailment')
+                for text_a, text_b, label in read_tsv(filename, columns=(1, 2, 3), skip_header=True))
+    elif task == 'rte_test':
+        rows = ((text_a, text_b, 'entailment' if label == '1' else 'not_entailment')
+                for label, text_a, text_b in read_tsv(filename, num_columns=3, strip_fields=False))
+    elif task == 'scitail':
+        rows = read_tsv(filename, num_columns=3)
+    else:
+        raise ValueError('unknown task {}'.format(task))
+    return [Example(guid='{}-{}'.format(task, i), text_a=text_a, text_b=text_b, label=label)
+            for i, (text_a, text_b, label) in enumerate(rows)]
+
+
+def examples_to_tokenized(examples, label_list, tokenizer, max_seq_length):
+    quiet = lambda done, total: None
+    layout = roberta_layout(tokenizer)
+    features = convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, 'classification',
+                                            progress_callback=quiet, **layout)
+    return TokenizedFeatures.from_features(features, max_seq_length, layout['pad_token'])
+
+
+def predict_logits(model, features, batch_size, device='cpu'):
+    '''(len(features), tagset_size) float32 logits, in feature order'''
+    logits = []
+    for input_ids, input_mask, _, _ in features_dataloader(features, batch_size):
+        with torch.no_grad():
+            logits.append(model(input_ids.to(device), input_mask.to(device)).float().cpu().numpy())
+    return np.concatenate(logits, 0)
+
+
+def collapse_2way(pred_label_ids_3way):
+    '''the eval loops' 2-way decision: entailment (0) stays 0, neutral and contradiction become 1'''
+    return (np.asarray(pred_label_ids_3way) != 0).astype(np.int64)
+
+
+def format_prediction(probs):
+    '''
+    probs: the 3-way softmax of one pair
+    return: the JSON-able prediction of the server and the scoring CLI, with the 2-way collapse of the eval loops
+    '''
+    pred_id = int(np.argmax(probs))
+    return {'label': MNLI_LABELS[pred_id],
+            'probs': {label: float(p) for label, p in zip(MNLI_LABELS, probs)},
+            'label_2way': 'entailment' if pred_id == 0 else 'not_entailment',
+            'probs_2way': {'entailment': float(probs[0]), 'not_entailment': float(1.0 - probs[0])}}
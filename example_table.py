@@ -0,0 +1,114 @@
+"""
+columnar storage of (text_a, text_b, label) examples, used instead of one
+InputExample object per row for the large MNLI training set
+"""
+
+import collections
+
+import numpy as np
+
+
+'''what indexing an ExampleTable returns; same attributes as InputExample, no per-row __dict__'''
+Example = collections.namedtuple('Example', ['guid', 'text_a', 'text_b', 'label'])
+
+
+class ExampleTable(object):
+    """
+    All texts live in one UTF-8 `bytes` buffer: the text_a of base row i is
+    buffer[offsets[2i]:offsets[2i+1]], its text_b is buffer[offsets[2i+1]:offsets[2i+2]].
+    Labels are int8 codes into `label_list`, guids are "<guid_prefix>-<base row>".
+
+    A table is a list of base rows over those shared columns, so slicing,
+    `take`, `+` and `partition_by_label` return views and never copy text.
+    Examples are decoded on access. A missing text_b is stored as ''.
+    """
+
+    def __init__(self, buffer, offsets, labels, label_list, guid_prefix, rows=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.labels = labels
+        self.label_list = label_list
+        self.guid_prefix = guid_prefix
+        self.rows = np.arange(len(labels), dtype=np.int64) if rows is None else rows
+
+    @classmethod
+    def from_rows(cls, rows, label_list, guid_prefix):
+        '''
+        rows: iterable of (text_a, text_b, label), e.g. a `read_tsv` generator
+        label_list: label order of the codes; labels not in it are appended
+        '''
+        label_list = list(label_list)
+        label_map = {label: i for i, label in enumerate(label_list)}
+        buffer = bytearray()
+        offsets = [0]
+        labels = bytearray()
+        for text_a, text_b, label in rows:
+            buffer += text_a.encode('utf-8')
+            offsets.append(len(buffer))
+            if text_b:
+                buffer += text_b.encode('utf-8')
+            offsets.append(len(buffer))
+            code = label_map.get(label)
+            if code is None:
+                code = label_map[label] = len(label_list)
+                label_list.append(label)
+                assert code < 128, 'too many distinct labels for int8 codes'
+            labels.append(code)
+        return cls(bytes(buffer), np.asarray(offsets, dtype=np.int64),
+                   np.frombuffer(bytes(labels), dtype=np.int8), label_list, guid_prefix)
+
+    def _view(self, rows):
+        return ExampleTable(self.buffer, self.offsets, self.labels, self.label_list, self.guid_prefix, rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._view(self.rows[index])
+        return self.example(int(self.rows[index]))
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.example(int(row))
+
+    def __add__(self, other):
+        '''concatenation of two views of the same table, like list + list'''
+        assert other.buffer is self.buffer, 'can only concatenate views of the same table'
+        return self._view(np.concatenate([self.rows, other.rows]))
+
+    def example(self, row):
+        '''decodes base row `row`'''
+        start, mid, end = self.offsets[2 * row:2 * row + 3]
+        return Example(guid='{}-{}'.format(self.guid_prefix, row),
+                       text_a=self.buffer[start:mid].decode('utf-8'),
+                       text_b=self.buffer[mid:end].decode('utf-8'),
+                       label=self.label_list[self.labels[row]])
+
+    def take(self, positions):
+        '''view of the examples at `positions` (relative to this view)'''
+        return self._view(self.rows[np.asarray(positions, dtype=np.int64)])
+
+    def label_ids(self, label_list=None):
+        '''
+        int64 label ids of the rows; by default the codes of `self.label_list`,
+        otherwise remapped to the positions in `label_list`
+        '''
+        codes = self.labels[self.rows].astype(np.int64)
+        if label_list is None:
+            return codes
+        label_map = {label: i for i, label in enumerate(label_list)}
+        remap = np.asarray([label_map.get(label, -1) for label in self.label_list], dtype=np.int64)
+        ids = remap[codes]
+        assert (ids >= 0).all(), 'labels missing from label_list'
+        return ids
+
+    def partition_by_label(self):
+        '''one view per entry of `label_list`, in row order'''
+        codes = self.labels[self.rows]
+        return [self._view(self.rows[codes == code]) for code in range(len(self.label_list))]
+
+    def without(self, *views):
+        '''view of the rows of this table that are in none of `views`, order kept'''
+        excluded = np.concatenate([view.rows for view in views]) if views else np.empty(0, dtype=np.int64)
+        return self._view(self.rows[~np.isin(self.rows, excluded)])
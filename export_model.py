@@ -0,0 +1,137 @@
+"""
+TorchScript export of the entailment classifier (roberta_single + single_hidden2tag) for CPU serving
+
+    python export_model.py --checkpoint MNLI_pretrained/_acc_0.9040886899918633.pt --output mnli.ts
+    python export_model.py --checkpoint ... --output mnli.int8.ts --quantize --benchmark
+
+The exported file holds the traced and frozen model; `load_exported` gives back a module
+with the same call, model(input_ids, input_mask) -> logits, that needs neither this
+repository's classes nor transformers. Every export is checked against the eager model
+on batches of other shapes than the tracing example.
+"""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from entailment_model import load_model
+from quantization import quantize_model
+
+
+logger = logging.getLogger(__name__)
+
+
+def example_inputs(vocab_size, batch_size, seq_length, seed=0):
+    '''random (input_ids, input_mask) starting with <s> (id 0), with a different amount of right padding per row'''
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(3, vocab_size, (batch_size, seq_length), generator=generator)
+    lengths = torch.randint(2, seq_length + 1, (batch_size,), generator=generator)
+    lengths[0] = seq_length
+    input_mask = (torch.arange(seq_length)[None, :] < lengths[:, None]).long()
+    input_ids[:, 0] = 0
+    input_ids[input_mask == 0] = 1
+    return input_ids, input_mask
+
+
+def export(model, output, max_seq_length=128):
+    '''traces the eval-mode `model` on a padded example batch, freezes it and saves it to `output`'''
+    model.eval()
+    inputs = example_inputs(model.roberta_single.config.vocab_size, 4, max_seq_length)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs)
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, output)
+    return traced
+
+
+def load_exported(path):
+    '''the exported model on CPU, used like RobertaForSequenceClassification: model(input_ids, input_mask)'''
+    model = torch.jit.load(path, map_location='cpu')
+    model.eval()
+    return model
+
+
+def load_inference_model(checkpoint=None, exported_model=None, quantize=False,
+                         pretrain_model_dir='roberta-large', tagset_size=3):
+    '''
+    the model for serving and scoring: an export_model.py file if `exported_model` is given,
+    otherwise the checkpoint, int8-quantized if asked; on CPU, in eval mode
+    '''
+    if exported_model:
+        return load_exported(exported_model)
+    model = load_model(checkpoint, tagset_size, pretrain_model_dir)
+    return quantize_model(model) if quantize else model
+
+
+def max_logit_difference(model, exported, vocab_size, shapes=((1, 7), (3, 33), (16, 128)), seed=1):
+    '''largest |logit| difference of the two models over random batches of the given (batch, length) shapes'''
+    difference = 0.0
+    for i, (batch_size, seq_length) in enumerate(shapes):
+        input_ids, input_mask = example_inputs(vocab_size, batch_size, seq_length, seed + i)
+        with torch.no_grad():
+            expected = model(input_ids, input_mask)
+            actual = exported(input_ids, input_mask)
+        difference = max(difference, (expected - actual).abs().max().item())
+    return difference
+
+
+def latency(model, input_ids, input_mask, repeats):
+    '''median seconds per call, after one warm-up call'''
+    times = []
+    with torch.no_grad():
+        model(input_ids, input_mask)
+        for _ in range(repeats):
+            start = time.time()
+            model(input_ids, input_mask)
+            times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def benchmark(model, exported, vocab_size, seq_length, batch_sizes=(1, 2, 4, 8, 16, 32, 64), repeats=10):
+    print('batch  eager ms  exported ms  speedup')
+    for batch_size in batch_sizes:
+        input_ids, input_mask = example_inputs(vocab_size, batch_size, seq_length)
+        eager_time = latency(model, input_ids, input_mask, repeats)
+        exported_time = latency(exported, input_ids, input_mask, repeats)
+        print('{:5d}  {:8.1f}  {:11.1f}  {:6.2f}x'.format(
+            batch_size, 1000 * eager_time, 1000 * exported_time, eager_time / exported_time))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='state_dict of the scripts\' RobertaForSequenceClassification')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--pretrain_model_dir', type=str, default='roberta-large')
+    parser.add_argument('--tagset_size', type=int, default=3)
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--quantize', action='store_true', help='export the int8 model of quantization.py')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time eager against exported for batch sizes 1 to 64 at max_seq_length')
+    parser.add_argument('--repeats', type=int, default=10, help='timed calls per batch size')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch.set_num_threads')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    model = load_model(args.checkpoint, args.tagset_size, args.pretrain_model_dir)
+    if args.quantize:
+        model = quantize_model(model)
+    vocab_size = model.roberta_single.config.vocab_size
+    export(model, args.output, args.max_seq_length)
+    exported = load_exported(args.output)
+    difference = max_logit_difference(model, exported, vocab_size)
+    logger.info('exported to %s, max |logit difference| to eager %.2e', args.output, difference)
+    assert difference < 1e-3, 'exported model does not reproduce the eager logits'
+    if args.benchmark:
+        benchmark(model, exported, vocab_size, args.max_seq_length, repeats=args.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+on-disk cache of tokenized features, so the parallel seeds of a run tokenize a dataset only once
+
+Each entry is a directory holding int32 token ids (all rows concatenated, no
+padding), uint16 lengths and segment-a lengths, the label ids and a
+manifest.json with the tokenization settings. `python feature_cache.py DIR`
+lists the entries of a cache directory.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+import file_lock
+from embedding_cache import examples_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+class TokenizedFeatures(object):
+    """
+    Row i has the token ids ids[offsets[i]:offsets[i+1]] (CLS ... SEP included);
+    its first a_lengths[i] tokens have segment id 0 and the rest segment id 1.
+    """
+
+    def __init__(self, ids, lengths, a_lengths, label_ids, max_seq_length, pad_token):
+        self.ids = ids
+        self.lengths = lengths
+        self.a_lengths = a_lengths
+        self.label_ids = label_ids
+        self.max_seq_length = max_seq_length
+        self.pad_token = pad_token
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def to_tensors(self):
+        '''
+        the padded (input_ids, input_mask, segment_ids, label_ids) LongTensors of all
+        rows, what convert_examples_to_features + torch.tensor used to produce
+        '''
+        return self.batch(np.arange(len(self)))
+
+    @classmethod
+    def from_features(cls, features, max_seq_length, pad_token):
+        '''from the InputFeatures list of convert_examples_to_features, without going through a cache'''
+        return cls(*features_to_arrays(features), max_seq_length=max_seq_length, pad_token=pad_token)
+
+    def batch(self, rows, trim=False):
+        '''
+        padded tensors of the rows `rows`, built from the ids and lengths of just those rows;
+        padded to max_seq_length, or with trim=True to the longest of these rows
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.lengths[rows].astype(np.int64)
+        seq_length = int(lengths.max()) if trim and len(rows) else self.max_seq_length
+        positions = np.arange(seq_length)
+        input_mask = positions[None, :] < lengths[:, None]
+        input_ids = np.full((len(rows), seq_length), self.pad_token, dtype=np.int64)
+        input_ids[input_mask] = self.ids[(self.offsets[rows][:, None] + positions[None, :])[input_mask]]
+        segment_ids = input_mask & (positions[None, :] >= self.a_lengths[rows].astype(np.int64)[:, None])
+        return (torch.from_numpy(input_ids), torch.from_numpy(input_mask.astype(np.int64)),
+                torch.from_numpy(segment_ids.astype(np.int64)), torch.from_numpy(np.array(self.label_ids[rows])))
+
+
+class PackedFeatureDataset(Dataset):
+    """
+    Dataset over TokenizedFeatures that keeps only the int32 ids and uint16
+    lengths (memory-mapped from the cache) and builds the padded
+    (input_ids, input_mask, segment_ids, label_ids) per batch in `collate`,
+    instead of holding four (N, max_seq_length) int64 tensors. With trim=True
+    each batch is only as long as its longest row (see batching.py).
+
+        DataLoader(dataset, sampler=..., batch_size=..., collate_fn=dataset.collate)
+    """
+
+    def __init__(self, features, trim=False):
+        self.features = features
+        self.trim = trim
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, index):
+        return index
+
+    def collate(self, indices):
+        return self.features.batch(indices, trim=self.trim)
+
+
+def features_to_arrays(features):
+    '''
+    features: InputFeatures padded on the right, pad segment id 0, segment ids 0..0 1..1
+    return: ids (int32), lengths (uint16), a_lengths (uint16), label_ids
+    '''
+    lengths = np.empty(len(features), dtype=np.uint16)
+    a_lengths = np.empty(len(features), dtype=np.uint16)
+    ids = []
+    for i, f in enumerate(features):
+        length = sum(f.input_mask)
+        segment_ids = f.segment_ids[:length]
+        a_length = segment_ids.index(1) if 1 in segment_ids else length
+        assert f.input_mask[:length] == [1] * length, 'only right padding is supported'
+        assert segment_ids[a_length:] == [1] * (length - a_length) and not any(f.segment_ids[length:])
+        lengths[i] = length
+        a_lengths[i] = a_length
+        ids.extend(f.input_ids[:length])
+    label_ids = np.asarray([f.label_id for f in features])
+    return np.asarray(ids, dtype=np.int32), lengths, a_lengths, label_ids
+
+
+class FeatureCache(object):
+    """
+    Keyed by tokenizer name, do_lower_case, max_seq_length, sep_token_extra,
+    pad token, label list and the examples (in order). The first process that
+    misses builds the entry under a lock file; the others wait and load it.
+    """
+
+    def __init__(self, cache_dir, tokenizer_name, do_lower_case, max_seq_length,
+                 sep_token_extra=True, pad_token=1, poll_seconds=10):
+        self.cache_dir = cache_dir
+        self.settings = {'format_version': FORMAT_VERSION,
+                         'tokenizer_name': tokenizer_name,
+                         'do_lower_case': bool(do_lower_case),
+                         'max_seq_length': max_seq_length,
+                         'sep_token_extra': bool(sep_token_extra),
+                         'pad_token': pad_token}
+        self.poll_seconds = poll_seconds
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def manifest_for(self, name, examples, label_list):
+        manifest = dict(self.settings)
+        manifest.update({'name': name,
+                         'label_list': list(label_list),
+                         'examples_sha1': examples_fingerprint(examples),
+                         'num_examples': len(examples)})
+        return manifest
+
+    def path_for(self, manifest):
+        key = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '{}.{}'.format(manifest['name'], key))
+
+    def load_or_build(self, name, examples, label_list, convert):
+        '''
+        convert: maps the examples to a list of InputFeatures, only called on a miss
+        return: TokenizedFeatures of `examples`
+        '''
+        manifest = self.manifest_for(name, examples, label_list)
+        path = self.path_for(manifest)
+
+        def build():
+            logger.info('tokenize %d examples into %s', len(examples), path)
+            self._write(path, manifest, convert(examples))
+
+        file_lock.build_once(path, lambda: os.path.exists(os.path.join(path, MANIFEST)), build, self.poll_seconds)
+        logger.info('load cached features %s', path)
+        return load(path)
+
+    def _write(self, path, manifest, features):
+        ids, lengths, a_lengths, label_ids = features_to_arrays(features)
+        assert len(lengths) == manifest['num_examples']
+        manifest = dict(manifest, num_tokens=int(len(ids)), created=time.strftime('%Y-%m-%d %H:%M:%S'))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for array_name, array in [('ids', ids), ('lengths', lengths), ('a_lengths', a_lengths), ('label_ids', label_ids)]:
+            np.save(os.path.join(tmp_path, array_name + '.npy'), array)
+        with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+def load(path):
+    '''memory-maps a cache entry'''
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    arrays = [np.load(os.path.join(path, array_name + '.npy'), mmap_mode='r')
+              for array_name in ['ids', 'lengths', 'a_lengths', 'label_ids']]
+    return TokenizedFeatures(*arrays, max_seq_length=manifest['max_seq_length'], pad_token=manifest['pad_token'])
+
+
+if __name__ == '__main__':
+    cache_dir = sys.argv[1]
+    for entry in sorted(os.listdir(cache_dir)):
+        manifest_path = os.path.join(cache_dir, entry, MANIFEST)
+        if not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        print('{}\t{} examples\t{} tokens\t{} lower={} max_len={} sep_extra={}\t{}'.format(
+            entry, manifest['num_examples'], manifest['num_tokens'], manifest['tokenizer_name'],
+            manifest['do_lower_case'], manifest['max_seq_length'], manifest['sep_token_extra'], manifest['created']))
@@ -0,0 +1,355 @@
+"""
+the RoBERTa pair -> features conversion shared by the 2020 scripts, and a
+multi-process version of it for the large MNLI training set
+"""
+
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+
+from example_table import Example
+
+
+logger = logging.getLogger(__name__)
+
+
+def log_progress(done, total):
+    logger.info("Writing example %d of %d" % (done, total))
+
+
+class InputFeatures(object):
+    """A single set of features of data."""
+
+    def __init__(self, input_ids, input_mask, segment_ids, label_id):
+        self.input_ids = input_ids
+        self.input_mask = input_mask
+        self.segment_ids = segment_ids
+        self.label_id = label_id
+
+
+def convert_examples_to_features(examples, label_list, max_seq_length,
+                                 tokenizer, output_mode,
+                                 cls_token_at_end=False,
+                                 cls_token='[CLS]',
+                                 cls_token_segment_id=1,
+                                 sep_token='[SEP]',
+                                 sep_token_extra=False,
+                                 pad_on_left=False,
+                                 pad_token=0,
+                                 pad_token_segment_id=0,
+                                 sequence_a_segment_id=0,
+                                 sequence_b_segment_id=1,
+                                 mask_padding_with_zero=True,
+                                 progress_callback=None,
+                                 progress_every=10000):
+    """ Loads a data file into a list of `InputBatch`s
+        `cls_token_at_end` define the location of the CLS token:
+            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
+            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
+        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `progress_callback(done, total)` is called every `progress_every` examples, by default it logs
+    """
+    if progress_callback is None:
+        progress_callback = log_progress
+
+    label_map = {label : i for i, label in enumerate(label_list)}
+
+    features = []
+    for (ex_index, example) in enumerate(examples):
+        if ex_index % progress_every == 0:
+            progress_callback(ex_index, len(examples))
+
+        tokens_a = tokenizer.tokenize(example.text_a)
+
+        tokens_b = None
+        if example.text_b:
+            tokens_b = tokenizer.tokenize(example.text_b)
+            # Modifies `tokens_a` and `tokens_b` in place so that the total
+            # length is less than the specified length.
+            # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
+            special_tokens_count = 4 if sep_token_extra else 3
+            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - special_tokens_count)
+        else:
+            # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
+            special_tokens_count = 3 if sep_token_extra else 2
+            if len(tokens_a) > max_seq_length - special_tokens_count:
+                tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
+
+        # The convention in BERT is:
+        # (a) For sequence pairs:
+        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
+        # (b) For single sequences:
+        #  tokens:   [CLS] the dog is hairy . [SEP]
+        #  type_ids:   0   0   0   0  0     0   0
+        #
+        # Where "type_ids" are used to indicate whether this is the first
+        # sequence or the second sequence. The embedding vectors for `type=0` and
+        # `type=1` were learned during pre-training and are added to the wordpiece
+        # embedding vector (and position vector). This is not *strictly* necessary
+        # since the [SEP] token unambiguously separates the sequences, but it makes
+        # it easier for the model to learn the concept of sequences.
+        #
+        # For classification tasks, the first vector (corresponding to [CLS]) is
+        # used as as the "sentence vector". Note that this only makes sense because
+        # the entire model is fine-tuned.
+        tokens = tokens_a + [sep_token]
+        if sep_token_extra:
+            # roberta uses an extra separator b/w pairs of sentences
+            tokens += [sep_token]
+        segment_ids = [sequence_a_segment_id] * len(tokens)
+
+        if tokens_b:
+            tokens += tokens_b + [sep_token]
+            segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
+
+        if cls_token_at_end:
+            tokens = tokens + [cls_token]
+            segment_ids = segment_ids + [cls_token_segment_id]
+        else:
+            tokens = [cls_token] + tokens
+            segment_ids = [cls_token_segment_id] + segment_ids
+
+        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+
+        # The mask has 1 for real tokens and 0 for padding tokens. Only real
+        # tokens are attended to.
+        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
+
+        # Zero-pad up to the sequence length.
+        padding_length = max_seq_length - len(input_ids)
+        if pad_on_left:
+            input_ids = ([pad_token] * padding_length) + input_ids
+            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
+            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
+        else:
+            input_ids = input_ids + ([pad_token] * padding_length)
+            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
+            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
+
+        assert len(input_ids) == max_seq_length
+        assert len(input_mask) == max_seq_length
+        assert len(segment_ids) == max_seq_length
+
+        if output_mode == "classification":
+            label_id = label_map[example.label]
+        elif output_mode == "regression":
+            label_id = float(example.label)
+        else:
+            raise KeyError(output_mode)
+
+        # if ex_index < 5:
+        #     logger.info("*** Example ***")
+        #     logger.info("guid: %s" % (example.guid))
+        #     logger.info("tokens: %s" % " ".join(
+        #             [str(x) for x in tokens]))
+        #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
+        #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
+        #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+        #     logger.info("label: %s (id = %d)" % (example.label, label_id))
+
+        features.append(
+                InputFeatures(input_ids=input_ids,
+                              input_mask=input_mask,
+                              segment_ids=segment_ids,
+                              label_id=label_id))
+    return features
+
+def _truncate_seq_pair(tokens_a, tokens_b, max_length):
+    """Truncates a sequence pair in place to the maximum length."""
+
+    # This is a simple heuristic which will always truncate the longer sequence
+    # one token at a time. This makes more sense than truncating an equal percent
+    # of tokens from each, since if one sequence is very short then each token
+    # that's truncated likely contains more information than a longer sequence.
+    while True:
+        total_length = len(tokens_a) + len(tokens_b)
+        if total_length <= max_length:
+            break
+        if len(tokens_a) > len(tokens_b):
+            tokens_a.pop()
+        else:
+            tokens_b.pop()
+
+
+def truncated_pair_lengths(len_a, len_b, max_length):
+    '''
+    closed form of _truncate_seq_pair for arrays of lengths: the longer side
+    loses tokens until both are equal, then b and a lose one in turn, b first
+    '''
+    len_a = np.asarray(len_a, dtype=np.int64)
+    len_b = np.asarray(len_b, dtype=np.int64)
+    excess = np.maximum(len_a + len_b - max_length, 0)
+    diff = np.abs(len_a - len_b)
+    rest = np.maximum(excess - diff, 0)
+    base = np.minimum(len_a, len_b)
+    a_longer = len_a > len_b
+    new_a = np.where(excess <= diff, np.where(a_longer, len_a - excess, len_a), base - rest // 2)
+    new_b = np.where(excess <= diff, np.where(a_longer, len_b, len_b - excess), base - (rest - rest // 2))
+    return new_a, new_b
+
+
+def encode_pairs(pairs, tokenizer, max_seq_length,
+                 cls_token='[CLS]',
+                 cls_token_segment_id=1,
+                 sep_token='[SEP]',
+                 sep_token_extra=False,
+                 pad_token=0,
+                 pad_token_segment_id=0,
+                 sequence_a_segment_id=0,
+                 sequence_b_segment_id=1):
+    '''
+    pairs: list of (text_a, text_b), text_b may be None
+    return: input_ids, input_mask, segment_ids as (len(pairs), max_seq_length) int64 arrays,
+            the same layout convert_examples_to_features builds with the CLS token
+            in front and right padding: CLS a SEP [SEP] b SEP PAD ...
+    '''
+    n = len(pairs)
+    tokens_a = [tokenizer.tokenize(text_a) for text_a, _ in pairs]
+    tokens_b = [tokenizer.tokenize(text_b) if text_b else None for _, text_b in pairs]
+    has_b = np.asarray([t is not None for t in tokens_b], dtype=bool)
+    len_a = np.asarray([len(t) for t in tokens_a], dtype=np.int64)
+    len_b = np.asarray([len(t) if t is not None else 0 for t in tokens_b], dtype=np.int64)
+
+    num_sep_a = 2 if sep_token_extra else 1
+    pair_a, pair_b = truncated_pair_lengths(len_a, len_b, max_seq_length - num_sep_a - 2)
+    single_a = np.minimum(len_a, max_seq_length - num_sep_a - 1)
+    len_a = np.where(has_b, pair_a, single_a)
+    len_b = np.where(has_b, pair_b, 0)
+    # as in convert_examples_to_features, b that ends up empty gets no segment (and no SEP)
+    len_b_part = np.where(len_b > 0, len_b + 1, 0)
+    a_part = 1 + len_a + num_sep_a
+    lengths = a_part + len_b_part
+
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+    input_ids = np.full((n, max_seq_length), pad_token, dtype=np.int64)
+    positions = np.arange(max_seq_length)
+    input_mask = (positions[None, :] < lengths[:, None]).astype(np.int64)
+    segment_ids = np.full((n, max_seq_length), pad_token_segment_id, dtype=np.int64)
+    segment_ids[positions[None, :] < a_part[:, None]] = sequence_a_segment_id
+    segment_ids[(positions[None, :] >= a_part[:, None]) & (input_mask == 1)] = sequence_b_segment_id
+    segment_ids[:, 0] = cls_token_segment_id
+    # the real tokens of all rows back to back, scattered into the padded array at once
+    flat_ids = []
+    for tokens, la, b, lb in zip(tokens_a, len_a.tolist(), tokens_b, len_b.tolist()):
+        flat_ids.append(cls_id)
+        flat_ids.extend(tokenizer.convert_tokens_to_ids(tokens[:la]))
+        flat_ids.extend([sep_id] * num_sep_a)
+        if lb > 0:
+            flat_ids.extend(tokenizer.convert_tokens_to_ids(b[:lb]))
+            flat_ids.append(sep_id)
+    input_ids[input_mask == 1] = flat_ids
+    return input_ids, input_mask, segment_ids
+
+
+def batched_convert_examples_to_features(examples, label_list, max_seq_length,
+                                         tokenizer, output_mode,
+                                         batch_size=1000,
+                                         progress_callback=None,
+                                         **kwargs):
+    '''
+    convert_examples_to_features through encode_pairs, `batch_size` examples at a time;
+    kwargs: the layout arguments of encode_pairs. Returns the same InputFeatures.
+    '''
+    if progress_callback is None:
+        progress_callback = log_progress
+    label_map = {label : i for i, label in enumerate(label_list)}
+    features = []
+    batch = []
+    for example in examples:
+        batch.append(example)
+        if len(batch) == batch_size:
+            _append_features(features, batch, label_map, max_seq_length, tokenizer, output_mode, kwargs)
+            progress_callback(len(features), len(examples))
+            batch = []
+    if batch:
+        _append_features(features, batch, label_map, max_seq_length, tokenizer, output_mode, kwargs)
+        progress_callback(len(features), len(examples))
+    return features
+
+
+def _append_features(features, batch, label_map, max_seq_length, tokenizer, output_mode, kwargs):
+    input_ids, input_mask, segment_ids = encode_pairs(
+        [(example.text_a, example.text_b) for example in batch], tokenizer, max_seq_length, **kwargs)
+    for example, ids, mask, segments in zip(batch, input_ids.tolist(), input_mask.tolist(), segment_ids.tolist()):
+        if output_mode == "classification":
+            label_id = label_map[example.label]
+        elif output_mode == "regression":
+            label_id = float(example.label)
+        else:
+            raise KeyError(output_mode)
+        features.append(InputFeatures(input_ids=ids, input_mask=mask, segment_ids=segments, label_id=label_id))
+
+
+_worker_state = {}
+
+
+def _init_worker(label_list, max_seq_length, tokenizer, output_mode, kwargs):
+    _worker_state['args'] = (label_list, max_seq_length, tokenizer, output_mode)
+    _worker_state['kwargs'] = kwargs
+
+
+def _encode_pairs_kwargs(kwargs):
+    '''the encode_pairs arguments for a convert_examples_to_features call, None if its layout is not supported'''
+    kwargs = dict(kwargs)
+    if kwargs.pop('cls_token_at_end', False) or kwargs.pop('pad_on_left', False) or not kwargs.pop('mask_padding_with_zero', True):
+        return None
+    return kwargs
+
+
+def _convert_chunk(rows):
+    '''rows: (text_a, text_b, label) tuples, cheaper to send than example objects'''
+    examples = [Example(None, text_a, text_b, label) for text_a, text_b, label in rows]
+    quiet = lambda done, total: None
+    encode_kwargs = _encode_pairs_kwargs(_worker_state['kwargs'])
+    if encode_kwargs is None:
+        return convert_examples_to_features(examples, *_worker_state['args'],
+                                            progress_callback=quiet, **_worker_state['kwargs'])
+    return batched_convert_examples_to_features(examples, *_worker_state['args'],
+                                                progress_callback=quiet, **encode_kwargs)
+
+
+def parallel_convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, output_mode,
+                                          num_workers=None, chunk_size=2000, progress_callback=None, **kwargs):
+    '''
+    same output as convert_examples_to_features, computed by `num_workers` processes
+    (default: all cores) over consecutive chunks of `chunk_size` examples; the
+    chunks are collected in order. `progress_callback(done, total)` runs after every chunk.
+    kwargs: the keyword arguments of convert_examples_to_features
+    '''
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, (len(examples) + chunk_size - 1) // chunk_size)
+    if num_workers <= 1:
+        encode_kwargs = _encode_pairs_kwargs(kwargs)
+        if encode_kwargs is None:
+            return convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, output_mode,
+                                                progress_callback=progress_callback, **kwargs)
+        return batched_convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, output_mode,
+                                                    progress_callback=progress_callback, **encode_kwargs)
+    if progress_callback is None:
+        progress_callback = log_progress
+
+    def chunks():
+        rows = []
+        for example in examples:
+            rows.append((example.text_a, example.text_b, example.label))
+            if len(rows) == chunk_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    logger.info('converting %d examples with %d workers', len(examples), num_workers)
+    features = []
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                initargs=(label_list, max_seq_length, tokenizer, output_mode, kwargs))
+    try:
+        for chunk_features in pool.imap(_convert_chunk, chunks()):
+            features.extend(chunk_features)
+            progress_callback(len(features), len(examples))
+    finally:
+        pool.terminate()
+    return features
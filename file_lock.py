@@ -0,0 +1,59 @@
+"""
+lock files on a shared cache directory, so that of the parallel seeds of a run only one
+builds a cache entry while the others wait for it and then load it
+"""
+
+import logging
+import os
+import socket
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def acquire(lock_path):
+    '''True if this process created `lock_path`; a stale lock of a dead process on this host is removed'''
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        break_stale_lock(lock_path)
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write('{} {}'.format(socket.gethostname(), os.getpid()))
+    return True
+
+
+def break_stale_lock(lock_path):
+    '''a lock left by a dead process on this host would block every later run'''
+    try:
+        with open(lock_path) as f:
+            host, pid = f.read().split()
+        if host != socket.gethostname():
+            return
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        logger.warning('removing stale lock %s', lock_path)
+        os.remove(lock_path)
+    except (OSError, ValueError):
+        # lock vanished, is half written, or belongs to another user
+        pass
+
+
+def build_once(path, exists, build, poll_seconds=10):
+    '''
+    path: the cache entry, locked through path + '.lock'
+    exists(): whether the entry is complete
+    build(): writes the entry, called by the one process that holds the lock
+    '''
+    lock_path = path + '.lock'
+    while not exists():
+        if acquire(lock_path):
+            try:
+                if not exists():
+                    build()
+            finally:
+                os.remove(lock_path)
+        else:
+            logger.info('waiting for another process to build %s', path)
+            time.sleep(poll_seconds)
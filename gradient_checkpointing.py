@@ -0,0 +1,47 @@
+"""
+gradient checkpointing for the transformers 2.1 BertModel / RobertaModel encoders, which
+have no built-in switch for it
+
+    enable_gradient_checkpointing(model.roberta_single)
+
+In training mode each encoder layer then keeps only its input for the backward pass and
+runs its forward a second time when the gradients reach it: activation memory drops from
+O(layers x batch x seq_length x (hidden + heads x seq_length)) to about one layer's worth,
+for roughly one extra forward pass per step. Eval and no_grad forwards are unchanged, and
+so are the parameter names, so state_dicts load and save as before.
+"""
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+class CheckpointedLayer(object):
+    '''mixed into the class of each encoder layer by enable_gradient_checkpointing'''
+
+    def forward(self, *inputs):
+        layer_forward = super(CheckpointedLayer, self).forward
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(layer_forward, *inputs, use_reentrant=False)
+        return layer_forward(*inputs)
+
+
+_checkpointed_classes = {}
+
+
+def _checkpointed_class(cls):
+    if issubclass(cls, CheckpointedLayer):
+        return cls
+    if cls not in _checkpointed_classes:
+        _checkpointed_classes[cls] = type('Checkpointed' + cls.__name__, (CheckpointedLayer, cls), {})
+    return _checkpointed_classes[cls]
+
+
+def enable_gradient_checkpointing(encoder_model):
+    '''
+    encoder_model: a BertModel / RobertaModel (e.g. roberta_single); its layers are switched in place
+    return: the number of checkpointed layers
+    '''
+    layers = encoder_model.encoder.layer
+    for layer in layers:
+        layer.__class__ = _checkpointed_class(layer.__class__)
+    return len(layers)
@@ -2,9 +2,15 @@
 jsonlines implementation
 """
 
+import array
 import numbers
 import io
+import itertools
 import json
+import mmap
+import multiprocessing
+import os
+import struct
 
 import six
 
@@ -19,6 +25,32 @@ TYPE_MAPPING = {
     bool: bool,
 }
 
+#: Faster JSON decoders tried, in order, when ``loads='auto'``.
+FAST_BACKENDS = ('orjson', 'ujson')
+
+
+def find_loads(loads=None):
+    """
+    Resolve the `loads` argument of :py:class:`Reader`.
+
+    ``None`` or ``'json'`` is the standard ``json.loads``; ``'auto'``
+    is the first importable backend of :py:data:`FAST_BACKENDS`,
+    falling back to ``json.loads``; any other string names a module
+    whose ``loads`` is used. Callables are returned unchanged.
+    """
+    if loads is None or loads == 'json':
+        return json.loads
+    if callable(loads):
+        return loads
+    names = FAST_BACKENDS if loads == 'auto' else (loads,)
+    for name in names:
+        try:
+            return __import__(name).loads
+        except ImportError:
+            if loads != 'auto':
+                raise
+    return json.loads
+
 
 class Error(Exception):
     """Base error class."""
@@ -46,11 +78,17 @@ class InvalidLineError(Error, ValueError):
     lineno = None
 
     def __init__(self, msg, line, lineno):
+        self.reason = msg
         msg = "{} (line {})".format(msg, lineno)
         self.line = line.rstrip()
         self.lineno = lineno
         super(InvalidLineError, self).__init__(msg)
 
+    def __reduce__(self):
+        # Rebuild from the parts, so the error survives being sent back
+        # from a decode worker of read_file().
+        return (type(self), (self.reason, self.line, self.lineno))
+
 
 class ReaderWriterBase(object):
     """
@@ -100,10 +138,19 @@ class Reader(ReaderWriterBase):
 
     The `loads` argument can be used to replace the standard json
     decoder. If specified, it must be a callable that accepts a
-    (unicode) string and returns the decoded object.
+    (unicode) string and returns the decoded object, or a backend name
+    understood by :py:func:`find_loads`, e.g. ``'auto'``.
 
     Instances are iterable and can be used as a context manager.
 
+    A reader returned by ``open(name, index=True)`` also has random
+    access through a :py:class:`LineIndex`: ``len(reader)`` is the
+    number of lines, ``reader[i]`` decodes line ``i`` (0-based, empty
+    lines included), ``reader[i:j]`` returns a list, and
+    :py:meth:`~Reader.shard()` reads one contiguous part of the file.
+    These read the memory-mapped file and do not move the iteration
+    position.
+
     :param file-like iterable: iterable yielding lines as strings
     :param callable loads: custom json decoder callable
     """
@@ -111,9 +158,9 @@ class Reader(ReaderWriterBase):
         self._fp = iterable
         self._should_close_fp = False
         self._closed = False
-        if loads is None:
-            loads = json.loads
-        self._loads = loads
+        self._index = None
+        self._mmap = None
+        self._loads = find_loads(loads)
         self._line_iter = enumerate(iterable, 1)
 
     def read(self, type=None, allow_none=False, skip_empty=False):
@@ -146,6 +193,9 @@ class Reader(ReaderWriterBase):
         except StopIteration:
             six.raise_from(EOFError, None)
 
+        return self._decode(lineno, line, type, allow_none)
+
+    def _decode(self, lineno, line, type, allow_none):
         if isinstance(line, six.binary_type):
             try:
                 line = line.decode('utf-8')
@@ -179,6 +229,64 @@ class Reader(ReaderWriterBase):
 
         return value
 
+    def read_block(self, size=10000, type=None, allow_none=False,
+                   skip_empty=False, skip_invalid=False):
+        """
+        Read and decode up to `size` lines at once.
+
+        Returns a list of the decoded values, which is shorter than
+        `size` only at the end of the input (empty once it is reached).
+        Lines are checked exactly as by :py:meth:`~Reader.read()`, and
+        an invalid line raises :py:exc:`InvalidLineError` with its line
+        number, unless `skip_invalid` is set; skipped empty and invalid
+        lines do not count towards `size`.
+        """
+        if self._closed:
+            raise RuntimeError('reader is closed')
+        if type is not None and type not in TYPE_MAPPING:
+            raise ValueError("invalid type specified")
+
+        values = []
+        append = values.append
+        decode = self._decode
+        while len(values) < size:
+            block = list(itertools.islice(
+                self._line_iter, size - len(values)))
+            if not block:
+                break
+            for lineno, line in block:
+                if skip_empty and not line.rstrip():
+                    continue
+                try:
+                    append(decode(lineno, line, type, allow_none))
+                except InvalidLineError:
+                    if not skip_invalid:
+                        raise
+        return values
+
+    def iter_blocks(self, block_size=10000, **kwargs):
+        """
+        Iterate over the input as lists of up to `block_size` values.
+
+        See :py:meth:`~Reader.read_block()` for the other arguments.
+        """
+        while True:
+            values = self.read_block(block_size, **kwargs)
+            if not values:
+                return
+            yield values
+
+    def read_all(self, **kwargs):
+        """
+        Read and decode all remaining lines into a list.
+
+        See :py:meth:`~Reader.read_block()` for the arguments.
+        """
+        values = []
+        for block in self.iter_blocks(**kwargs):
+            values.extend(block)
+        return values
+
     def iter(self, type=None, allow_none=False, skip_empty=False,
              skip_invalid=False):
         """
@@ -214,6 +322,84 @@ class Reader(ReaderWriterBase):
         """
         return self.iter()
 
+    def _attach_index(self, name, index):
+        with io.open(name, 'rb') as fp:
+            if index.offsets[-1]:
+                self._mmap = mmap.mmap(
+                    fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mmap = b''
+        self._index = index
+
+    def close(self):
+        super(Reader, self).close()
+        if self._mmap is not None and not isinstance(self._mmap, bytes):
+            self._mmap.close()
+        self._mmap = None
+
+    def _check_index(self):
+        if self._closed:
+            raise RuntimeError('reader is closed')
+        if self._index is None:
+            raise TypeError(
+                'random access needs a reader opened with index=True')
+
+    def __len__(self):
+        self._check_index()
+        return len(self._index)
+
+    def get(self, i, type=None, allow_none=False):
+        """
+        Decode line `i` (0-based).
+
+        See :py:meth:`~Reader.read()` for the other arguments; errors
+        report the line number ``i + 1``.
+        """
+        self._check_index()
+        if type is not None and type not in TYPE_MAPPING:
+            raise ValueError("invalid type specified")
+        n = len(self._index)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('line index out of range')
+        offsets = self._index.offsets
+        line = self._mmap[offsets[i]:offsets[i + 1]]
+        return self._decode(i + 1, line, type, allow_none)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            self._check_index()
+            return [self.get(j) for j in range(*i.indices(len(self)))]
+        return self.get(i)
+
+    def shard(self, rank, world_size, type=None, allow_none=False,
+              skip_empty=False, skip_invalid=False):
+        """
+        Iterate over the lines of part `rank` of `world_size`.
+
+        The file is cut into `world_size` contiguous parts with equal
+        numbers of lines (up to one), so every worker of a job can read
+        its part without scanning the lines before it. See
+        :py:meth:`~Reader.read_block()` for the other arguments.
+        """
+        self._check_index()
+        if not 0 <= rank < world_size:
+            raise ValueError("rank must be in [0, world_size)")
+        n = len(self._index)
+        start = n * rank // world_size
+        end = n * (rank + 1) // world_size
+        offsets = self._index.offsets
+        for i in range(start, end):
+            line = self._mmap[offsets[i]:offsets[i + 1]]
+            if skip_empty and not line.rstrip():
+                continue
+            try:
+                yield self._decode(i + 1, line, type, allow_none)
+            except InvalidLineError:
+                if not skip_invalid:
+                    raise
+
 
 class Writer(ReaderWriterBase):
     """
@@ -230,6 +416,9 @@ class Writer(ReaderWriterBase):
     For more control, provide a a custom encoder callable using the
     `dumps` argument. The callable must produce (unicode) string output.
     If specified, the `compact` and `sort` arguments will be ignored.
+    ``dumps='auto'`` uses ``orjson`` when it is installed and `compact`
+    is set, since it only produces compact output, and the standard
+    encoder otherwise.
 
     When the `flush` argument is set to ``True``, the writer will call
     ``fp.flush()`` after each written line.
@@ -251,6 +440,8 @@ class Writer(ReaderWriterBase):
             self._fp_is_binary = False
         except TypeError:
             self._fp_is_binary = True
+        if dumps == 'auto':
+            dumps = _fast_dumps(sort_keys) if compact else None
         if dumps is None:
             encoder_kwargs = dict(ensure_ascii=False, sort_keys=sort_keys)
             if compact:
@@ -281,23 +472,190 @@ class Writer(ReaderWriterBase):
             self._fp.write(b'\n')
         else:
             if not isinstance(line, six.text_type):
-                line = line.decode('ascii')  # For Python 2.
+                line = line.decode('utf-8')  # Python 2, or orjson.
             self._fp.write(line)
             self._fp.write(u'\n')
         if self._flush:
             self._fp.flush()
 
-    def write_all(self, iterable):
+    def write_all(self, iterable, block_size=1000):
         """
         Encode and write multiple objects.
 
+        Objects are encoded `block_size` at a time and each block is
+        written with a single ``.write()`` call (and flushed, if
+        `flush` is set), instead of two calls per object.
+
         :param iterable: an iterable of objects
+        :param int block_size: number of objects per write
         """
-        for obj in iterable:
-            self.write(obj)
+        if self._closed:
+            raise RuntimeError('writer is closed')
+        iterator = iter(iterable)
+        while True:
+            lines = [self._dumps(obj)
+                     for obj in itertools.islice(iterator, block_size)]
+            if not lines:
+                return
+            if self._fp_is_binary:
+                lines = [line if isinstance(line, six.binary_type)
+                         else line.encode('utf-8') for line in lines]
+                lines.append(b'')
+                self._fp.write(b'\n'.join(lines))
+            else:
+                lines = [line if isinstance(line, six.text_type)
+                         else line.decode('utf-8') for line in lines]
+                lines.append(u'')
+                self._fp.write(u'\n'.join(lines))
+            if self._flush:
+                self._fp.flush()
+
+
+def _fast_dumps(sort_keys):
+    try:
+        import orjson
+    except ImportError:
+        return None
+    option = orjson.OPT_SORT_KEYS if sort_keys else 0
+    return lambda obj: orjson.dumps(obj, option=option)
+
+
+def _read_range(args):
+    name, start, end, first_lineno, loads, kwargs = args
+    with io.open(name, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    lines = data.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    reader = Reader(lines, loads=loads)
+    reader._line_iter = enumerate(lines, first_lineno)
+    return reader.read_all(**kwargs)
+
+
+def read_file(name, num_workers=None, chunk_size=1 << 25, loads='auto',
+              **kwargs):
+    """
+    Read and decode a whole jsonlines file, using several processes.
+
+    The file is cut at line boundaries into chunks of about
+    `chunk_size` bytes, which `num_workers` processes (default: the
+    number of CPUs, at most one per chunk) decode in parallel with
+    :py:meth:`Reader.read_all()`. The values are returned in file order
+    and errors report the line number in the whole file, as when
+    reading it with a single :py:class:`Reader`.
+
+    `loads` must be a backend name (see :py:func:`find_loads`) so the
+    workers can resolve it; the other keyword arguments are those of
+    :py:meth:`Reader.read_block()`.
+
+    :param str name: name of the file to read
+    :param int num_workers: number of decode processes
+    :param int chunk_size: approximate number of bytes per chunk
+    """
+    size = os.path.getsize(name)
+    ranges = []
+    first_lineno = 1
+    with io.open(name, 'rb') as fp:
+        start = 0
+        while start < size:
+            fp.seek(min(start + chunk_size, size))
+            fp.readline()
+            end = min(fp.tell(), size)
+            ranges.append((name, start, end, first_lineno, loads, kwargs))
+            fp.seek(start)
+            first_lineno += fp.read(end - start).count(b'\n')
+            start = end
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, len(ranges))
+    if num_workers <= 1:
+        blocks = [_read_range(r) for r in ranges]
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            blocks = pool.map(_read_range, ranges, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [value for block in blocks for value in block]
 
 
-def open(name, mode='r', **kwargs):
+class LineIndex(object):
+    """
+    Byte offsets of the lines of a jsonlines file.
+
+    Line ``i`` is ``data[offsets[i]:offsets[i + 1]]``, newline
+    included; a last line without a newline counts as a line. The index
+    is stored next to the file (``<name>.idx`` by default) as a small
+    header with the size and modification time of the file it was built
+    from, followed by the int64 offsets, and is rebuilt when the file
+    has changed.
+    """
+
+    MAGIC = b'JSONLIDX'
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, offsets):
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def build(cls, name, chunk_size=1 << 24):
+        """Scan the file `name` for newlines."""
+        offsets = array.array('q', [0])
+        position = 0
+        with io.open(name, 'rb') as fp:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                lines = chunk.split(b'\n')
+                for line in lines[:-1]:
+                    position += len(line) + 1
+                    offsets.append(position)
+                position += len(lines[-1])
+        if position != offsets[-1]:
+            offsets.append(position)
+        return cls(offsets)
+
+    @classmethod
+    def load_or_build(cls, name, index_path=None):
+        """
+        Load the sidecar index of `name`, or build it and try to store
+        it (a read-only directory just means it is rebuilt next time).
+        """
+        if index_path is None:
+            index_path = name + '.idx'
+        stat = os.stat(name)
+        key = (stat.st_size, stat.st_mtime_ns)
+        try:
+            with io.open(index_path, 'rb') as fp:
+                magic, size, mtime_ns, count = cls.HEADER.unpack(
+                    fp.read(cls.HEADER.size))
+                if magic == cls.MAGIC and (size, mtime_ns) == key:
+                    offsets = array.array('q')
+                    offsets.fromfile(fp, count)
+                    return cls(offsets)
+        except (IOError, OSError, EOFError, struct.error):
+            pass
+        index = cls.build(name)
+        tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+        try:
+            with io.open(tmp_path, 'wb') as fp:
+                fp.write(cls.HEADER.pack(
+                    cls.MAGIC, key[0], key[1], len(index.offsets)))
+                index.offsets.tofile(fp)
+            os.replace(tmp_path, index_path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return index
+
+
+def open(name, mode='r', index=False, index_path=None, **kwargs):
     """
     Open a jsonlines file for reading or writing.
 
@@ -318,16 +676,32 @@ def open(name, mode='r', **kwargs):
         with jsonlines.open('out.jsonl', mode='w') as writer:
             writer.write(...)
 
+    With ``index=True`` (reading only), the reader also gets random
+    access through the sidecar :py:class:`LineIndex` of the file, which
+    is built and stored on first use (at `index_path`, by default
+    ``name + '.idx'``).
+
     :param file-like fp: name of the file to open
     :param str mode: whether to open the file for reading (``r``),
         writing (``w``) or appending (``a``).
+    :param bool index: whether to load or build the line index
+    :param str index_path: where the line index is stored
     :param \*\*kwargs: additional arguments, forwarded to the reader or writer
     """
     if mode not in {'r', 'w', 'a'}:
         raise ValueError("'mode' must be either 'r', 'w', or 'a'")
+    if index and mode != 'r':
+        raise ValueError("'index' is only supported for reading")
     fp = io.open(name, mode=mode + 't', encoding='utf-8')
     if mode == 'r':
         instance = Reader(fp, **kwargs)
+        if index:
+            try:
+                instance._attach_index(
+                    name, LineIndex.load_or_build(name, index_path))
+            except Exception:
+                fp.close()
+                raise
     else:
         instance = Writer(fp, **kwargs)
     instance._should_close_fp = True
@@ -0,0 +1,59 @@
+"""
+stratified k-shot sampling over integer row indices
+"""
+
+import random
+
+import numpy as np
+
+
+class StratifiedKShotSampler(object):
+    """
+    Partitions the rows of a dataset by label once, as int64 index arrays in
+    row order, so support sets and their complement are index operations.
+
+    Drawing uses `rng.sample(range(n), k)` per label, which consumes the
+    random state exactly like the old `random.sample(examples_of_label, k)`,
+    so a given seed still picks the same examples.
+    """
+
+    def __init__(self, labels, label_list):
+        '''
+        labels: one label per row (list or array, e.g. ExampleTable.labels codes)
+        label_list: the labels to stratify over, in the order results are returned
+        '''
+        labels = np.asarray(labels)
+        self.num_rows = len(labels)
+        self.label_list = list(label_list)
+        self.rows_by_label = [np.flatnonzero(labels == label) for label in self.label_list]
+
+    def sizes(self):
+        return [len(rows) for rows in self.rows_by_label]
+
+    def sample(self, k_shot, sampling_seed=None, clamp=False):
+        '''
+        k_shot rows of every label, drawn with random.Random(sampling_seed),
+        or with the global `random` state if no seed is given
+        clamp: take all rows of a label that has fewer than k_shot
+        return: one index array per label
+        '''
+        rng = random if sampling_seed is None else random.Random(sampling_seed)
+        support = []
+        for rows in self.rows_by_label:
+            k = min(k_shot, len(rows)) if clamp else k_shot
+            support.append(rows[np.asarray(rng.sample(range(len(rows)), k), dtype=np.int64)])
+        return support
+
+    def complement(self, support):
+        '''
+        rows of the stratified labels not in `support` (index arrays), grouped by
+        label in label_list order and in row order within a label
+        '''
+        keep = np.ones(self.num_rows, dtype=bool)
+        for rows in support:
+            keep[rows] = False
+        return np.concatenate([rows[keep[rows]] for rows in self.rows_by_label])
+
+    def all_rows(self):
+        '''every row of the stratified labels, grouped by label'''
+        return np.concatenate(self.rows_by_label)
@@ -0,0 +1,73 @@
+"""
+starts N processes of a training script on this machine for distributed_training.py
+
+    python launch_distributed.py --nproc 4 2020/pretrain.on.MNLI.py --no_cuda --do_train ...
+    python launch_distributed.py --nproc 2 --threads_per_process 8 2020/RTE/k.shot.STILTS.py --no_cuda ...
+
+Each process gets RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT in its
+environment (what torchrun sets), and OMP_NUM_THREADS so the processes share the CPU
+cores instead of oversubscribing them. If one process fails, the others are stopped.
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nproc', type=int, required=True, help='processes to start')
+    parser.add_argument('--master_port', type=int, default=None, help='default: a free port')
+    parser.add_argument('--threads_per_process', type=int, default=None,
+                        help='OMP_NUM_THREADS of each process (default: CPU cores / nproc)')
+    parser.add_argument('script', type=str)
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    threads = args.threads_per_process or max(1, (os.cpu_count() or 1) // args.nproc)
+    base_env = dict(os.environ, MASTER_ADDR='127.0.0.1', MASTER_PORT=str(args.master_port or free_port()),
+                    WORLD_SIZE=str(args.nproc))
+    if args.threads_per_process or 'OMP_NUM_THREADS' not in os.environ:
+        base_env['OMP_NUM_THREADS'] = str(threads)
+
+    processes = []
+    for rank in range(args.nproc):
+        env = dict(base_env, RANK=str(rank), LOCAL_RANK=str(rank))
+        processes.append(subprocess.Popen([sys.executable, '-u', args.script] + args.script_args, env=env))
+
+    returncode = 0
+    try:
+        while processes:
+            for process in list(processes):
+                code = process.poll()
+                if code is None:
+                    continue
+                processes.remove(process)
+                if code != 0:
+                    returncode = code
+                    for other in processes:
+                        other.terminate()
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        returncode = 1
+    finally:
+        for process in processes:
+            process.wait()
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+load generator for serve_model.py: `concurrency` client threads send /predict requests for
+`duration` seconds, then the client-side latency and throughput and the server's /metrics are printed
+
+    python load_generator.py --port 8008 --concurrency 16 --duration 30
+    python load_generator.py --unix_socket /tmp/entail.sock --pairs_file glue_data/RTE/dev.tsv --pairs_per_request 4
+"""
+
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+
+import numpy as np
+
+from serve_model import UnixHTTPConnection
+from tsv_reader import read_tsv
+
+
+WORDS = ('a man is playing a guitar on the stage while the crowd watches quietly '
+         'nobody is outside the house and the dog sleeps in the sun').split()
+
+
+def synthetic_pairs(n, seed=0):
+    rng = random.Random(seed)
+    return [(' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 40))),
+             ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 15)))) for _ in range(n)]
+
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    return http.client.HTTPConnection(args.host, args.port, timeout=60)
+
+
+def request(connection, method, path, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    headers = {'Content-Type': 'application/json'} if data is not None else {}
+    connection.request(method, path, body=data, headers=headers)
+    response = connection.getresponse()
+    payload = json.loads(response.read().decode('utf-8'))
+    if response.status != 200:
+        raise RuntimeError('{} {}: {}'.format(response.status, path, payload))
+    return payload
+
+
+def client(args, pairs, seed, deadline, latencies, errors):
+    rng = random.Random(seed)
+    connection = connect(args)
+    while time.time() < deadline:
+        body = {'pairs': [list(rng.choice(pairs)) for _ in range(args.pairs_per_request)]}
+        start = time.time()
+        try:
+            predictions = request(connection, 'POST', '/predict', body)['predictions']
+            assert len(predictions) == args.pairs_per_request
+            latencies.append(time.time() - start)
+        except Exception as e:
+            errors.append(repr(e))
+            connection.close()
+            connection = connect(args)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--unix_socket', type=str, default=None)
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads, one request in flight each')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--pairs_per_request', type=int, default=1)
+    parser.add_argument('--pairs_file', type=str, default=None,
+                        help='GLUE-style tsv (index, sentence1, sentence2, ...) to draw pairs from; synthetic otherwise')
+    args = parser.parse_args()
+
+    if args.pairs_file:
+        pairs = [tuple(row) for row in read_tsv(args.pairs_file, columns=(1, 2), skip_header=True)]
+    else:
+        pairs = synthetic_pairs(1000)
+    request(connect(args), 'GET', '/health')
+
+    latencies, errors = [], []
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=client, args=(args, pairs, seed, deadline, latencies, errors))
+               for seed in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies_ms = 1000 * np.asarray(latencies) if latencies else np.zeros(1)
+    print('{} requests ({} pairs) in {:.1f}s from {} clients, {} errors'.format(
+        len(latencies), len(latencies) * args.pairs_per_request, elapsed, args.concurrency, len(errors)))
+    print('{:.1f} requests/sec, {:.1f} pairs/sec'.format(
+        len(latencies) / elapsed, len(latencies) * args.pairs_per_request / elapsed))
+    print('client latency ms: p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  max {:.1f}'.format(
+        *[np.percentile(latencies_ms, q) for q in (50, 90, 99, 100)]))
+    for error in errors[:5]:
+        print('error:', error)
+    print('server metrics:', json.dumps(request(connect(args), 'GET', '/metrics'), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+autocast mixed precision for the training and eval loops of the 2020 scripts
+
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+    with precision.autocast():
+        logits = model(input_ids, input_mask)
+        loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
+    precision.backward(loss)
+    precision.step(optimizer)
+
+The weights and the optimizer state stay fp32; matmuls and convolutions inside
+`autocast()` run in fp16 or bf16. fp16 needs a GPU and scales the loss so that small
+gradients do not underflow; bf16 has the fp32 exponent range and needs no scaling.
+`--fp16` on a CPU-only machine falls back to bf16.
+"""
+
+import contextlib
+import logging
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+class MixedPrecision(object):
+    '''
+    device: the device the model is on
+    loss_scale: 0 for dynamic fp16 loss scaling, a positive power of 2 for a fixed starting scale
+        that is never grown (it is still halved when a step overflows)
+    '''
+
+    def __init__(self, device, fp16=False, bf16=False, loss_scale=0):
+        self.device_type = torch.device(device).type
+        if fp16 and bf16:
+            raise ValueError('choose one of fp16 and bf16')
+        if fp16 and self.device_type != 'cuda':
+            logger.warning('fp16 autocast needs a GPU, using bf16 on %s instead', self.device_type)
+            fp16, bf16 = False, True
+        if fp16:
+            self.name, self.dtype = 'fp16', torch.float16
+        elif bf16:
+            self.name, self.dtype = 'bf16', torch.bfloat16
+        else:
+            self.name, self.dtype = 'fp32', None
+
+        self.scaler = None
+        if fp16:
+            if loss_scale:
+                self.scaler = torch.cuda.amp.GradScaler(init_scale=loss_scale, growth_interval=2**31 - 1)
+            else:
+                self.scaler = torch.cuda.amp.GradScaler()
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    def autocast(self):
+        '''context for forward passes (and the loss); a no-op in fp32'''
+        if not self.enabled:
+            return contextlib.suppress()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def step(self, optimizer):
+        '''optimizer.step(); with fp16 the gradients are unscaled first and steps with inf/nan gradients are skipped'''
+        if self.scaler is not None:
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
+
+    def __str__(self):
+        if self.scaler is not None:
+            return '{} (loss scale {})'.format(self.name, self.scaler.get_scale())
+        return self.name
@@ -0,0 +1,140 @@
+"""
+partial fine-tuning of the entailment classifier: the embeddings and the bottom N encoder
+layers are frozen, their output is computed once per example and cached, and training
+and evaluation only run the top layers
+
+    freeze_bottom_layers(model.roberta_single, args.freeze_layers)
+    classifier = TopLayersClassifier(model, args.freeze_layers)
+    layer_cache = FrozenLayerCache(model.roberta_single, args.freeze_layers, precision)
+    train_dataloader = layer_cache.dataloader(train_dataloader, device)
+    for hidden_states, input_mask, segment_ids, label_ids in train_dataloader:
+        logits = classifier(hidden_states, input_mask)
+
+The frozen layers run in eval mode (no dropout) when the cache is built. The cache keeps
+the hidden states of the real tokens only, as fp32 on the CPU: len(features) x mean length
+x hidden x 4 bytes, about 300 MB per 1000 RTE pairs for roberta-large.
+"""
+
+import contextlib
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+
+
+def _extended_attention_mask(input_mask, dtype):
+    '''the additive attention mask BertModel.forward builds from input_mask'''
+    return (1.0 - input_mask[:, None, None, :].to(dtype)) * -10000.0
+
+
+def freeze_bottom_layers(encoder_model, num_layers):
+    '''
+    encoder_model: a BertModel / RobertaModel (e.g. roberta_single)
+    return: the number of frozen parameters
+    '''
+    frozen = [encoder_model.embeddings] + list(encoder_model.encoder.layer[:num_layers])
+    count = 0
+    for module in frozen:
+        for parameter in module.parameters():
+            parameter.requires_grad = False
+            count += parameter.numel()
+    return count
+
+
+def bottom_hidden_states(encoder_model, num_layers, input_ids, input_mask):
+    '''the output of encoder layer `num_layers` (the embeddings for 0), (batch, seq_length, hidden)'''
+    hidden_states = encoder_model.embeddings(input_ids)
+    attention_mask = _extended_attention_mask(input_mask, hidden_states.dtype)
+    for layer in encoder_model.encoder.layer[:num_layers]:
+        hidden_states = layer(hidden_states, attention_mask, None)[0]
+    return hidden_states
+
+
+def top_pooled_output(encoder_model, num_layers, hidden_states, input_mask):
+    '''continues from bottom_hidden_states to the pooled output, outputs[1] of encoder_model(input_ids, input_mask)'''
+    attention_mask = _extended_attention_mask(input_mask, hidden_states.dtype)
+    for layer in encoder_model.encoder.layer[num_layers:]:
+        hidden_states = layer(hidden_states, attention_mask, None)[0]
+    return encoder_model.pooler(hidden_states)
+
+
+class TopLayersClassifier(nn.Module):
+    '''
+    model: the scripts' RobertaForSequenceClassification (roberta_single + single_hidden2tag)
+    forward: (cached hidden states of layer num_frozen, input_mask) -> the logits of model(input_ids, input_mask)
+    '''
+
+    def __init__(self, model, num_frozen):
+        super(TopLayersClassifier, self).__init__()
+        self.model = model
+        self.num_frozen = num_frozen
+
+    def forward(self, hidden_states, input_mask):
+        pooled_output = top_pooled_output(self.model.roberta_single, self.num_frozen, hidden_states, input_mask)
+        return self.model.single_hidden2tag(pooled_output)
+
+
+class CachedHiddenStateDataset(Dataset):
+    """
+    Like PackedFeatureDataset, but `collate` yields the cached hidden states in place of the
+    input_ids: (hidden_states, input_mask, segment_ids, label_ids), padded with zeros to the
+    longest row of the batch. Padded positions are masked out as attention keys and never
+    reach the pooled output, so zeros give the same logits as the real padding activations.
+    """
+
+    def __init__(self, features, hidden_states):
+        self.features = features
+        self.hidden_states = hidden_states
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, index):
+        return index
+
+    def collate(self, indices):
+        _, input_mask, segment_ids, label_ids = self.features.batch(indices, trim=True)
+        rows = np.asarray(indices, dtype=np.int64)
+        positions = torch.from_numpy(self.features.offsets[rows][:, None]) + torch.arange(input_mask.shape[1])[None, :]
+        keep = input_mask.bool()
+        hidden_states = torch.zeros(input_mask.shape + (self.hidden_states.shape[1],), dtype=self.hidden_states.dtype)
+        hidden_states[keep] = self.hidden_states[positions[keep]]
+        return hidden_states, input_mask, segment_ids, label_ids
+
+
+class FrozenLayerCache(object):
+    '''computes the frozen layers' output once per TokenizedFeatures and serves it batch by batch'''
+
+    def __init__(self, encoder_model, num_layers, precision=None, batch_size=32):
+        self.encoder_model = encoder_model
+        self.num_layers = num_layers
+        self.precision = precision
+        self.batch_size = batch_size
+
+    def encode(self, features, device):
+        '''(total tokens of `features`, hidden) float32, the rows of example i at features.offsets[i]:offsets[i+1]'''
+        hidden_size = self.encoder_model.config.hidden_size
+        cached = torch.empty((int(features.offsets[-1]), hidden_size), dtype=torch.float32)
+        was_training = self.encoder_model.training
+        self.encoder_model.eval()
+        for start in range(0, len(features), self.batch_size):
+            rows = np.arange(start, min(start + self.batch_size, len(features)))
+            input_ids, input_mask, _, _ = features.batch(rows, trim=True)
+            with torch.no_grad(), (self.precision.autocast() if self.precision is not None else contextlib.suppress()):
+                hidden_states = bottom_hidden_states(self.encoder_model, self.num_layers,
+                                                     input_ids.to(device), input_mask.to(device))
+            keep = input_mask.bool()
+            cached[int(features.offsets[start]):int(features.offsets[rows[-1] + 1])] = hidden_states.float().cpu()[keep]
+        self.encoder_model.train(was_training)
+        return cached
+
+    def dataloader(self, dataloader, device):
+        '''
+        dataloader: a features_dataloader (its dataset holds the TokenizedFeatures)
+        return: a DataLoader with the same batches (and batch sampler, so restore_order and
+                set_epoch keep working) over the cached hidden states
+        '''
+        features = dataloader.dataset.features
+        dataset = CachedHiddenStateDataset(features, self.encode(features, device))
+        return DataLoader(dataset, batch_sampler=dataloader.batch_sampler, collate_fn=dataset.collate)
@@ -0,0 +1,105 @@
+"""
+the PrototypeNet of 2020/*/k.shot.GFS.Entail.py, and a factorized, query-chunked scoring path for it
+
+PrototypeNet.forward pairs every query q with every class prototype c and feeds
+[c, q, c*q, c-q], a (batch*#class, 4*hidden) tensor, to HiddenLayer_1. Splitting
+its weight into the column blocks W = [W_c | W_q | W_m | W_d] gives
+
+    HiddenLayer_1([c, q, c*q, c-q]) = (W_c + W_d) c + (W_q - W_d) q + W_m (c*q) + b
+
+so the class term is computed once per class, the query term once per query, and only
+W_m (c*q), with a hidden-wide instead of a 4*hidden-wide input, per pair: a quarter of the
+layer-1 multiply-adds. The residual connections and the layers above still need a
+(pairs, 4*hidden) activation, so queries are scored `chunk_size` at a time; under
+no_grad (evaluation) memory is then bounded by chunk_size * #class * 4 * hidden
+whatever the number of queries. With autograd every chunk is kept for backward.
+
+PrototypeNet(hidden_size, scoring_chunk_size) takes this path when scoring_chunk_size > 0.
+tests/test_prototype_scoring.py checks it against PrototypeNet's pairwise forward;
+benchmark_prototype_scoring.py times both.
+"""
+
+import torch
+import torch.nn as nn
+
+
+def _layer_1_terms(net, rep_classes, hidden_size):
+    weight = net.HiddenLayer_1.weight
+    w_c, w_q, w_m, w_d = [weight[:, i * hidden_size:(i + 1) * hidden_size] for i in range(4)]
+    class_term = torch.nn.functional.linear(rep_classes, w_c + w_d, net.HiddenLayer_1.bias) #(#class, 4*hidden)
+    return class_term, w_q - w_d, w_m
+
+
+def factorized_prototype_scores(net, rep_classes, rep_query_batch, chunk_size=None):
+    '''
+    net: a PrototypeNet (HiddenLayer_1..5, dropout)
+    rep_classes: (#class*2, hidden_size), 3 come from MNLI, 3 from the target
+    rep_query_batch: (batch_size, hidden_size)
+    chunk_size: queries scored at a time, None for all at once
+    return: (batch_size, 3), the score_matrix of net(rep_classes, rep_query_batch)
+    '''
+    class_size, hidden_size = rep_classes.shape
+    class_term, w_query, w_product = _layer_1_terms(net, rep_classes, hidden_size)
+    chunk_size = chunk_size or max(rep_query_batch.shape[0], 1)
+
+    score_chunks = []
+    for start in range(0, rep_query_batch.shape[0], chunk_size):
+        rep_query = rep_query_batch[start:start + chunk_size] #(chunk, hidden)
+        chunk = rep_query.shape[0]
+        query_term = torch.nn.functional.linear(rep_query, w_query) #(chunk, 4*hidden)
+        product = rep_classes[None, :, :] * rep_query[:, None, :] #(chunk, #class, hidden)
+        pre_1 = torch.nn.functional.linear(product, w_product) + query_term[:, None, :] + class_term[None, :, :]
+
+        classes = rep_classes[None, :, :].expand(chunk, -1, -1)
+        queries = rep_query[:, None, :].expand(-1, class_size, -1)
+        combined_rep = torch.cat([classes, queries, product, classes - queries], dim=2) #(chunk, #class, 4*hidden)
+
+        output_1 = net.dropout(torch.tanh(pre_1)) + combined_rep
+        output_2 = net.dropout(torch.tanh(net.HiddenLayer_2(output_1))) + output_1
+        output_3 = net.dropout(torch.tanh(net.HiddenLayer_3(output_2)))
+        output_4 = net.dropout(torch.tanh(net.HiddenLayer_4(output_3)))
+        all_scores = torch.sigmoid(net.HiddenLayer_5(output_4)).view(chunk, class_size)
+        score_chunks.append(all_scores[:, :3] + all_scores[:, -3:])
+    return torch.cat(score_chunks, dim=0)
+
+
+class PrototypeNet(nn.Module):
+    def __init__(self, hidden_size, scoring_chunk_size=0):
+        super(PrototypeNet, self).__init__()
+        '''>0: score with factorized_prototype_scores, that many queries at a time'''
+        self.scoring_chunk_size = scoring_chunk_size
+        self.HiddenLayer_1 = nn.Linear(4*hidden_size, 4*hidden_size)
+        self.HiddenLayer_2 = nn.Linear(4*hidden_size, 4*hidden_size)
+        self.HiddenLayer_3 = nn.Linear(4*hidden_size, 2*hidden_size)
+        self.HiddenLayer_4 = nn.Linear(2*hidden_size, hidden_size)
+        self.HiddenLayer_5 = nn.Linear(hidden_size, 1)
+        self.dropout = nn.Dropout(0.1)
+
+    def forward(self, rep_classes,rep_query_batch):
+        '''
+        rep_classes: (#class*2, hidden_size), 3 comes from MNLI, 3 comes from target
+        rep_query_batch: (batch_size, hidden_size)
+        '''
+        if self.scoring_chunk_size:
+            return factorized_prototype_scores(self, rep_classes, rep_query_batch, self.scoring_chunk_size)
+        class_size = rep_classes.shape[0]
+        batch_size = rep_query_batch.shape[0]
+        repeat_rep_classes = rep_classes.repeat(batch_size, 1)
+        repeat_rep_query = torch.repeat_interleave(rep_query_batch, repeats=class_size, dim=0)
+        combined_rep = torch.cat([repeat_rep_classes, repeat_rep_query, repeat_rep_classes*repeat_rep_query, repeat_rep_classes-repeat_rep_query], dim=1) #(#class*batch, 3*hidden)
+
+        output_1 = self.dropout(torch.tanh(self.HiddenLayer_1(combined_rep))) +combined_rep
+        output_2 = self.dropout(torch.tanh(self.HiddenLayer_2(output_1))) +output_1
+        output_3 = self.dropout(torch.tanh(self.HiddenLayer_3(output_2)))
+        output_4 = self.dropout(torch.tanh(self.HiddenLayer_4(output_3)))
+        all_scores = torch.sigmoid(self.HiddenLayer_5(output_4))
+
+
+
+
+
+        # all_scores = torch.sigmoid(self.HiddenLayer_3(self.dropout(torch.tanh(self.HiddenLayer_2(self.dropout(torch.tanh(self.HiddenLayer_1(combined_rep)))))))) #(#class*batch, 1)
+
+        score_matrix_to_fold = all_scores.view(-1, class_size) #(batch_size, class_size*2)
+        score_matrix = score_matrix_to_fold[:,:3]+score_matrix_to_fold[:, -3:]#(batch_size, class_size)
+        return score_matrix
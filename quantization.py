@@ -0,0 +1,101 @@
+"""
+int8 dynamic quantization of the entailment classifier for CPU-only evaluation, and a tool
+that reports its accuracy drift against the fp32 checkpoint and the examples/sec of both
+
+    python quantization.py --checkpoint MNLI_pretrained/_acc_0.9040886899918633.pt \
+        --task rte --eval_file glue_data/RTE/dev.tsv
+    python quantization.py --checkpoint ... --task scitail --eval_file SciTailV1/tsv_format/scitail_1.0_dev.tsv
+"""
+
+import argparse
+import io
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from scipy.special import softmax
+
+from entailment_model import (EVAL_LABELS, collapse_2way, examples_to_tokenized, load_eval_examples,
+                              load_model, load_tokenizer, predict_logits)
+
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_model(model):
+    '''
+    a copy of `model` whose nn.Linear layers (attention, feed-forward, pooler and
+    RobertaClassificationHead) have int8 weights and quantize their inputs per batch;
+    embeddings and LayerNorm stay fp32. CPU only.
+    '''
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def state_dict_megabytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def timed_logits(model, features, batch_size):
+    '''logits and examples/sec; one batch is run before timing'''
+    input_ids, input_mask, _, _ = features.batch(np.arange(min(batch_size, len(features))), trim=True)
+    with torch.no_grad():
+        model(input_ids, input_mask)
+    start = time.time()
+    logits = predict_logits(model, features, batch_size)
+    return logits, len(features) / (time.time() - start)
+
+
+def report(name, logits, gold_2way, speed, megabytes):
+    pred_3way = np.argmax(softmax(logits, axis=1), axis=1)
+    acc = (collapse_2way(pred_3way) == gold_2way).mean()
+    print('{:5} acc {:.4f}  {:8.1f} examples/sec  {:7.1f} MB'.format(name, acc, speed, megabytes))
+    return acc, pred_3way
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='state_dict of the scripts\' RobertaForSequenceClassification')
+    parser.add_argument('--task', type=str, default='rte', choices=sorted(EVAL_LABELS))
+    parser.add_argument('--eval_file', type=str, required=True)
+    parser.add_argument('--pretrain_model_dir', type=str, default='roberta-large')
+    parser.add_argument('--tagset_size', type=int, default=3)
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--limit', type=int, default=None, help='only the first N examples')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    label_list = EVAL_LABELS[args.task]
+    examples = load_eval_examples(args.task, args.eval_file)[:args.limit]
+    tokenizer = load_tokenizer(args.pretrain_model_dir)
+    features = examples_to_tokenized(examples, label_list, tokenizer, args.max_seq_length)
+    gold_2way = np.asarray(features.label_ids)
+    print('{} examples of {}, {} threads'.format(len(examples), args.eval_file, torch.get_num_threads()))
+
+    model = load_model(args.checkpoint, args.tagset_size, args.pretrain_model_dir)
+    fp32_logits, fp32_speed = timed_logits(model, features, args.batch_size)
+    fp32_acc, fp32_3way = report('fp32', fp32_logits, gold_2way, fp32_speed, state_dict_megabytes(model))
+
+    model = quantize_model(model)
+    int8_logits, int8_speed = timed_logits(model, features, args.batch_size)
+    int8_acc, int8_3way = report('int8', int8_logits, gold_2way, int8_speed, state_dict_megabytes(model))
+
+    prob_diff = np.abs(softmax(int8_logits, axis=1) - softmax(fp32_logits, axis=1)).max(axis=1)
+    print('accuracy drift {:+.4f}, speedup {:.2f}x'.format(int8_acc - fp32_acc, int8_speed / fp32_speed))
+    print('agreement 3-way {:.4f}, 2-way {:.4f}'.format(
+        (int8_3way == fp32_3way).mean(), (collapse_2way(int8_3way) == collapse_2way(fp32_3way)).mean()))
+    print('max |prob diff| mean {:.4f}, max {:.4f}'.format(prob_diff.mean(), prob_diff.max()))
+
+
+if __name__ == '__main__':
+    main()
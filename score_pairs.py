@@ -0,0 +1,219 @@
+"""
+streaming batch scoring of premise/hypothesis files with a trained checkpoint
+
+    python score_pairs.py --checkpoint MNLI_pretrained/_acc_0.9040886899918633.pt \
+        --input corpus.tsv --premise_field 1 --hypothesis_field 2 --skip_header --output corpus.pred.jsonl
+    python score_pairs.py --exported_model mnli.int8.ts --input pairs.jsonl \
+        --premise_field sentence1 --hypothesis_field sentence2 --id_field pairID --output pairs.pred.jsonl
+
+The input is read lazily in chunks of `chunk_size` pairs; `num_workers` processes tokenize
+the next chunks while the model scores the current one, with at most `prefetch_chunks`
+chunks in flight, so memory does not grow with the file. Every scored chunk is appended to
+the output (one format_prediction line per pair, plus "index", the position of the pair
+among the pairs read, and "id" if --id_field is given) and flushed. Rerunning the same command
+after an interruption drops a partially written last line, skips the pairs already in
+the output and continues.
+"""
+
+import argparse
+import collections
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import torch
+
+import jsonlines
+from entailment_model import format_prediction, load_tokenizer, roberta_layout
+from export_model import load_inference_model
+from feature_conversion import encode_pairs
+from tsv_reader import read_tsv
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_pairs(path, input_format, premise_field, hypothesis_field, id_field=None, skip_header=False):
+    '''
+    lazily yields (id, premise, hypothesis); id is None without id_field
+    tsv fields are column indices, jsonl fields are keys
+    '''
+    if input_format == 'tsv':
+        columns = [int(premise_field), int(hypothesis_field)] + ([int(id_field)] if id_field is not None else [])
+        for row in read_tsv(path, columns=columns, skip_header=skip_header):
+            yield (row[2] if id_field is not None else None), row[0], row[1]
+    else:
+        with jsonlines.open(path, loads='auto') as reader:
+            for row in reader.iter(type=dict):
+                yield (row.get(id_field) if id_field is not None else None), row[premise_field], row[hypothesis_field]
+
+
+def completed_lines(output):
+    '''number of complete lines of `output`, after cutting off a partially written last line'''
+    if not os.path.exists(output):
+        return 0
+    count = 0
+    last_newline = 0
+    with io.open(output, 'rb') as f:
+        position = 0
+        while True:
+            chunk = f.read(1 << 24)
+            if not chunk:
+                break
+            newlines = chunk.count(b'\n')
+            if newlines:
+                count += newlines
+                last_newline = position + chunk.rfind(b'\n') + 1
+            position += len(chunk)
+    if last_newline != position:
+        logger.warning('dropping a partially written line at the end of %s', output)
+        with io.open(output, 'r+b') as f:
+            f.truncate(last_newline)
+    return count
+
+
+_worker_state = {}
+
+
+def _init_worker(pretrain_model_dir, max_seq_length):
+    tokenizer = load_tokenizer(pretrain_model_dir)
+    _worker_state['args'] = (tokenizer, max_seq_length)
+    _worker_state['layout'] = roberta_layout(tokenizer)
+
+
+def _tokenize_chunk(pairs):
+    '''input_ids (int32) trimmed to the longest pair of the chunk, and the lengths'''
+    tokenizer, max_seq_length = _worker_state['args']
+    input_ids, input_mask, _ = encode_pairs(pairs, tokenizer, max_seq_length, **_worker_state['layout'])
+    lengths = input_mask.sum(1)
+    return input_ids[:, :int(lengths.max())].astype(np.int32), lengths
+
+
+class _Inline(object):
+    '''stands in for an AsyncResult when tokenizing in the main process (num_workers=0)'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def score_chunk(model, input_ids, lengths, batch_size, pad_token, device):
+    '''3-way probabilities in chunk order; batches are formed over the pairs sorted by length'''
+    order = np.argsort(lengths, kind='stable')
+    probs = np.empty((len(lengths), 3), dtype=np.float32)
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        seq_length = int(lengths[rows].max())
+        ids = torch.from_numpy(input_ids[rows, :seq_length].astype(np.int64))
+        mask = (torch.arange(seq_length)[None, :] < torch.from_numpy(lengths[rows])[:, None]).long()
+        ids[mask == 0] = pad_token
+        with torch.no_grad():
+            logits = model(ids.to(device), mask.to(device))
+        probs[rows] = torch.softmax(logits.float(), dim=1).cpu().numpy()
+    return probs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='state_dict of the scripts\' RobertaForSequenceClassification')
+    parser.add_argument('--exported_model', type=str, default=None, help='a file written by export_model.py')
+    parser.add_argument('--quantize', action='store_true', help='score with the int8 model of quantization.py')
+    parser.add_argument('--pretrain_model_dir', type=str, default='roberta-large')
+    parser.add_argument('--input', type=str, required=True)
+    parser.add_argument('--input_format', type=str, default=None, choices=['tsv', 'jsonl'],
+                        help='default: jsonl for .jsonl/.json files, tsv otherwise')
+    parser.add_argument('--premise_field', type=str, default=None,
+                        help='tsv column index or jsonl key (default 0 / sentence1)')
+    parser.add_argument('--hypothesis_field', type=str, default=None,
+                        help='tsv column index or jsonl key (default 1 / sentence2)')
+    parser.add_argument('--id_field', type=str, default=None, help='copied to the "id" of each prediction')
+    parser.add_argument('--skip_header', action='store_true', help='the tsv has a header line')
+    parser.add_argument('--output', type=str, required=True, help='jsonl predictions, appended to when resuming')
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--chunk_size', type=int, default=4096, help='pairs tokenized per worker task')
+    parser.add_argument('--num_workers', type=int, default=2, help='tokenizer processes, 0 tokenizes inline')
+    parser.add_argument('--prefetch_chunks', type=int, default=None,
+                        help='chunks tokenized ahead of the model (default: 2 per worker)')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch.set_num_threads')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    if not args.checkpoint and not args.exported_model:
+        parser.error('one of --checkpoint and --exported_model is required')
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    input_format = args.input_format or ('jsonl' if args.input.endswith(('.jsonl', '.json')) else 'tsv')
+    premise_field = args.premise_field or ('0' if input_format == 'tsv' else 'sentence1')
+    hypothesis_field = args.hypothesis_field or ('1' if input_format == 'tsv' else 'sentence2')
+    prefetch_chunks = args.prefetch_chunks or max(2 * args.num_workers, 1)
+
+    done = completed_lines(args.output)
+    if done:
+        logger.info('resuming: %d pairs already scored in %s', done, args.output)
+    pairs = itertools.islice(read_pairs(args.input, input_format, premise_field, hypothesis_field,
+                                        args.id_field, args.skip_header), done, None)
+
+    model = load_inference_model(args.checkpoint, args.exported_model, args.quantize, args.pretrain_model_dir)
+    model.to(args.device)
+    pad_token = roberta_layout(load_tokenizer(args.pretrain_model_dir))['pad_token']
+    if args.num_workers > 0:
+        pool = multiprocessing.Pool(args.num_workers, initializer=_init_worker,
+                                    initargs=(args.pretrain_model_dir, args.max_seq_length))
+        tokenize = lambda chunk: pool.apply_async(_tokenize_chunk, (chunk,))
+    else:
+        pool = None
+        _init_worker(args.pretrain_model_dir, args.max_seq_length)
+        tokenize = lambda chunk: _Inline(_tokenize_chunk(chunk))
+
+    pending = collections.deque()
+    scored = done
+    start = time.time()
+
+    def write_next(writer):
+        index, ids, result = pending.popleft()
+        input_ids, lengths = result.get()
+        probs = score_chunk(model, input_ids, lengths, args.batch_size, pad_token, args.device)
+        records = []
+        for i, (pair_id, p) in enumerate(zip(ids, probs)):
+            record = {'index': index + i}
+            if args.id_field is not None:
+                record['id'] = pair_id
+            record.update(format_prediction(p))
+            records.append(record)
+        writer.write_all(records, block_size=len(records))
+        return index + len(records)
+
+    try:
+        with jsonlines.open(args.output, mode='a', compact=True, flush=True) as writer:
+            index = done
+            while True:
+                chunk = list(itertools.islice(pairs, args.chunk_size))
+                if not chunk:
+                    break
+                pending.append((index, [pair_id for pair_id, _, _ in chunk],
+                                tokenize([(premise, hypothesis) for _, premise, hypothesis in chunk])))
+                index += len(chunk)
+                if len(pending) >= prefetch_chunks:
+                    scored = write_next(writer)
+                    logger.info('%d pairs scored, %.1f pairs/sec', scored, (scored - done) / (time.time() - start))
+            while pending:
+                scored = write_next(writer)
+                logger.info('%d pairs scored, %.1f pairs/sec', scored, (scored - done) / (time.time() - start))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    logger.info('finished: %d pairs in %s', scored, args.output)
+
+
+if __name__ == '__main__':
+    main()
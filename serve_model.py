@@ -0,0 +1,316 @@
+"""
+local entailment inference server that coalesces concurrent requests into micro-batches
+
+    python serve_model.py --checkpoint MNLI_pretrained/_acc_0.9040886899918633.pt --port 8008
+    python serve_model.py --exported_model mnli.int8.ts --unix_socket /tmp/entail.sock --max_wait_ms 10
+
+POST /predict  {"pairs": [[premise, hypothesis], ...]}  or  {"premise": ..., "hypothesis": ...}
+               -> {"predictions": [format_prediction(...), ...]}, one per pair, in order
+GET  /metrics  queue depth, batch sizes, latency percentiles, throughput
+GET  /health
+
+Pairs of all requests that arrive within `max_wait_ms` of the oldest waiting one are run
+as one model batch of up to `max_batch_size` pairs. load_generator.py drives a running server.
+"""
+
+import argparse
+import collections
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import torch
+
+from entailment_model import format_prediction, load_tokenizer, roberta_layout
+from export_model import load_inference_model
+from feature_conversion import encode_pairs
+
+
+logger = logging.getLogger(__name__)
+
+
+class EntailmentPredictor(object):
+    '''pairs -> format_prediction dicts, one model call, padded to the longest pair'''
+
+    def __init__(self, model, tokenizer, max_seq_length):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.layout = roberta_layout(tokenizer)
+
+    def __call__(self, pairs):
+        input_ids, input_mask, _ = encode_pairs(pairs, self.tokenizer, self.max_seq_length, **self.layout)
+        seq_length = int(input_mask.sum(1).max())
+        with torch.no_grad():
+            logits = self.model(torch.from_numpy(input_ids[:, :seq_length]),
+                                torch.from_numpy(input_mask[:, :seq_length]))
+        probs = torch.softmax(logits.float(), dim=1).numpy()
+        return [format_prediction(p) for p in probs]
+
+
+class _Request(object):
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.enqueued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ServerMetrics(object):
+    '''counters since start and latencies of the last `window` requests / batches'''
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.pairs = 0
+        self.batches = 0
+        self.errors = 0
+        self.latency_ms = collections.deque(maxlen=window)
+        self.queue_wait_ms = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.model_ms = collections.deque(maxlen=window)
+
+    def record_batch(self, requests, num_pairs, started, finished, failed):
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.pairs += num_pairs
+            self.errors += len(requests) if failed else 0
+            self.batch_sizes.append(num_pairs)
+            self.model_ms.append(1000 * (finished - started))
+            for request in requests:
+                self.queue_wait_ms.append(1000 * (started - request.enqueued))
+                self.latency_ms.append(1000 * (finished - request.enqueued))
+
+    def snapshot(self, queue_depth):
+        def percentiles(values):
+            if not values:
+                return {}
+            return {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+                    'p99': float(np.percentile(values, 99)), 'max': float(max(values))}
+        with self.lock:
+            uptime = time.time() - self.started
+            return {'uptime_sec': uptime,
+                    'queue_depth': queue_depth,
+                    'requests': self.requests,
+                    'pairs': self.pairs,
+                    'batches': self.batches,
+                    'errors': self.errors,
+                    'pairs_per_sec': self.pairs / uptime,
+                    'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                    'latency_ms': percentiles(list(self.latency_ms)),
+                    'queue_wait_ms': percentiles(list(self.queue_wait_ms)),
+                    'model_ms': percentiles(list(self.model_ms))}
+
+
+class MicroBatcher(object):
+    """
+    `submit` blocks the calling (request) thread until its pairs are predicted. One worker
+    thread takes the oldest waiting request, keeps collecting requests until
+    `max_batch_size` pairs or `max_wait_ms` after that request arrived, and runs them
+    through `predict` together (in chunks of max_batch_size if one request is larger).
+    """
+
+    def __init__(self, predict, max_batch_size=32, max_wait_ms=5.0, metrics=None):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name='micro-batcher')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, pairs):
+        request = _Request(pairs)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def queue_depth(self):
+        '''requests waiting for a batch'''
+        return self.queue.qsize()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        num_pairs = len(batch[0].pairs)
+        deadline = batch[0].enqueued + self.max_wait
+        while num_pairs < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_pairs += len(request.pairs)
+        return batch, num_pairs
+
+    def _run(self):
+        while True:
+            batch, num_pairs = self._collect()
+            pairs = [pair for request in batch for pair in request.pairs]
+            started = time.time()
+            failed = False
+            try:
+                results = []
+                for start in range(0, len(pairs), self.max_batch_size):
+                    results.extend(self.predict(pairs[start:start + self.max_batch_size]))
+                position = 0
+                for request in batch:
+                    request.result = results[position:position + len(request.pairs)]
+                    position += len(request.pairs)
+            except Exception as e:
+                logger.exception('prediction failed')
+                failed = True
+                for request in batch:
+                    request.error = e
+            self.metrics.record_batch(batch, num_pairs, started, time.time(), failed)
+            for request in batch:
+                request.done.set()
+
+
+def parse_pairs(body):
+    '''the pairs of a /predict request body, ValueError if malformed'''
+    if 'pairs' in body:
+        pairs = body['pairs']
+    elif 'premise' in body and 'hypothesis' in body:
+        pairs = [[body['premise'], body['hypothesis']]]
+    else:
+        raise ValueError('expected "pairs" or "premise" and "hypothesis"')
+    if not isinstance(pairs, list) or not all(
+            isinstance(pair, (list, tuple)) and len(pair) == 2 and all(isinstance(text, str) for text in pair)
+            for pair in pairs):
+        raise ValueError('"pairs" must be a list of [premise, hypothesis] strings')
+    return [(premise, hypothesis) for premise, hypothesis in pairs]
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        batcher = self.server.batcher
+        if self.path == '/metrics':
+            self._send_json(200, batcher.metrics.snapshot(batcher.queue_depth()))
+        elif self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': 'unknown path'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            pairs = parse_pairs(json.loads(self.rfile.read(length).decode('utf-8')))
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        try:
+            predictions = self.server.batcher.submit(pairs) if pairs else []
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, {'predictions': predictions})
+
+    def address_string(self):
+        # a Unix socket peer has no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher, host='127.0.0.1', port=8008, unix_socket=None):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.batcher = batcher
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''http.client connection over a Unix socket, for clients of `--unix_socket` servers'''
+
+    def __init__(self, path, timeout=60):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='state_dict of the scripts\' RobertaForSequenceClassification')
+    parser.add_argument('--exported_model', type=str, default=None, help='a file written by export_model.py')
+    parser.add_argument('--quantize', action='store_true', help='serve the int8 model of quantization.py')
+    parser.add_argument('--pretrain_model_dir', type=str, default='roberta-large')
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help='how long the oldest request waits for others to join its batch')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--unix_socket', type=str, default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch.set_num_threads')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
+    if not args.checkpoint and not args.exported_model:
+        parser.error('one of --checkpoint and --exported_model is required')
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    model = load_inference_model(args.checkpoint, args.exported_model, args.quantize, args.pretrain_model_dir)
+    predictor = EntailmentPredictor(model, load_tokenizer(args.pretrain_model_dir), args.max_seq_length)
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_wait_ms)
+    server = make_server(batcher, args.host, args.port, args.unix_socket)
+    logger.info('serving on %s', args.unix_socket or '{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
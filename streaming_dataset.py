@@ -0,0 +1,97 @@
+"""
+iterable training dataset that streams rows from a memory-mapped feature cache entry
+"""
+
+import random
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+class StreamingFeatureDataset(IterableDataset):
+    """
+    Yields row indices of a TokenizedFeatures (`collate` turns them into the
+    usual (input_ids, input_mask, segment_ids, label_ids) batch), reading the
+    memory-mapped rows shard by shard instead of materialising the dataset.
+
+    Every epoch the shards (`shard_size` consecutive rows) are put in a random
+    order, and that stream of rows is cut into equal contiguous parts, one
+    per distributed rank. A rank's part is split between its DataLoader
+    workers on `batch_size` boundaries, so only the worker holding the last
+    rows yields a partial batch and the DataLoader yields exactly
+    len(dataloader) batches. Each worker's rows are shuffled through a buffer
+    of `shuffle_buffer_size` rows. The order depends only on seed, epoch,
+    world size and number of workers; rows past a multiple of the world size
+    are dropped so every rank takes the same number of steps. Call
+    `set_epoch` before iterating each epoch.
+
+        DataLoader(dataset, batch_size=dataset.batch_size, collate_fn=dataset.collate, num_workers=...)
+    """
+
+    def __init__(self, features, seed, batch_size=1, shard_size=10000, shuffle_buffer_size=10000,
+                 rank=None, world_size=None, trim=True):
+        self.features = features
+        self.seed = seed
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        if world_size is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            world_size = torch.distributed.get_world_size() if distributed else 1
+            rank = torch.distributed.get_rank() if distributed else 0
+        self.rank = rank
+        self.world_size = world_size
+        self.trim = trim
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        '''rows this rank yields per epoch'''
+        return len(self.features) // self.world_size
+
+    def _shards(self, rng):
+        shards = [(start, min(start + self.shard_size, len(self.features)))
+                  for start in range(0, len(self.features), self.shard_size)]
+        rng.shuffle(shards)
+        return shards
+
+    def _rows(self, shards, begin, end):
+        '''rows at positions [begin, end) of the concatenation of `shards`'''
+        position = 0
+        for start, stop in shards:
+            size = stop - start
+            if position + size > begin and position < end:
+                for row in range(start + max(begin - position, 0), start + min(end - position, size)):
+                    yield row
+            position += size
+            if position >= end:
+                break
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        shards = self._shards(random.Random('{}-{}'.format(self.seed, self.epoch)))
+
+        per_rank = len(self)
+        num_batches = (per_rank + self.batch_size - 1) // self.batch_size
+        rank_begin = self.rank * per_rank
+        begin = rank_begin + min(num_batches * worker_id // num_workers * self.batch_size, per_rank)
+        end = rank_begin + min(num_batches * (worker_id + 1) // num_workers * self.batch_size, per_rank)
+
+        rng = random.Random('{}-{}-{}-{}'.format(self.seed, self.epoch, self.rank, worker_id))
+        buffer = []
+        for row in self._rows(shards, begin, end):
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(row)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], row = row, buffer[i]
+            yield row
+        rng.shuffle(buffer)
+        for row in buffer:
+            yield row
+
+    def collate(self, indices):
+        return self.features.batch(indices, trim=self.trim)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the shared modules live at the repository root, as for the 2020 scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
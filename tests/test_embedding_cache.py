@@ -0,0 +1,71 @@
+"""
+embedding_cache.EmbeddingCache with parallel seeds: the dataset is encoded once
+"""
+
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import torch
+
+from embedding_cache import EmbeddingCache
+from example_table import Example
+
+
+EXAMPLES = [Example(str(i), 'premise %d' % i, 'hypothesis %d' % (i % 7), 'entailment') for i in range(50)]
+
+
+def to_dataloader(examples):
+    '''one batch of ids: the premise number, so the vectors identify their example'''
+    ids = torch.tensor([[int(example.text_a.split()[1])] for example in examples], dtype=torch.long)
+    return [(ids, torch.ones_like(ids))]
+
+
+class CountingEncoder(torch.nn.Module):
+    '''appends a line to `log_path` per forward, and is slow enough for the seeds to collide'''
+
+    def __init__(self, log_path):
+        super(CountingEncoder, self).__init__()
+        self.log_path = log_path
+
+    def forward(self, input_ids, input_mask):
+        with open(self.log_path, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+        time.sleep(1)
+        return (input_ids.float().repeat(1, 4),)
+
+
+def encode_in_seed(cache_dir, log_path, seed, results):
+    cache = EmbeddingCache(cache_dir, 'checkpoint', 128, poll_seconds=0.1)
+    examples = list(EXAMPLES)
+    np.random.RandomState(seed).shuffle(examples)
+    embeddings = cache.encode('MNLI.train', examples, to_dataloader, CountingEncoder(log_path), torch.device('cpu'))
+    vectors = embeddings.take(list(range(len(examples))), torch.device('cpu'))
+    results.put((seed, [example.text_a for example in examples], vectors[:, 0].tolist()))
+
+
+def test_parallel_seeds_encode_once(tmp_path):
+    cache_dir, log_path = str(tmp_path / 'cache'), str(tmp_path / 'forwards.log')
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=encode_in_seed, args=(cache_dir, log_path, seed, results))
+                 for seed in range(4)]
+    for process in processes:
+        process.start()
+    outputs = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with open(log_path) as f:
+        assert len(f.read().split()) == 1
+    assert [name for name in os.listdir(cache_dir) if not name.endswith('.npy')] == []
+    for seed, texts, vectors in outputs:
+        assert vectors == [float(text.split()[1]) for text in texts]
+
+
+def test_empty_dataset(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), 'checkpoint', 128)
+    embeddings = cache.encode('empty', [], lambda examples: [], CountingEncoder(str(tmp_path / 'log')), torch.device('cpu'))
+    assert len(embeddings) == 0
+    assert not os.path.exists(str(tmp_path / 'log'))
@@ -0,0 +1,115 @@
+"""
+parity of the batched encoder (feature_conversion.batched_convert_examples_to_features)
+and of the process-pool converter (parallel_convert_examples_to_features) with the
+original convert_examples_to_features
+
+    python -m pytest tests/test_feature_conversion.py
+
+The synthetic pairs use a whitespace tokenizer. To also compare on real data, set
+FEATURE_PARITY_TOKENIZER (e.g. roberta-large) and FEATURE_PARITY_TSV (an MNLI tsv).
+"""
+
+import os
+import random
+
+import pytest
+
+from example_table import Example
+from feature_conversion import (_truncate_seq_pair, batched_convert_examples_to_features,
+                                convert_examples_to_features, parallel_convert_examples_to_features,
+                                truncated_pair_lengths)
+
+
+LABEL_LIST = ["entailment", "neutral", "contradiction"]
+
+
+class WhitespaceTokenizer(object):
+    '''stands in for the RoBERTa tokenizer: token "w<i>" has id 3 + i'''
+    cls_token = '<s>'
+    sep_token = '</s>'
+    pad_token = '<pad>'
+    vocab = {'<s>': 0, '<pad>': 1, '</s>': 2}
+
+    def tokenize(self, text):
+        return text.split()
+
+    def convert_tokens_to_ids(self, tokens):
+        return [self.vocab[token] if token in self.vocab else 3 + int(token[1:]) for token in tokens]
+
+
+def synthetic_examples(size=3000, seed=42):
+    '''random pairs, including empty, missing and whitespace-only text_b and pairs far above max_seq_length'''
+    rng = random.Random(seed)
+    text = lambda: ' '.join('w%d' % rng.randint(0, 99) for _ in range(rng.choice([0, 1, 2, 5, 30, 70, 200])))
+    return [Example(None, text() or 'w1', rng.choice([text(), text(), None, '', '  ']), rng.choice(LABEL_LIST))
+            for _ in range(size)]
+
+
+def layout_kwargs(tokenizer, sep_token_extra):
+    '''the RoBERTa layout the 2020 scripts pass to convert_examples_to_features'''
+    return dict(cls_token=tokenizer.cls_token, cls_token_segment_id=0,
+                sep_token=tokenizer.sep_token, sep_token_extra=sep_token_extra,
+                pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                pad_token_segment_id=0)
+
+
+def quiet(done, total):
+    pass
+
+
+def batched_mismatches(examples, max_seq_length, tokenizer, sep_token_extra):
+    '''indices of the examples where the batched features differ from convert_examples_to_features'''
+    kwargs = layout_kwargs(tokenizer, sep_token_extra)
+    expected = convert_examples_to_features(examples, LABEL_LIST, max_seq_length, tokenizer, "classification",
+                                            progress_callback=quiet, **kwargs)
+    actual = batched_convert_examples_to_features(examples, LABEL_LIST, max_seq_length, tokenizer, "classification",
+                                                  batch_size=97, progress_callback=quiet, **kwargs)
+    assert len(expected) == len(actual)
+    return [i for i, (e, a) in enumerate(zip(expected, actual)) if e.__dict__ != a.__dict__]
+
+
+def test_truncated_pair_lengths_matches_truncate_seq_pair():
+    for max_length in range(0, 40):
+        for len_a in range(0, 50):
+            for len_b in range(0, 50):
+                tokens_a, tokens_b = [0] * len_a, [0] * len_b
+                _truncate_seq_pair(tokens_a, tokens_b, max_length)
+                new_a, new_b = truncated_pair_lengths([len_a], [len_b], max_length)
+                assert (new_a[0], new_b[0]) == (len(tokens_a), len(tokens_b)), (len_a, len_b, max_length)
+
+
+@pytest.mark.parametrize('sep_token_extra', [True, False])
+@pytest.mark.parametrize('max_seq_length', [6, 7, 16, 64, 128])
+def test_batched_conversion_parity(max_seq_length, sep_token_extra):
+    mismatches = batched_mismatches(synthetic_examples(), max_seq_length, WhitespaceTokenizer(), sep_token_extra)
+    assert not mismatches, mismatches[:10]
+
+
+@pytest.mark.skipif(not (os.environ.get('FEATURE_PARITY_TOKENIZER') and os.environ.get('FEATURE_PARITY_TSV')),
+                    reason='FEATURE_PARITY_TOKENIZER / FEATURE_PARITY_TSV not set')
+@pytest.mark.parametrize('max_seq_length', [16, 64, 128])
+def test_batched_conversion_parity_on_real_data(max_seq_length):
+    from transformers.tokenization_roberta import RobertaTokenizer
+    from tsv_reader import read_tsv
+
+    tokenizer = RobertaTokenizer.from_pretrained(os.environ['FEATURE_PARITY_TOKENIZER'])
+    examples = [Example(None, text_a, text_b, label) for text_a, text_b, label
+                in read_tsv(os.environ['FEATURE_PARITY_TSV'], columns=(8, 9, -1), skip_header=True)]
+    assert examples, 'no MNLI rows in FEATURE_PARITY_TSV'
+    mismatches = batched_mismatches(examples, max_seq_length, tokenizer, True)
+    assert not mismatches, mismatches[:10]
+
+
+@pytest.mark.parametrize('num_workers, chunk_size', [(2, 250), (3, 97), (4, 1000), (1, 250)])
+@pytest.mark.parametrize('pad_on_left', [False, True])
+def test_parallel_conversion_matches_serial(num_workers, chunk_size, pad_on_left):
+    '''pad_on_left is a layout encode_pairs does not support, the workers then run convert_examples_to_features'''
+    tokenizer = WhitespaceTokenizer()
+    examples = synthetic_examples(size=1000)
+    kwargs = dict(layout_kwargs(tokenizer, True), pad_on_left=pad_on_left)
+    expected = convert_examples_to_features(examples, LABEL_LIST, 64, tokenizer, "classification",
+                                            progress_callback=quiet, **kwargs)
+    actual = parallel_convert_examples_to_features(examples, LABEL_LIST, 64, tokenizer, "classification",
+                                                   num_workers=num_workers, chunk_size=chunk_size,
+                                                   progress_callback=quiet, **kwargs)
+    assert [f.__dict__ for f in actual] == [f.__dict__ for f in expected]
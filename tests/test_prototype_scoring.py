@@ -0,0 +1,47 @@
+"""
+parity of prototype_scoring.factorized_prototype_scores with the pairwise forward of the
+PrototypeNet the GFS.Entail scripts train (PrototypeNet with scoring_chunk_size=0)
+"""
+
+import pytest
+import torch
+
+from prototype_scoring import PrototypeNet, factorized_prototype_scores
+
+
+HIDDEN_SIZE = 64
+
+
+def scores_and_grads(net, score):
+    net.zero_grad()
+    scores = score()
+    scores.sum().backward()
+    return scores.detach(), [p.grad.clone() for p in net.parameters()]
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 100])
+@pytest.mark.parametrize('chunk_size', [None, 1, 3, 64])
+def test_factorized_scores_match_pairwise_forward(batch_size, chunk_size):
+    '''float64 and eval mode (no dropout), so both paths should agree to rounding'''
+    torch.manual_seed(0)
+    net = PrototypeNet(HIDDEN_SIZE).double().eval()
+    rep_classes = torch.randn(6, HIDDEN_SIZE, dtype=torch.float64)
+    rep_query_batch = torch.randn(batch_size, HIDDEN_SIZE, dtype=torch.float64)
+
+    expected, expected_grads = scores_and_grads(net, lambda: net(rep_classes, rep_query_batch))
+    actual, actual_grads = scores_and_grads(
+        net, lambda: factorized_prototype_scores(net, rep_classes, rep_query_batch, chunk_size))
+    assert actual.shape == (batch_size, 3)
+    assert torch.allclose(actual, expected, rtol=0, atol=1e-10)
+    for grad, expected_grad in zip(actual_grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, rtol=0, atol=1e-10)
+
+
+def test_scoring_chunk_size_selects_the_factorized_path():
+    torch.manual_seed(0)
+    net = PrototypeNet(HIDDEN_SIZE).double().eval()
+    rep_classes = torch.randn(6, HIDDEN_SIZE, dtype=torch.float64)
+    rep_query_batch = torch.randn(10, HIDDEN_SIZE, dtype=torch.float64)
+    expected = net(rep_classes, rep_query_batch)
+    net.scoring_chunk_size = 4
+    assert torch.allclose(net(rep_classes, rep_query_batch), expected, rtol=0, atol=1e-10)
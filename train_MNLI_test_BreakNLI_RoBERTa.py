@@ -137,10 +137,10 @@ class RteProcessor(DataProcessor):
         return examples
 
     def get_BreakNLI_as_test(self, filename):
-        readfile = jsonlines.open(filename, 'r')
+        readfile = jsonlines.open(filename, 'r', loads='auto')
         line_co=0
         examples=[]
-        for row2dict in readfile:
+        for row2dict in readfile.read_all():
             guid = "test-"+str(line_co)
             text_a = row2dict.get('sentence1')
             text_b = row2dict.get('sentence2')
@@ -18,11 +18,9 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
-import csv
 import logging
 import os
 import random
-import sys
 import codecs
 import numpy as np
 import torch
@@ -43,6 +41,8 @@ from pytorch_transformers.tokenization_roberta import RobertaTokenizer
 from pytorch_transformers.optimization import AdamW
 from pytorch_transformers.modeling_roberta import RobertaForSequenceClassification
 
+from tsv_reader import read_tsv
+
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
                     level = logging.INFO)
@@ -102,14 +102,7 @@ class DataProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """Reads a tab separated value file."""
-        with open(input_file, "r") as f:
-            reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-            lines = []
-            for line in reader:
-                if sys.version_info[0] == 2:
-                    line = list(unicode(cell, 'utf-8') for cell in line)
-                lines.append(line)
-            return lines
+        return [list(line) for line in read_tsv(input_file, strip_fields=False)]
 
 class RteProcessor(DataProcessor):
     """Processor for the RTE data set (GLUE version)."""
@@ -139,23 +132,14 @@ class RteProcessor(DataProcessor):
 
 
     def get_FEVER_as_test(self, filename):
-        readfile = codecs.open(filename, 'r', 'utf-8')
-        line_co=0
         examples=[]
-        for row in readfile:
-            line=row.strip().split('\t')
-            if len(line)==3:
-                guid = "test-"+str(line_co)
-                text_a = line[0].strip()
-                text_b = line[1].strip()
-                '''for RTE, we currently only choose randomly two labels in the set, in prediction we then decide the predicted labels'''
-                label = 'entailment'  if line[2] == 'entailment' else 'neutral'
-                examples.append(
-                    InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-                line_co+=1
-
-        readfile.close()
-        print('loaded test size:', line_co)
+        for line_co, (text_a, text_b, label) in enumerate(read_tsv(filename, num_columns=3)):
+            guid = "test-"+str(line_co)
+            '''for RTE, we currently only choose randomly two labels in the set, in prediction we then decide the predicted labels'''
+            label = 'entailment'  if label == 'entailment' else 'neutral'
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+        print('loaded test size:', len(examples))
         return examples
 
     def get_labels(self):
@@ -19,7 +19,7 @@ from bert_common_functions import store_bert_model
 torch.manual_seed(400)
 device = torch.device("cuda")
 
-from bert_common_functions import sent_pair_to_embedding
+from bert_common_functions import sent_pairs_to_embeddings
 
 
 
@@ -41,11 +41,7 @@ class Encoder(nn.Module):
         '''
         sent_pair_batch: a list of list: each sublist has two ele: premise, hypo
         '''
-        emb_batch = []
-        for sent_pair in sent_pair_batch:
-            # print(sent_pair_to_embedding(sent_pair[0], sent_pair[1], self.bert_tokenizer, self.bert_model, False).reshape(1,-1))
-            emb_batch.append(sent_pair_to_embedding(sent_pair[0], sent_pair[1], self.bert_tokenizer, self.bert_model, False).reshape(1,-1))
-        bert_rep_batch = torch.cat(emb_batch, 0) #(batch, 768)
+        bert_rep_batch = sent_pairs_to_embeddings(sent_pair_batch, self.bert_tokenizer, self.bert_model, False) #(batch, 768)
         batch_scores = (self.label_rep(bert_rep_batch)).tanh()#(batch, 2)
         # batch_probs = nn.Softmax(dim=1)((self.classifier(bert_rep_batch)))#(batch, 2)
 
@@ -69,11 +65,7 @@ class Classifier(nn.Module):
         '''
         sent_pair_batch: a list of list: each sublist has two ele: premise, hypo
         '''
-        emb_batch = []
-        for sent_pair in sent_pair_batch:
-            # print(sent_pair_to_embedding(sent_pair[0], sent_pair[1], self.bert_tokenizer, self.bert_model, False).reshape(1,-1))
-            emb_batch.append(sent_pair_to_embedding(sent_pair[0], sent_pair[1], tokenizer, bert_model, False).reshape(1,-1))
-        bert_rep_batch = torch.cat(emb_batch, 0) #(batch, 768)
+        bert_rep_batch = sent_pairs_to_embeddings(sent_pair_batch, tokenizer, bert_model, False) #(batch, 768)
         # batch_scores = (self.label_rep(bert_rep_batch)).tanh()#(batch, 2)
         batch_probs = nn.Softmax(dim=1)((self.classifier(bert_rep_batch)))#(batch, 2)
 
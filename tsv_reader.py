@@ -0,0 +1,62 @@
+"""
+streaming reader for the tab separated dataset files (MNLI, RTE, SciTail, FEVER)
+"""
+
+import io
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_tsv(filename, columns=None, skip_header=False, num_columns=None,
+             strip_fields=True, chunk_size=1 << 22, max_reported=10):
+    '''
+    lazily yields one tuple per well-formed line, holding only the requested columns
+
+    columns: column indices to keep, e.g. (8, 9, -1) for MNLI; None keeps all
+    num_columns: if set, only lines with exactly this many fields are kept
+    strip_fields: strip() each kept field, like the old `line[i].strip()` loops
+
+    Every line is first `strip()`-ed and split on tabs, the same as the
+    `row.strip().split('\t')` loops this replaces. Blank lines are skipped;
+    lines that are too short for `columns` or do not have `num_columns`
+    fields are logged (the first `max_reported`, then a summary) and skipped.
+    '''
+    if columns is not None:
+        columns = tuple(columns)
+    maxsplit = -1
+    if columns is not None and num_columns is None and min(columns) >= 0:
+        # only the leading fields are needed, leave the rest of the line unsplit
+        maxsplit = max(columns) + 1
+    min_fields = 0
+    if columns is not None:
+        min_fields = max(max(columns) + 1, max(-c for c in columns))
+
+    malformed = 0
+    line_no = 0
+    with io.open(filename, 'r', encoding='utf-8', buffering=chunk_size) as f:
+        while True:
+            rows = f.readlines(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                line_no += 1
+                if skip_header and line_no == 1:
+                    continue
+                row = row.strip()
+                if not row:
+                    continue
+                line = row.split('\t', maxsplit)
+                if len(line) < min_fields or (num_columns is not None and len(line) != num_columns):
+                    malformed += 1
+                    if malformed <= max_reported:
+                        logger.warning('%s line %d: malformed, %d fields', filename, line_no, len(line))
+                    continue
+                if columns is not None:
+                    line = [line[c] for c in columns]
+                if strip_fields:
+                    line = [field.strip() for field in line]
+                yield tuple(line)
+    if malformed:
+        logger.warning('%s: skipped %d malformed lines out of %d', filename, malformed, line_no)